@@ -1,8 +1,19 @@
+import asyncio
 import os
+import threading
 import utils
 import time
+from concurrent.futures import Future
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import aiohttp
+except ImportError:
+    # 异步API为可选功能，未安装aiohttp时不可用
+    aiohttp = None
 
 from models import RenderMessage
 
@@ -17,48 +28,241 @@ MESSAGE_URI = "%(host)s/open-apis/im/v1/messages?receive_id_type=%(receive_id_ty
 REPLY_MESSAGE_URI = "%(host)s/open-apis/im/v1/messages/%(messages_id)s/reply"
 USER_INFO_URI = "%(host)s/open-apis/contact/v3/users/%(open_id)s"
 
+# 连接池默认参数
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+DEFAULT_MAX_RETRIES = 3
+# 距离令牌过期多少秒时开始后台刷新（飞书在令牌剩余有效期小于30分钟时才会返回新令牌）
+DEFAULT_TOKEN_REFRESH_AHEAD = 300
+# 令牌无效/过期的错误码
+INVALID_TOKEN_CODES = (99991661, 99991663, 99991668)
+# 触发频率限制的错误码
+RATE_LIMIT_CODES = (99991400, 230020)
+# 异步API默认最大并发请求数
+DEFAULT_ASYNC_MAX_CONCURRENCY = 100
+
+
+class TenantAccessTokenManager(object):
+    """
+    tenant_access_token管理器
+    按接口返回的expire计算过期时间，临近过期时在后台提前刷新；
+    令牌失效时并发的刷新请求会合并为一次，其余线程等待该次刷新的结果
+    """
+
+    def __init__(self, fetcher, refresh_ahead: int = DEFAULT_TOKEN_REFRESH_AHEAD):
+        """
+        初始化令牌管理器
+        :param fetcher:         获取令牌的方法，返回 (token, expire)，expire为有效期秒数
+        :param refresh_ahead:   距离过期多少秒时开始后台刷新
+        """
+        self._fetcher = fetcher
+        self._refresh_ahead = refresh_ahead
+        self._cond = threading.Condition()
+        self._token = ""
+        self._expire_at = 0.0
+        self._refreshing = False
+        # 统计信息
+        self.refresh_count = 0
+        self.background_refresh_count = 0
+        self.wait_count = 0
+        self.error_count = 0
+
+    @property
+    def token(self) -> str:
+        return self._token
+
+    def _is_valid(self, now: float) -> bool:
+        return bool(self._token) and now < self._expire_at
+
+    def get(self, block: bool = True) -> str:
+        """
+        获取可用令牌，仅在令牌不可用时阻塞
+        :param block: 令牌不可用时是否阻塞刷新，为False时直接返回空字符串
+        :return:
+        """
+        now = time.time()
+        token = self._token
+        if self._is_valid(now):
+            if now >= self._expire_at - self._refresh_ahead:
+                self._refresh_in_background()
+            return token
+        if not block:
+            return ""
+        return self._refresh()
+
+    def invalidate(self, token: str):
+        """
+        标记令牌失效，仅当该令牌仍为当前令牌时生效，避免覆盖其他线程刚刷新的令牌
+        :param token: 失效的令牌
+        :return:
+        """
+        with self._cond:
+            if token == self._token:
+                self._expire_at = 0.0
+
+    def stats(self) -> dict:
+        return {
+            "refresh_count": self.refresh_count,
+            "background_refresh_count": self.background_refresh_count,
+            "wait_count": self.wait_count,
+            "error_count": self.error_count,
+            "expire_at": self._expire_at
+        }
+
+    def _refresh(self) -> str:
+        with self._cond:
+            waited = False
+            while True:
+                if self._is_valid(time.time()):
+                    return self._token
+                if not self._refreshing:
+                    break
+                if not waited:
+                    waited = True
+                    self.wait_count += 1
+                self._cond.wait()
+            self._refreshing = True
+        return self._do_refresh()
+
+    def _refresh_in_background(self):
+        with self._cond:
+            if self._refreshing:
+                return
+            self._refreshing = True
+            self.background_refresh_count += 1
+
+        def _run():
+            try:
+                self._do_refresh()
+            except BaseException as e:
+                logger.error("tenant_access_token后台刷新失败: %s" % e)
+
+        threading.Thread(target=_run, name="tenant-token-refresh", daemon=True).start()
+
+    def _do_refresh(self) -> str:
+        """
+        执行刷新，调用前必须已将 _refreshing 置为True
+        """
+        try:
+            token, expire = self._fetcher()
+        except BaseException:
+            with self._cond:
+                self._refreshing = False
+                self.error_count += 1
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            self._token = token
+            self._expire_at = time.time() + expire
+            self._refreshing = False
+            self.refresh_count += 1
+            self._cond.notify_all()
+        return token
+
 
 class MessageApiClient(object):
-    def __init__(self, app_id, app_secret, lark_host):
+    def __init__(self, app_id, app_secret, lark_host,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT,
+                 max_retries: int = DEFAULT_MAX_RETRIES,
+                 token_refresh_ahead: int = DEFAULT_TOKEN_REFRESH_AHEAD):
+        """
+        初始化飞书API
+        :param app_id:          APP_ID
+        :param app_secret:      APP_SECRET
+        :param lark_host:       飞书API地址
+        :param pool_size:       每个host的连接池大小，建议与事件处理线程数保持一致
+        :param connect_timeout: 连接超时(秒)
+        :param read_timeout:    读取超时(秒)
+        :param max_retries:     幂等请求(GET等)的最大重试次数，POST不重试
+        :param token_refresh_ahead: 距离令牌过期多少秒时开始后台刷新
+        """
         self._app_id = app_id
         self._app_secret = app_secret
         self._lark_host = lark_host
-        self._tenant_access_token = ""
-        self._tenant_access_token_time = 0
+        self._token_manager = TenantAccessTokenManager(self._fetch_tenant_access_token, token_refresh_ahead)
+        self._timeout = (connect_timeout, read_timeout)
+        self._session = MessageApiClient._create_session(pool_size, max_retries)
+
+    @staticmethod
+    def _create_session(pool_size: int, max_retries: int) -> requests.Session:
+        """
+        创建共享的长连接会话
+        requests.Session的连接池是线程安全的，所有线程共用同一个会话以复用TCP/TLS连接
+        """
+        retry = Retry(total=max_retries,
+                      backoff_factor=0.3,
+                      status_forcelist=(500, 502, 503, 504),
+                      allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.headers.update({"Connection": "keep-alive"})
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    def close(self):
+        self._session.close()
 
     @property
     def tenant_access_token(self):
-        return self._tenant_access_token
+        return self._token_manager.token
+
+    @property
+    def token_manager(self) -> TenantAccessTokenManager:
+        return self._token_manager
 
     def send_message_with_open_id(self, msg: RenderMessage):
-        self._send_message("open_id", msg)
+        return self._send_message("open_id", msg)
 
     def send_message_with_group_id(self, msg: RenderMessage):
-        self._send_message("chat_id", msg)
+        return self._send_message("chat_id", msg)
 
     def reply_message(self, messages_id: str, msg: RenderMessage):
+        return self.reply_message_json(messages_id, msg.json())
+
+    def send_message_json(self, receive_id_type: str, req_body: dict):
+        """
+        发送已序列化的消息体
+        :param receive_id_type: open_id / chat_id
+        :param req_body:        RenderMessage.json()的结果
+        :return:
+        """
+        url = MESSAGE_URI % {
+            "host": self._lark_host,
+            "receive_id_type": receive_id_type
+        }
+        return self._post_json(url, req_body)
+
+    def reply_message_json(self, messages_id: str, req_body: dict):
+        """
+        使用已序列化的消息体回复消息
+        :param messages_id: 被回复的消息ID
+        :param req_body:    RenderMessage.json()的结果
+        :return:
+        """
         url = REPLY_MESSAGE_URI % {
             "host": self._lark_host,
             "messages_id": messages_id
         }
-        self._post_json(url, msg.json())
+        return self._post_json(url, req_body)
 
     def _send_message(self, receive_id_type, msg: RenderMessage):
-        url = MESSAGE_URI % {
-            "host": self._lark_host,
-            "receive_id_type": receive_id_type
-        }
-        self._post_json(url, msg.json())
-
-    def _authorize_tenant_access_token(self):
-        now = int(time.time())
-        if now - self._tenant_access_token_time > 1200:
-            url = TENANT_ACCESS_TOKEN_URI % {"host": self._lark_host}
-            req_body = {"app_id": self._app_id, "app_secret": self._app_secret}
-            response = requests.post(url, req_body)
-            MessageApiClient._check_error_response(response)
-            self._tenant_access_token = response.json().get("tenant_access_token")
-            self._tenant_access_token_time = now
+        return self.send_message_json(receive_id_type, msg.json())
+
+    def _authorize_tenant_access_token(self) -> str:
+        return self._token_manager.get()
+
+    def _fetch_tenant_access_token(self):
+        url = TENANT_ACCESS_TOKEN_URI % {"host": self._lark_host}
+        req_body = {"app_id": self._app_id, "app_secret": self._app_secret}
+        response = self._session.post(url, req_body, timeout=self._timeout)
+        MessageApiClient._check_error_response(response)
+        response_dict = response.json()
+        return response_dict.get("tenant_access_token"), int(response_dict.get("expire", 7200))
 
     @staticmethod
     def _check_error_response(resp: requests.models.Response):
@@ -69,11 +273,15 @@ class MessageApiClient(object):
             if hasattr(resp, 'msg_content'):
                 logger.info(resp.json())
             # resp.raise_for_status()
-        response_dict = resp.json()
+        try:
+            response_dict = resp.json()
+        except ValueError:
+            response_dict = {"code": -1, "msg": resp.text}
         code = response_dict.get("code", -1)
         if code != 0:
             logger.error(response_dict)
-            raise LarkException(code=code, msg=response_dict.get("msg"))
+            raise LarkException(code=code, msg=response_dict.get("msg"), status_code=resp.status_code,
+                                retry_after=LarkException.parse_retry_after(resp.headers))
 
     def get_user_info_with_open_id(self, open_id: str):
         url = USER_INFO_URI % {
@@ -87,40 +295,229 @@ class MessageApiClient(object):
         return self._get_json(url, body)
 
     def _get_json(self, url, req_body):
-        self._authorize_tenant_access_token()
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + self.tenant_access_token,
-        }
-        logger.info("==========[_get_json]==========")
-        logger.info(url)
-        logger.info(headers)
-        logger.info(req_body)
-        logger.info("===============================")
-        response = requests.get(url=url, headers=headers, json=req_body)
-        self._check_error_response(response)
-        return response.json()
+        return self._request_json("GET", url, req_body)
 
     def _post_json(self, url, req_body):
-        self._authorize_tenant_access_token()
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": "Bearer " + self.tenant_access_token,
+        return self._request_json("POST", url, req_body)
+
+    def _request_json(self, method, url, req_body):
+        # 令牌失效时刷新令牌并重试一次
+        for attempt in range(2):
+            token = self._authorize_tenant_access_token()
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + token,
+            }
+            logger.info("==========[%s]==========" % method)
+            logger.info(url)
+            logger.info(headers)
+            logger.info(req_body)
+            logger.info("========================")
+            response = self._session.request(method, url=url, headers=headers, json=req_body, timeout=self._timeout)
+            try:
+                self._check_error_response(response)
+            except LarkException as e:
+                if attempt == 0 and e.code in INVALID_TOKEN_CODES:
+                    logger.info("tenant_access_token已失效，刷新后重试")
+                    self._token_manager.invalidate(token)
+                    continue
+                raise
+            return response.json()
+
+
+class AsyncMessageApiClient(object):
+    """
+    异步飞书API（需要安装aiohttp）
+    所有请求都在客户端自有的事件循环线程中执行，共享同一个连接池，并通过信号量限制并发数；
+    可以在任意事件循环中await，也可以在同步插件中通过run()批量等待
+    """
+
+    def __init__(self, app_id, app_secret, lark_host,
+                 token_manager: TenantAccessTokenManager = None,
+                 pool_size: int = DEFAULT_ASYNC_MAX_CONCURRENCY,
+                 max_concurrency: int = DEFAULT_ASYNC_MAX_CONCURRENCY,
+                 connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout: float = DEFAULT_READ_TIMEOUT):
+        """
+        初始化异步飞书API
+        :param app_id:          APP_ID
+        :param app_secret:      APP_SECRET
+        :param lark_host:       飞书API地址
+        :param token_manager:   令牌管理器，建议与同步API共用（MessageApiClient.token_manager）
+        :param pool_size:       连接池大小
+        :param max_concurrency: 最大并发请求数
+        :param connect_timeout: 连接超时(秒)
+        :param read_timeout:    读取超时(秒)
+        """
+        if aiohttp is None:
+            raise ImportError("AsyncMessageApiClient 需要安装 aiohttp")
+        self._app_id = app_id
+        self._app_secret = app_secret
+        self._lark_host = lark_host
+        self._token_manager = token_manager or TenantAccessTokenManager(self._fetch_tenant_access_token)
+        self._pool_size = pool_size
+        self._max_concurrency = max_concurrency
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._lock = threading.Lock()
+        self._loop = None
+        self._session = None
+        self._semaphore = None
+
+    @staticmethod
+    def available() -> bool:
+        return aiohttp is not None
+
+    @property
+    def token_manager(self) -> TenantAccessTokenManager:
+        return self._token_manager
+
+    async def send_message_with_open_id(self, msg: RenderMessage):
+        return await self._dispatch(self._send_message("open_id", msg.json()))
+
+    async def send_message_with_group_id(self, msg: RenderMessage):
+        return await self._dispatch(self._send_message("chat_id", msg.json()))
+
+    async def reply_message(self, messages_id: str, msg: RenderMessage):
+        url = REPLY_MESSAGE_URI % {
+            "host": self._lark_host,
+            "messages_id": messages_id
         }
-        logger.info("==========[_post_json]==========")
-        logger.info(url)
-        logger.info(headers)
-        logger.info(req_body)
-        logger.info("================================")
-        response = requests.post(url=url, headers=headers, json=req_body)
-        self._check_error_response(response)
-        return response.json()
+        return await self._dispatch(self._request_json("POST", url, msg.json()))
+
+    async def get_user_info_with_open_id(self, open_id: str):
+        url = USER_INFO_URI % {
+            "host": self._lark_host,
+            "open_id": open_id
+        }
+        body = {
+            "user_id_type": "open_id",
+            "department_id_type": "open_department_id"
+        }
+        return await self._dispatch(self._request_json("GET", url, body))
+
+    def submit(self, coro) -> Future:
+        """
+        在客户端事件循环中执行协程（同步代码中使用）
+        :param coro: 协程
+        :return: concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro, timeout: float = None):
+        """
+        在客户端事件循环中执行协程并等待结果（同步代码中使用），
+        例如 tools.async_api_client.run(send_all())，send_all中可以await多个发送请求
+        :param coro:    协程
+        :param timeout: 等待超时(秒)
+        :return: 协程返回值
+        """
+        return self.submit(coro).result(timeout)
+
+    def close(self):
+        loop = self._loop
+        if loop is None:
+            return
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._loop = None
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="lark-async-api", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    async def _dispatch(self, coro):
+        # 连接池与信号量都绑定在客户端事件循环上，其他事件循环中的调用需要转交过去
+        loop = self._ensure_loop()
+        if asyncio.get_running_loop() is loop:
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, loop))
+
+    def _get_session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self._pool_size, limit_per_host=self._pool_size)
+            timeout = aiohttp.ClientTimeout(sock_connect=self._connect_timeout, sock_read=self._read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self._semaphore = asyncio.Semaphore(self._max_concurrency)
+        return self._session
+
+    def _fetch_tenant_access_token(self):
+        # 令牌刷新频率很低，直接使用同步请求
+        url = TENANT_ACCESS_TOKEN_URI % {"host": self._lark_host}
+        req_body = {"app_id": self._app_id, "app_secret": self._app_secret}
+        response = requests.post(url, req_body, timeout=(self._connect_timeout, self._read_timeout))
+        MessageApiClient._check_error_response(response)
+        response_dict = response.json()
+        return response_dict.get("tenant_access_token"), int(response_dict.get("expire", 7200))
+
+    async def _get_token(self) -> str:
+        token = self._token_manager.get(block=False)
+        if not token:
+            token = await asyncio.get_running_loop().run_in_executor(None, self._token_manager.get)
+        return token
+
+    async def _send_message(self, receive_id_type, req_body):
+        url = MESSAGE_URI % {
+            "host": self._lark_host,
+            "receive_id_type": receive_id_type
+        }
+        return await self._request_json("POST", url, req_body)
+
+    async def _request_json(self, method, url, req_body):
+        session = self._get_session()
+        # 令牌失效时刷新令牌并重试一次
+        for attempt in range(2):
+            token = await self._get_token()
+            headers = {
+                "Content-Type": "application/json",
+                "Authorization": "Bearer " + token,
+            }
+            async with self._semaphore:
+                async with session.request(method, url, headers=headers, json=req_body) as response:
+                    try:
+                        response_dict = await response.json(content_type=None)
+                    except (ValueError, aiohttp.ContentTypeError):
+                        # 限流、网关错误等可能返回非JSON的响应体
+                        response_dict = {"code": -1, "msg": await response.text()}
+                    status_code = response.status
+                    retry_after = LarkException.parse_retry_after(response.headers)
+            code = response_dict.get("code", -1)
+            if code != 0:
+                if attempt == 0 and code in INVALID_TOKEN_CODES:
+                    logger.info("tenant_access_token已失效，刷新后重试")
+                    self._token_manager.invalidate(token)
+                    continue
+                logger.error(response_dict)
+                raise LarkException(code=code, msg=response_dict.get("msg"), status_code=status_code,
+                                    retry_after=retry_after)
+            return response_dict
 
 
 class LarkException(Exception):
-    def __init__(self, code=0, msg=None):
+    def __init__(self, code=0, msg=None, status_code=200, retry_after: float = None):
         self.code = code
         self.msg = msg
+        self.status_code = status_code
+        # 服务端要求的重试等待时间(秒)，未返回时为None
+        self.retry_after = retry_after
+
+    @property
+    def is_rate_limited(self) -> bool:
+        return self.status_code == 429 or self.code in RATE_LIMIT_CODES
+
+    @staticmethod
+    def parse_retry_after(headers) -> float:
+        value = headers.get("Retry-After") or headers.get("x-ogw-ratelimit-reset")
+        try:
+            return float(value) if value is not None else None
+        except ValueError:
+            return None
 
     def __str__(self) -> str:
         return "{}:{}".format(self.code, self.msg)
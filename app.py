@@ -1,23 +1,26 @@
 #!/usr/bin/env python3.10
+import atexit
+import functools
 import json
 import os
+import threading
 import utils
 
 import requests
-from werkzeug.exceptions import NotFound
 
-from api import MessageApiClient
+from api import MessageApiClient, AsyncMessageApiClient
 from utils import AESCipher
 from flask import Flask, jsonify, request
-from dotenv import load_dotenv, find_dotenv
 
+from dispatcher import EventDispatcher
+from router import HTTP_METHODS, ROUTE_METHOD_NOT_ALLOWED
+from ingest import EventDeduplicator, SqliteDedupBackend, CallbackDecoder, get_json_codec
 from manager import PluginManager, ConfigManger
-from models import Event
+from models import Event, USER_INFO_CACHE
+from outbox import Outbox
+from scheduler import OutboundScheduler
 from concurrent.futures import ThreadPoolExecutor
 
-executor = ThreadPoolExecutor()
-load_dotenv(find_dotenv())
-
 app = Flask(__name__)
 
 # 加载环境参数
@@ -26,6 +29,48 @@ APP_SECRET = os.getenv("APP_SECRET")
 VERIFICATION_TOKEN = os.getenv("VERIFICATION_TOKEN")
 ENCRYPT_KEY = os.getenv("ENCRYPT_KEY")
 LARK_HOST = os.getenv("LARK_HOST")
+# 事件处理线程数，默认与ThreadPoolExecutor的默认值一致
+EXECUTOR_WORKERS = int(os.getenv("EXECUTOR_WORKERS") or min(32, (os.cpu_count() or 1) + 4))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT") or 3.05)
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT") or 10)
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES") or 3)
+ASYNC_MAX_CONCURRENCY = int(os.getenv("ASYNC_MAX_CONCURRENCY") or 100)
+OUTBOUND_ENDPOINT_RATE = float(os.getenv("OUTBOUND_ENDPOINT_RATE") or 50)
+OUTBOUND_RECEIVER_RATE = float(os.getenv("OUTBOUND_RECEIVER_RATE") or 5)
+OUTBOX_DB_PATH = os.getenv("OUTBOX_DB_PATH") or "./conf/outbox.db"
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS") or 4)
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS") or 8)
+EVENT_DEDUP_CAPACITY = int(os.getenv("EVENT_DEDUP_CAPACITY") or 10000)
+EVENT_DEDUP_TTL = int(os.getenv("EVENT_DEDUP_TTL") or 6 * 3600)
+EVENT_DEDUP_DB_PATH = os.getenv("EVENT_DEDUP_DB_PATH")
+EVENT_LANES = int(os.getenv("EVENT_LANES") or EXECUTOR_WORKERS)
+EVENT_LANE_CAPACITY = int(os.getenv("EVENT_LANE_CAPACITY") or 1000)
+EVENT_OVERFLOW = os.getenv("EVENT_OVERFLOW") or "block"
+EVENT_SPILL_DIR = os.getenv("EVENT_SPILL_DIR") or "./conf/spill"
+JSON_CODEC = os.getenv("JSON_CODEC") or "auto"
+# 回调延迟解析：带签名的回调直接应答并入队，签名校验、解密与解析在后台线程中完成
+CALLBACK_DEFERRED = (os.getenv("CALLBACK_DEFERRED") or "false").lower() == "true"
+# 插件热加载：检查插件文件变化的间隔(秒)，0表示不检查
+PLUGIN_RELOAD_INTERVAL = float(os.getenv("PLUGIN_RELOAD_INTERVAL") or 0)
+# 插件延迟加载：启动时根据插件清单注册插件，首次命中时才导入并初始化；可选在后台预先加载
+PLUGIN_LAZY_LOAD = (os.getenv("PLUGIN_LAZY_LOAD") or "false").lower() == "true"
+PLUGIN_WARM_UP = (os.getenv("PLUGIN_WARM_UP") or "false").lower() == "true"
+PLUGIN_MANIFEST_PATH = os.getenv("PLUGIN_MANIFEST_PATH") or "./conf/plugin_manifest.json"
+# 插件并行初始化的线程数与单个插件的初始化超时时间(秒)
+PLUGIN_INIT_WORKERS = int(os.getenv("PLUGIN_INIT_WORKERS") or 8)
+PLUGIN_INIT_TIMEOUT = float(os.getenv("PLUGIN_INIT_TIMEOUT") or 30)
+# 插件事件处理的超时时间与慢调用阈值(秒，0表示不限制)，连续失败的次数达到阈值后熔断一段时间(秒)
+PLUGIN_HANDLER_TIMEOUT = float(os.getenv("PLUGIN_HANDLER_TIMEOUT") or 0)
+PLUGIN_SLOW_CALL = float(os.getenv("PLUGIN_SLOW_CALL") or 0)
+PLUGIN_BREAKER_THRESHOLD = int(os.getenv("PLUGIN_BREAKER_THRESHOLD") or 5)
+PLUGIN_BREAKER_RESET = float(os.getenv("PLUGIN_BREAKER_RESET") or 30)
+# 插件进程池的进程数，仅 PluginInfo(process_pool=True) 的插件使用，默认为CPU核数
+PLUGIN_PROCESS_WORKERS = int(os.getenv("PLUGIN_PROCESS_WORKERS") or 0) or None
+# 配置日志超过该大小(字节)时压缩到配置文件
+CONFIG_COMPACT_BYTES = int(os.getenv("CONFIG_COMPACT_BYTES") or 1024 * 1024)
+# 配置延迟写入的刷新间隔(秒，0表示每次修改立即写入)，待写入的键数达到阈值时提前写入
+CONFIG_FLUSH_INTERVAL = float(os.getenv("CONFIG_FLUSH_INTERVAL") or 0)
+CONFIG_FLUSH_THRESHOLD = int(os.getenv("CONFIG_FLUSH_THRESHOLD") or 1000)
 logger = utils.get_logger()
 
 logger.info("APP_ID                   >>>> %s", APP_ID)
@@ -33,11 +78,96 @@ logger.info("APP_SECRET               >>>> %s", APP_SECRET)
 logger.info("VERIFICATION_TOKEN       >>>> %s", VERIFICATION_TOKEN)
 logger.info("ENCRYPT_KEY              >>>> %s", ENCRYPT_KEY)
 logger.info("LARK_HOST                >>>> %s", LARK_HOST)
+logger.info("EXECUTOR_WORKERS         >>>> %s", EXECUTOR_WORKERS)
+
+executor = ThreadPoolExecutor(max_workers=EXECUTOR_WORKERS)
 
 # 初始化工具
-config_manger = ConfigManger()
-message_api_client = MessageApiClient(APP_ID, APP_SECRET, LARK_HOST)
-plugin_manager = PluginManager(message_api_client, config_manger)
+config_manger = ConfigManger(compact_bytes=CONFIG_COMPACT_BYTES,
+                             flush_interval=CONFIG_FLUSH_INTERVAL,
+                             flush_threshold=CONFIG_FLUSH_THRESHOLD)
+message_api_client = MessageApiClient(APP_ID, APP_SECRET, LARK_HOST,
+                                      pool_size=EXECUTOR_WORKERS,
+                                      connect_timeout=HTTP_CONNECT_TIMEOUT,
+                                      read_timeout=HTTP_READ_TIMEOUT,
+                                      max_retries=HTTP_MAX_RETRIES)
+async_message_api_client = None
+if AsyncMessageApiClient.available():
+    async_message_api_client = AsyncMessageApiClient(APP_ID, APP_SECRET, LARK_HOST,
+                                                     token_manager=message_api_client.token_manager,
+                                                     pool_size=ASYNC_MAX_CONCURRENCY,
+                                                     max_concurrency=ASYNC_MAX_CONCURRENCY,
+                                                     connect_timeout=HTTP_CONNECT_TIMEOUT,
+                                                     read_timeout=HTTP_READ_TIMEOUT)
+outbound_scheduler = OutboundScheduler(message_api_client,
+                                       workers=EXECUTOR_WORKERS,
+                                       endpoint_rate=OUTBOUND_ENDPOINT_RATE,
+                                       receiver_rate=OUTBOUND_RECEIVER_RATE)
+outbox = Outbox(message_api_client, OUTBOX_DB_PATH,
+                workers=OUTBOX_WORKERS,
+                max_attempts=OUTBOX_MAX_ATTEMPTS,
+                scheduler=outbound_scheduler)
+callback_decoder = CallbackDecoder(ENCRYPT_KEY, get_json_codec(JSON_CODEC))
+event_deduplicator = EventDeduplicator(EVENT_DEDUP_CAPACITY, EVENT_DEDUP_TTL,
+                                       SqliteDedupBackend(EVENT_DEDUP_DB_PATH, EVENT_DEDUP_TTL)
+                                       if EVENT_DEDUP_DB_PATH else None)
+plugin_manager = PluginManager(message_api_client, config_manger, async_message_api_client,
+                               outbound_scheduler, outbox,
+                               lazy_load=PLUGIN_LAZY_LOAD,
+                               manifest_path=PLUGIN_MANIFEST_PATH,
+                               init_workers=PLUGIN_INIT_WORKERS,
+                               init_timeout=PLUGIN_INIT_TIMEOUT,
+                               handler_timeout=PLUGIN_HANDLER_TIMEOUT,
+                               slow_call=PLUGIN_SLOW_CALL,
+                               breaker_threshold=PLUGIN_BREAKER_THRESHOLD,
+                               breaker_reset=PLUGIN_BREAKER_RESET,
+                               handler_workers=EXECUTOR_WORKERS,
+                               process_workers=PLUGIN_PROCESS_WORKERS)
+if PLUGIN_LAZY_LOAD and PLUGIN_WARM_UP:
+    plugin_manager.start_warm_up()
+if PLUGIN_RELOAD_INTERVAL > 0:
+    plugin_manager.start_watcher(PLUGIN_RELOAD_INTERVAL)
+# Flask入口的事件分发器，首次处理回调时创建，ASGI入口使用自己的分发器
+event_dispatcher = None
+_event_dispatcher_lock = threading.Lock()
+# 退出时先处理完通道中已接收的事件（分发器创建时注册），再关闭插件线程池，
+# 然后发送调度器中的消息（超时未发送的转入持久化队列），最后提交持久化队列并写入配置（atexit按注册的相反顺序执行）
+atexit.register(config_manger.close)
+atexit.register(USER_INFO_CACHE.close)
+atexit.register(outbox.close)
+atexit.register(functools.partial(outbound_scheduler.close, handoff=outbox.enqueue))
+atexit.register(plugin_manager.close)
+
+
+def create_event_dispatcher(handler) -> EventDispatcher:
+    """
+    按环境参数创建事件分发器，Flask与ASGI入口各自创建一个，两者不能同时存在（共用同一组溢出文件）；
+    开启回调延迟解析时才启动原始回调的解析线程
+    :param handler: 事件处理方法
+    """
+    deferred = {}
+    if CALLBACK_DEFERRED:
+        deferred = {"resolver": lambda payload: resolve_raw_callback(*payload), "on_reject": reject_raw_callback}
+    return EventDispatcher(handler,
+                           lanes=EVENT_LANES,
+                           capacity=EVENT_LANE_CAPACITY,
+                           overflow=EVENT_OVERFLOW,
+                           spill_dir=EVENT_SPILL_DIR,
+                           **deferred)
+
+
+def get_event_dispatcher() -> EventDispatcher:
+    """
+    获取Flask入口的事件分发器，不存在时创建，退出时关闭
+    """
+    global event_dispatcher
+    if event_dispatcher is None:
+        with _event_dispatcher_lock:
+            if event_dispatcher is None:
+                dispatcher = create_event_dispatcher(plugin_manager.with_event)
+                atexit.register(dispatcher.close)
+                event_dispatcher = dispatcher
+    return event_dispatcher
 
 
 def decrypt_data(encrypt_key, data):
@@ -47,11 +177,17 @@ def decrypt_data(encrypt_key, data):
         return data
     if encrypt_key == "":
         raise Exception("ENCRYPT_KEY is necessary")
-    cipher = AESCipher(encrypt_key)
+    cipher = _get_cipher(encrypt_key)
 
     return json.loads(cipher.decrypt_string(encrypt_data))
 
 
+@functools.lru_cache(maxsize=8)
+def _get_cipher(encrypt_key) -> AESCipher:
+    # 密钥派生只需要执行一次
+    return AESCipher(encrypt_key)
+
+
 @app.errorhandler
 def msg_error_handler(ex):
     logger.error(ex)
@@ -62,34 +198,116 @@ def msg_error_handler(ex):
     return response
 
 
-@app.errorhandler(404)
-def plugin_web_hook_handler(error):
-    web_req = plugin_manager.config_path(request)
-    if web_req:
+def handle_web_hook(req):
+    """
+    处理插件WEB接口请求，Flask与ASGI入口共用
+    :param req: 请求
+    :return: (HTTP状态码, 响应数据)
+    """
+    api_request, status_code = plugin_manager.route_api(req)
+    return respond_web_hook(api_request, status_code)
+
+
+def respond_web_hook(api_request, status_code: int):
+    """
+    执行路由匹配到的API插件
+    :param api_request: 见 PluginManager.route_api
+    :param status_code: 路由匹配结果
+    :return: (HTTP状态码, 响应数据)
+    """
+    if api_request is None:
+        return status_code, {"message": "Method Not Allowed" if status_code == ROUTE_METHOD_NOT_ALLOWED else "Not Found"}
+    if not api_request.plugin.PLUGIN_INFO.api_sync:
         # 异步执行处理
-        executor.submit(plugin_manager.with_api, web_req)
-        return jsonify({"code": 0, "msg": "success"})
-    raise NotFound()
+        executor.submit(plugin_manager.with_api, api_request)
+        return 200, {"code": 0, "msg": "success"}
+    # 同步响应，handler_api的返回值作为响应数据，也可以返回 (状态码, 数据)
+    try:
+        result = plugin_manager.with_api(api_request, raise_error=True)
+    except BaseException as ex:
+        return 500, {"message": str(ex)}
+    if result is None:
+        return 200, {"code": 0, "msg": "success"}
+    if isinstance(result, tuple) and len(result) == 2 and isinstance(result[0], int):
+        return result
+    return 200, result
 
 
-@app.route("/", methods=["POST"])
-def callback_event_handler():
-    logger.info("callback_event_handler")
-    dict_data = json.loads(request.data)
-    logger.info(dict_data)
-    dict_data = decrypt_data(ENCRYPT_KEY, dict_data)
+@app.route("/<path:path>", methods=list(HTTP_METHODS))
+def plugin_web_hook_handler(path):
+    status_code, data = handle_web_hook(request)
+    response = jsonify(data)
+    response.status_code = status_code
+    return response
+
+
+def handle_callback(data: bytes, headers, dispatcher: EventDispatcher = None):
+    """
+    处理飞书事件回调，Flask与ASGI入口共用
+    :param data:        原始请求体
+    :param headers:     请求头
+    :param dispatcher:  事件分发器，默认为Flask入口的事件分发器
+    :return: (HTTP状态码, 响应数据)
+    """
+    dispatcher = dispatcher or get_event_dispatcher()
+    if CALLBACK_DEFERRED and headers.get("X-Lark-Signature"):
+        # 事件回调均带有签名，直接应答后在后台线程中解析
+        if not dispatcher.submit_raw((data, Event.capture_headers(headers))):
+            logger.error("回调队列已满，请求未被处理")
+            return 503, {"code": 1, "msg": "busy"}
+        return 200, {"code": 0, "msg": "success"}
+    # 解密前先校验签名，签名错误的请求不再解密
+    verified = callback_decoder.verify_signature(data, headers)
+    dict_data = callback_decoder.decode(data)
     logger.info(dict_data)
     callback_type = dict_data.get("type")
     if callback_type == "url_verification":
         logger.info("================ url_verification")
         if dict_data.get("token") != VERIFICATION_TOKEN:
             raise Exception("VERIFICATION_TOKEN is invalid")
-        return jsonify({"challenge": dict_data.get("challenge")})
-    else:
-        event = Event(dict_data, VERIFICATION_TOKEN, ENCRYPT_KEY)
-        # 异步执行处理
-        executor.submit(plugin_manager.with_event, event)
-    return jsonify({"code": 0, "msg": "success"})
+        return 200, {"challenge": dict_data.get("challenge")}
+    event = Event(dict_data, VERIFICATION_TOKEN, ENCRYPT_KEY, headers=headers, body=data, verified=verified)
+    # 飞书在响应超时后会重推事件，重复的事件直接应答
+    if event_deduplicator.is_duplicate(event.header.event_id):
+        logger.info("重复事件【%s】已忽略" % event.header.event_id)
+        return 200, {"code": 0, "msg": "success"}
+    # 按会话分发到有序通道异步执行处理
+    if not dispatcher.submit(event):
+        # 队列已满，让飞书稍后重推
+        logger.error("事件队列已满，事件【%s】未被处理" % event.header.event_id)
+        event_deduplicator.forget(event.header.event_id)
+        return 503, {"code": 1, "msg": "busy"}
+    return 200, {"code": 0, "msg": "success"}
+
+
+def resolve_raw_callback(data: bytes, headers: dict):
+    """
+    在后台线程中解析延迟处理的回调
+    :param data:    原始请求体
+    :param headers: 签名相关的请求头，见 Event.capture_headers
+    :return: 事件，重复或无需处理的回调返回None
+    """
+    event = Event.from_raw(data, headers, VERIFICATION_TOKEN, ENCRYPT_KEY, callback_decoder)
+    if event_deduplicator.is_duplicate(event.header.event_id):
+        logger.info("重复事件【%s】已忽略" % event.header.event_id)
+        return None
+    return event
+
+
+def reject_raw_callback(event: Event):
+    """
+    延迟处理的回调未能进入事件通道时移除去重记录，飞书重推该事件时可以再次处理
+    """
+    event_deduplicator.forget(event.header.event_id)
+
+
+@app.route("/", methods=["POST"])
+def callback_event_handler():
+    logger.info("callback_event_handler")
+    status_code, data = handle_callback(request.data, request.headers)
+    response = jsonify(data)
+    response.status_code = status_code
+    return response
 
 
 if __name__ == "__main__":
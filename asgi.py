@@ -0,0 +1,109 @@
+"""
+ASGI启动入口，提供与app.py相同的事件回调与插件WEB接口
+启动方式：python3 -m uvicorn asgi:app --port=2020 --host=0.0.0.0
+"""
+import asyncio
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.datastructures import Headers
+from werkzeug.test import EnvironBuilder
+
+import app as flask_app
+
+logger = flask_app.logger
+plugin_manager = flask_app.plugin_manager
+
+
+class AsgiApp(object):
+    """
+    ASGI应用
+    回调的解密、校验与去重沿用app.handle_callback，事件处理通道中的事件交由当前事件循环执行，
+    异步插件(async def handler_event)直接await，同步插件在线程池中执行
+    """
+
+    def __init__(self, callback_workers: int = 4):
+        """
+        初始化ASGI应用
+        :param callback_workers: 回调解密与校验使用的线程数，与插件使用的线程池分开，避免应答被插件处理拖慢
+        """
+        self._loop = None
+        self._dispatcher = None
+        self._callback_executor = ThreadPoolExecutor(max_workers=callback_workers, thread_name_prefix="asgi-callback")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+            return
+        if scope["type"] != "http":
+            return
+        self._ensure_started()
+        body = await self._read_body(receive)
+        headers = Headers([(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope["headers"]])
+        try:
+            if scope["path"] == "/" and scope["method"] == "POST":
+                status_code, data = await self._loop.run_in_executor(
+                    self._callback_executor, flask_app.handle_callback, body, headers, self._dispatcher)
+            else:
+                status_code, data = await self._plugin_web_hook(scope, headers, body)
+        except BaseException as ex:
+            logger.error(ex)
+            status_code, data = 500, {"message": str(ex)}
+        await self._send_json(send, status_code, data)
+
+    def _ensure_started(self):
+        if self._dispatcher is None:
+            self._loop = asyncio.get_running_loop()
+            self._dispatcher = flask_app.create_event_dispatcher(self._handle_event)
+
+    def _handle_event(self, event):
+        # 在处理通道线程中等待事件处理完成，以保证同一会话的事件按顺序处理
+        asyncio.run_coroutine_threadsafe(plugin_manager.async_with_event(event), self._loop).result()
+
+    async def _plugin_web_hook(self, scope, headers, body):
+        req = EnvironBuilder(path=scope["path"],
+                             method=scope["method"],
+                             headers=headers,
+                             data=body,
+                             query_string=scope.get("query_string", b"").decode("latin-1")).get_request()
+        api_request, status_code = plugin_manager.route_api(req)
+        if api_request is not None and api_request.plugin.PLUGIN_INFO.api_sync:
+            # 同步响应的插件在线程池中执行，不阻塞事件循环
+            return await self._loop.run_in_executor(
+                self._callback_executor, flask_app.respond_web_hook, api_request, status_code)
+        return flask_app.respond_web_hook(api_request, status_code)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self._ensure_started()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self._dispatcher:
+                    await asyncio.get_running_loop().run_in_executor(None, self._dispatcher.close)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            chunks.append(message.get("body", b""))
+            if not message.get("more_body"):
+                return b"".join(chunks)
+
+    @staticmethod
+    async def _send_json(send, status_code, data):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        await send({
+            "type": "http.response.start",
+            "status": status_code,
+            "headers": [(b"content-type", b"application/json"),
+                        (b"content-length", str(len(body)).encode("latin-1"))]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+app = AsgiApp()
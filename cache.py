@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import utils
+
+logger = utils.get_logger()
+
+DEFAULT_CACHE_CAPACITY = 10000
+DEFAULT_CACHE_TTL = 3600
+# 过期后仍可返回旧值（同时在后台刷新）的时间
+DEFAULT_CACHE_STALE_TTL = 24 * 3600
+# 加载失败或不存在的结果的缓存时间
+DEFAULT_CACHE_NEGATIVE_TTL = 300
+
+
+class _Entry(object):
+    __slots__ = ("value", "fresh_until", "stale_until")
+
+    def __init__(self, value, fresh_until: float, stale_until: float):
+        self.value = value
+        self.fresh_until = fresh_until
+        self.stale_until = stale_until
+
+
+class LoadingCache(object):
+    """
+    自动加载的缓存
+    容量有限，超出时淘汰最久未使用的条目；同一个键同时只加载一次，并发读取的线程等待同一次加载的结果。
+    条目过期后的 stale_ttl 时间内仍返回旧值，同时在后台刷新；加载失败或结果为None时缓存None，
+    negative_ttl 时间内不再重试，后台刷新失败时继续使用旧值
+    """
+
+    def __init__(self, loader, capacity: int = DEFAULT_CACHE_CAPACITY, ttl: float = DEFAULT_CACHE_TTL,
+                 stale_ttl: float = DEFAULT_CACHE_STALE_TTL, negative_ttl: float = DEFAULT_CACHE_NEGATIVE_TTL,
+                 refresh_workers: int = 2, name: str = "cache", clock=time.monotonic):
+        """
+        初始化缓存
+        :param loader:          加载方法 loader(key)，返回None或抛出异常表示加载失败
+        :param capacity:        最大条目数
+        :param ttl:             条目有效时间(秒)
+        :param stale_ttl:       条目过期后仍可返回旧值的时间(秒)，0表示过期后同步加载
+        :param negative_ttl:    加载失败的缓存时间(秒)，0表示不缓存
+        :param refresh_workers: 后台刷新的线程数
+        :param name:            缓存名称，用于日志
+        :param clock:           计时方法，返回单调递增的秒数
+        """
+        self._loader = loader
+        self._capacity = capacity
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._negative_ttl = negative_ttl
+        self._name = name
+        self._clock = clock
+        self._lock = threading.Lock()
+        # 键 -> 条目，按最近使用的顺序排列
+        self._entries = OrderedDict()
+        # 正在加载的键 -> Future
+        self._loading = {}
+        self._refresher = ThreadPoolExecutor(max_workers=refresh_workers, thread_name_prefix=name + "-refresh")
+        # 统计信息
+        self.hit_count = 0
+        self.stale_hit_count = 0
+        self.negative_hit_count = 0
+        self.miss_count = 0
+        self.load_count = 0
+        self.load_failure_count = 0
+        self.refresh_count = 0
+        self.eviction_count = 0
+
+    def get(self, key):
+        """
+        获取缓存值，不存在或已过期时加载
+        :return: 缓存值，加载失败时返回None
+        """
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now < entry.stale_until:
+                self._entries.move_to_end(key)
+                if now < entry.fresh_until:
+                    if entry.value is None:
+                        self.negative_hit_count += 1
+                    else:
+                        self.hit_count += 1
+                    return entry.value
+                self.stale_hit_count += 1
+                if key in self._loading:
+                    return entry.value
+                future = self._loading[key] = Future()
+                self.refresh_count += 1
+            else:
+                self.miss_count += 1
+                entry = None
+                future = self._loading.get(key)
+                loading = future is not None
+                if not loading:
+                    future = self._loading[key] = Future()
+        if entry is None:
+            if not loading:
+                self._load(key, future)
+            # 其他线程正在加载时等待其结果
+            return future.result()
+        try:
+            self._refresher.submit(self._load, key, future, entry)
+        except RuntimeError:
+            # 已关闭时同步刷新
+            self._load(key, future, entry)
+        return entry.value
+
+    def _load(self, key, future: Future, stale: _Entry = None):
+        try:
+            value = self._loader(key)
+        except BaseException as e:
+            logger.warning("缓存【%s】加载【%s】失败: %s" % (self._name, key, e))
+            value = None
+        now = self._clock()
+        with self._lock:
+            self.load_count += 1
+            if value is None:
+                self.load_failure_count += 1
+            if value is None and stale is not None:
+                # 刷新失败时继续使用旧值，negative_ttl 后再重试
+                stale.fresh_until = min(now + self._negative_ttl, stale.stale_until)
+            elif value is not None:
+                self._store(key, _Entry(value, now + self._ttl, now + self._ttl + self._stale_ttl))
+            elif self._negative_ttl > 0:
+                self._store(key, _Entry(None, now + self._negative_ttl, now + self._negative_ttl))
+            else:
+                self._entries.pop(key, None)
+            self._loading.pop(key, None)
+        future.set_result(value if value is not None or stale is None else stale.value)
+
+    def _store(self, key, entry: _Entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._capacity:
+            self._entries.popitem(last=False)
+            self.eviction_count += 1
+
+    def invalidate(self, key):
+        """
+        删除缓存值，下次获取时重新加载
+        """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hit_count + self.stale_hit_count + self.negative_hit_count + self.miss_count
+            return {
+                "size": len(self._entries),
+                "hit_count": self.hit_count,
+                "stale_hit_count": self.stale_hit_count,
+                "negative_hit_count": self.negative_hit_count,
+                "miss_count": self.miss_count,
+                "load_count": self.load_count,
+                "load_failure_count": self.load_failure_count,
+                "refresh_count": self.refresh_count,
+                "eviction_count": self.eviction_count,
+                "hit_rate": (requests - self.miss_count) / requests if requests else 0.0
+            }
+
+    def close(self):
+        """
+        停止后台刷新，退出时调用
+        """
+        self._refresher.shutdown(wait=False)
+        logger.info("缓存【%s】统计: %s" % (self._name, self.stats()))
@@ -0,0 +1,401 @@
+import re
+import shlex
+import threading
+
+from enums import ReceiveType
+from models import RenderMessage
+
+COMMAND_PREFIX = "/"
+HELP_COMMAND = "/help"
+
+# 用法中的参数：<必填参数>、[可选参数]、[--选项]
+_USAGE_TOKEN = re.compile(r"<[^>]+>|\[[^\]]+\]|\S+")
+# 群聊中@机器人时消息文本中的占位符，如 @_user_1
+_MENTION = re.compile(r"@_user_\d+")
+_TYPES = {"str": str, "int": int, "float": float}
+
+
+class CommandError(Exception):
+    """
+    命令参数错误，message为提示信息，command为匹配到的命令
+    """
+
+    def __init__(self, message: str, command=None):
+        super().__init__(message)
+        self.command = command
+
+
+class _Param(object):
+    __slots__ = ("name", "type_name", "convert", "required", "rest")
+
+    def __init__(self, spec: str, required: bool):
+        """
+        解析参数声明：name、name:int、name:dev|prod、name...
+        """
+        self.required = required
+        self.rest = spec.endswith("...")
+        if self.rest:
+            spec = spec[:-3]
+        name, _, type_name = spec.partition(":")
+        self.name = name.strip()
+        self.type_name = type_name.strip() or "str"
+        if not self.name.isidentifier():
+            raise ValueError("invalid parameter name: %s" % spec)
+        if self.type_name in _TYPES:
+            self.convert = _TYPES[self.type_name]
+        elif "|" in self.type_name:
+            choices = tuple(c for c in self.type_name.split("|") if c)
+            self.convert = lambda value, _choices=choices: _choice(value, _choices)
+        else:
+            raise ValueError("unknown parameter type: %s" % self.type_name)
+
+    def parse(self, value: str, command):
+        try:
+            return self.convert(value)
+        except ValueError:
+            raise CommandError("参数【%s】应为 %s，实际为 %s" % (self.name, self.type_name, value), command) from None
+
+
+def _choice(value: str, choices: tuple) -> str:
+    if value not in choices:
+        raise ValueError(value)
+    return value
+
+
+class _Option(object):
+    __slots__ = ("name", "flags", "param")
+
+    def __init__(self, flags: list, param: _Param = None):
+        """
+        选项：不带值时为开关，如 --force；带值时如 --tag <name>
+        """
+        self.flags = flags
+        self.name = flags[-1].lstrip("-").replace("-", "_")
+        self.param = param
+
+
+class Command(object):
+    """
+    命令
+    由用法字符串声明，注册时解析为参数解析器，如 /deploy <env:dev|prod> [count:int] [--force] [--tag <name>]
+    """
+
+    def __init__(self, usage: str, handler, description: str = "", owner: str = None):
+        """
+        初始化命令
+        :param usage:       用法，开头的单词为命令路径（可以有多级，如 /topic add），其后为参数与选项：
+                            <name> 必填参数，[name] 可选参数，name... 剩余的全部参数，
+                            name:int / name:float / name:a|b 指定类型或可选值，
+                            [-f|--force] 开关选项，[--tag <name>] 带值的选项
+        :param handler:     处理方法 handler(receive_message, args: dict, tools)，返回字符串或RenderMessage时回复该消息
+        :param description: 命令说明，用于生成帮助
+        :param owner:       注册命令的插件模块名，插件重新加载后重新注册时覆盖原命令
+        """
+        self.usage = usage.strip()
+        self.handler = handler
+        self.description = description
+        self.owner = owner
+        self.path = []
+        self.params = []
+        self.options = {}
+        for token in _USAGE_TOKEN.findall(self.usage):
+            if token.startswith("<"):
+                self._add_param(_Param(token[1:-1], required=True))
+            elif token.startswith("["):
+                inner = token[1:-1].strip()
+                if inner.startswith("-"):
+                    self._add_option(inner)
+                else:
+                    self._add_param(_Param(inner, required=False))
+            elif self.params or self.options:
+                raise ValueError("literal word after parameters in usage: %s" % usage)
+            else:
+                self.path.append(token)
+        if not self.path or not self.path[0].startswith(COMMAND_PREFIX):
+            raise ValueError("usage must start with %s: %s" % (COMMAND_PREFIX, usage))
+        self.name = " ".join(self.path)
+
+    def _add_param(self, param: _Param):
+        if self.params and (self.params[-1].rest or (not self.params[-1].required and param.required)):
+            raise ValueError("parameter %s cannot follow optional or rest parameters: %s" % (param.name, self.usage))
+        self.params.append(param)
+
+    def _add_option(self, spec: str):
+        flags, _, value = spec.partition(" ")
+        value = value.strip()
+        param = None
+        if value:
+            param = _Param(value.strip("<>"), required=True)
+        option = _Option(flags.split("|"), param)
+        for flag in option.flags:
+            self.options[flag] = option
+
+    def parse(self, tokens: list) -> dict:
+        """
+        解析命令参数
+        :param tokens: 命令路径之后的单词
+        :return: 参数名 -> 参数值，未提供的可选参数为None，开关选项为True/False
+        :raise CommandError: 参数错误
+        """
+        args = {option.name: (None if option.param else False) for option in self.options.values()}
+        positional = []
+        index = 0
+        while index < len(tokens):
+            token = tokens[index]
+            index += 1
+            if token == "--":
+                positional.extend(tokens[index:])
+                break
+            if not token.startswith("-") or _is_number(token):
+                positional.append(token)
+                continue
+            flag, has_value, value = token.partition("=")
+            option = self.options.get(flag)
+            if option is None:
+                raise CommandError("未知选项【%s】" % flag, self)
+            if option.param is None:
+                if has_value:
+                    raise CommandError("选项【%s】不需要值" % flag, self)
+                args[option.name] = True
+                continue
+            if not has_value:
+                if index >= len(tokens):
+                    raise CommandError("选项【%s】缺少值" % flag, self)
+                value = tokens[index]
+                index += 1
+            args[option.name] = option.param.parse(value, self)
+        for i, param in enumerate(self.params):
+            if param.rest:
+                args[param.name] = [param.parse(v, self) for v in positional[i:]]
+                if param.required and not args[param.name]:
+                    raise CommandError("缺少参数【%s】" % param.name, self)
+                break
+            if i < len(positional):
+                args[param.name] = param.parse(positional[i], self)
+            elif param.required:
+                raise CommandError("缺少参数【%s】" % param.name, self)
+            else:
+                args[param.name] = None
+        else:
+            if len(positional) > len(self.params):
+                raise CommandError("多余的参数: %s" % " ".join(positional[len(self.params):]), self)
+        return args
+
+    def help(self) -> str:
+        return "%s  %s" % (self.usage, self.description) if self.description else self.usage
+
+
+def _is_number(token: str) -> bool:
+    try:
+        float(token)
+        return True
+    except ValueError:
+        return False
+
+
+class _TrieNode(object):
+    __slots__ = ("children", "command")
+
+    def __init__(self):
+        self.children = {}
+        self.command = None
+
+
+class CommandEngine(object):
+    """
+    命令引擎
+    命令按路径单词组成前缀树，每条消息只切分一次，沿前缀树逐词查找最长匹配的命令，
+    查找开销与命令数量无关；参数解析器在注册时构建，并自动生成 /help 帮助
+    """
+
+    def __init__(self):
+        self._root = _TrieNode()
+        self._commands = {}
+        self._lock = threading.Lock()
+        self.register(HELP_COMMAND + " [command...]", self._help, "查看命令帮助")
+
+    def register(self, usage: str, handler, description: str = "", aliases=(), owner: str = None) -> Command:
+        """
+        注册命令，参数见 Command
+        :param aliases: 命令别名，如 ["/d"]
+        :param owner:   注册命令的插件模块名，默认为处理方法所在的模块
+        :raise ValueError: 用法错误或与其他插件的命令冲突
+        """
+        command = Command(usage, handler, description, owner or getattr(handler, "__module__", None))
+        paths = [command.path] + [alias.split() for alias in aliases]
+        with self._lock:
+            for path in paths:
+                existing = self._find(path)
+                if existing is not None and existing.owner != command.owner:
+                    raise ValueError("command %s is already registered by %s" % (" ".join(path), existing.owner))
+            for path in paths:
+                node = self._root
+                for word in path:
+                    child = node.children.get(word)
+                    if child is None:
+                        child = node.children[word] = _TrieNode()
+                    node = child
+                node.command = command
+            self._commands = {**self._commands, command.name: command}
+        return command
+
+    def command(self, usage: str, description: str = "", aliases=()):
+        """
+        注册命令的装饰器
+        """
+
+        def decorator(handler):
+            self.register(usage, handler, description, aliases)
+            return handler
+
+        return decorator
+
+    def unregister(self, owner: str):
+        """
+        移除插件注册的全部命令
+        :param owner: 插件模块名
+        """
+        with self._lock:
+            self._remove(self._root, lambda c: c.owner == owner)
+            self._commands = {name: c for name, c in self._commands.items() if c.owner != owner}
+
+    def owned(self, owner: str) -> list:
+        """
+        获取插件注册的全部命令，用于重新加载插件时保留旧版本的命令
+        :param owner: 插件模块名
+        :return: [(命令路径, 命令), ...]，包括别名
+        """
+        result = []
+
+        def walk(node, path):
+            if node.command is not None and node.command.owner == owner:
+                result.append((path, node.command))
+            for word, child in node.children.items():
+                walk(child, path + (word,))
+
+        with self._lock:
+            walk(self._root, ())
+        return result
+
+    def restore(self, owner: str, entries: list):
+        """
+        将插件的命令恢复为 owned 的结果，如插件新版本初始化失败时恢复旧版本的命令
+        :param owner:   插件模块名
+        :param entries: owned 的返回值
+        """
+        with self._lock:
+            self._remove(self._root, lambda c: c.owner == owner)
+            commands = {name: c for name, c in self._commands.items() if c.owner != owner}
+            for path, command in entries:
+                node = self._root
+                for word in path:
+                    child = node.children.get(word)
+                    if child is None:
+                        child = node.children[word] = _TrieNode()
+                    node = child
+                node.command = command
+                commands[command.name] = command
+            self._commands = commands
+
+    def discard(self, entries: list):
+        """
+        移除 owned 的结果中没有被重新注册的命令，如插件新版本初始化成功后移除其不再注册的旧命令
+        :param entries: owned 的返回值
+        """
+        stale = {id(command) for path, command in entries}
+        with self._lock:
+            self._remove(self._root, lambda c: id(c) in stale)
+            self._commands = {name: c for name, c in self._commands.items() if id(c) not in stale}
+
+    def _remove(self, node: _TrieNode, predicate):
+        if node.command is not None and predicate(node.command):
+            node.command = None
+        for word in list(node.children):
+            child = node.children[word]
+            self._remove(child, predicate)
+            if child.command is None and not child.children:
+                del node.children[word]
+
+    def _find(self, path: list):
+        node = self._root
+        for word in path:
+            node = node.children.get(word)
+            if node is None:
+                return None
+        return node.command
+
+    def commands(self) -> list:
+        return sorted(self._commands.values(), key=lambda c: c.name)
+
+    def resolve(self, text: str):
+        """
+        查找并解析命令
+        :param text: 消息文本
+        :return: (命令, 参数)，不是命令时返回None
+        :raise CommandError: 参数错误
+        """
+        text = _MENTION.sub("", text).strip()
+        if not text.startswith(COMMAND_PREFIX):
+            return None
+        tokens = text.split()
+        if '"' in text or "'" in text:
+            # 只有带引号的参数才需要按shell规则切分
+            try:
+                tokens = shlex.split(text)
+            except ValueError:
+                pass
+        node = self._root
+        command, consumed = None, 0
+        for i, word in enumerate(tokens):
+            node = node.children.get(word)
+            if node is None:
+                break
+            if node.command is not None:
+                command, consumed = node.command, i + 1
+        if command is None:
+            raise CommandError("未知命令【%s】，发送 %s 查看全部命令" % (tokens[0], HELP_COMMAND))
+        return command, command.parse(tokens[consumed:])
+
+    def dispatch(self, receive_message, tools) -> bool:
+        """
+        执行消息中的命令，命令返回的字符串或RenderMessage将回复给该消息；
+        群聊中没有@机器人时不回复未知命令，以免响应发给其他机器人的命令
+        :param receive_message: 入站信息
+        :param tools:           插件工具
+        :return: 是否为命令
+        """
+        if not receive_message.is_text:
+            return False
+        try:
+            resolved = self.resolve(receive_message.text_content)
+            if resolved is None:
+                return False
+            command, args = resolved
+            result = command.handler(receive_message, args, tools)
+        except CommandError as e:
+            if e.command is None and receive_message.msg_type == ReceiveType.GROUP.value \
+                    and not receive_message.at_me():
+                return False
+            result = str(e)
+            if e.command is not None:
+                result += "\n用法: " + e.command.help()
+        if isinstance(result, str):
+            result = RenderMessage.text(result)
+        if isinstance(result, RenderMessage):
+            tools.api_client.reply_message(receive_message.msg_id, result)
+        return True
+
+    def help(self, name: str = None) -> str:
+        """
+        生成帮助信息
+        :param name: 命令名称，为空时列出全部命令
+        """
+        if name:
+            command = self._find(name.split()) or self._find((COMMAND_PREFIX + name).split())
+            if command is None:
+                return "未知命令【%s】" % name
+            return command.help()
+        return "\n".join(["可用命令："] + [command.help() for command in self.commands()])
+
+    def _help(self, receive_message, args: dict, tools) -> str:
+        return self.help(" ".join(args["command"]))
@@ -0,0 +1,290 @@
+import os
+import pickle
+import struct
+import threading
+import time
+import traceback
+import zlib
+from collections import deque
+
+import utils
+
+logger = utils.get_logger()
+
+# 队列满时的处理策略
+OVERFLOW_BLOCK = "block"
+OVERFLOW_SHED = "shed"
+OVERFLOW_SPILL = "spill"
+
+DEFAULT_LANE_CAPACITY = 1000
+DEFAULT_INTAKE_CAPACITY = 10000
+DEFAULT_BLOCK_TIMEOUT = 3.0
+
+_SPILL_HEADER = struct.Struct("!I")
+
+
+class _Lane(object):
+    """
+    有序处理通道，同一会话的事件始终进入同一通道并按到达顺序处理
+    """
+
+    def __init__(self, index: int, handler, capacity: int, overflow: str, block_timeout: float, spill_dir: str):
+        self.index = index
+        self._handler = handler
+        self._capacity = capacity
+        self._overflow = overflow
+        self._block_timeout = block_timeout
+        self._spill_path = os.path.join(spill_dir, "lane_%s.spill" % index) if spill_dir else None
+        self._spill_file = None
+        self._spill_read_pos = 0
+        self._spilled = 0
+        self._items = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        # 统计信息
+        self.processed_count = 0
+        self.shed_count = 0
+        self.spill_count = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self._thread = threading.Thread(target=self._run, name="event-lane-%s" % index, daemon=True)
+        self._thread.start()
+
+    def put(self, item) -> bool:
+        with self._cond:
+            if self._closed:
+                return False
+            # 已有事件溢出到磁盘时，后续事件也写入磁盘以保证顺序
+            if not self._spilled and len(self._items) < self._capacity:
+                self._items.append((time.time(), item))
+                self._cond.notify()
+                return True
+            if self._overflow == OVERFLOW_BLOCK:
+                if self._cond.wait_for(lambda: len(self._items) < self._capacity or self._closed,
+                                       self._block_timeout) and not self._closed:
+                    self._items.append((time.time(), item))
+                    self._cond.notify()
+                    return True
+            elif self._overflow == OVERFLOW_SPILL and self._spill_path:
+                try:
+                    self._spill((time.time(), item))
+                    self._cond.notify()
+                    return True
+                except BaseException as e:
+                    logger.error("事件通道【%s】写入溢出文件失败: %s" % (self.index, e))
+            self.shed_count += 1
+            return False
+
+    def depth(self) -> int:
+        return len(self._items) + self._spilled
+
+    def close(self, timeout: float = None):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    def _spill(self, entry):
+        if self._spill_file is None:
+            self._spill_file = open(self._spill_path, "w+b")
+            self._spill_read_pos = 0
+        data = pickle.dumps(entry, protocol=pickle.HIGHEST_PROTOCOL)
+        self._spill_file.seek(0, os.SEEK_END)
+        self._spill_file.write(_SPILL_HEADER.pack(len(data)) + data)
+        self._spilled += 1
+        self.spill_count += 1
+
+    def _unspill(self):
+        self._spill_file.flush()
+        self._spill_file.seek(self._spill_read_pos)
+        size, = _SPILL_HEADER.unpack(self._spill_file.read(_SPILL_HEADER.size))
+        entry = pickle.loads(self._spill_file.read(size))
+        self._spill_read_pos = self._spill_file.tell()
+        self._spilled -= 1
+        if not self._spilled:
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+            self._spill_read_pos = 0
+        return entry
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._items and not self._spilled:
+                    if self._closed:
+                        return
+                    self._cond.wait()
+                if self._items:
+                    enqueued_at, item = self._items.popleft()
+                    self._cond.notify_all()
+                else:
+                    try:
+                        enqueued_at, item = self._unspill()
+                    except BaseException as e:
+                        logger.error("事件通道【%s】读取溢出文件失败，已丢弃%s个事件: %s" % (self.index, self._spilled, e))
+                        self.shed_count += self._spilled
+                        self._spilled = 0
+                        continue
+            waited = time.time() - enqueued_at
+            try:
+                self._handler(item)
+            except BaseException as e:
+                logger.error("事件通道【%s】处理事件失败: %s" % (self.index, e))
+                traceback.print_exc()
+            with self._cond:
+                self.processed_count += 1
+                self.wait_total += waited
+                self.wait_max = max(self.wait_max, waited)
+
+
+class EventDispatcher(object):
+    """
+    事件分发器
+    按会话(chat_id/open_id)哈希到固定数量的有序通道，同一会话的事件按顺序处理；
+    每个通道的队列有容量上限，队列满时按策略阻塞、丢弃或溢出到磁盘
+    """
+
+    def __init__(self, handler, lanes: int = 8, capacity: int = DEFAULT_LANE_CAPACITY,
+                 overflow: str = OVERFLOW_BLOCK, block_timeout: float = DEFAULT_BLOCK_TIMEOUT,
+                 spill_dir: str = None, resolver=None, intake_capacity: int = DEFAULT_INTAKE_CAPACITY,
+                 on_reject=None):
+        """
+        初始化事件分发器
+        :param handler:         事件处理方法，如 PluginManager.with_event
+        :param lanes:           通道数量（处理线程数）
+        :param capacity:        每个通道的队列容量
+        :param overflow:        队列满时的处理策略：OVERFLOW_BLOCK / OVERFLOW_SHED / OVERFLOW_SPILL
+        :param block_timeout:   阻塞策略的最长等待时间(秒)，超时后丢弃
+        :param spill_dir:       溢出文件目录，溢出策略必须提供
+        :param resolver:        原始回调解析方法，将submit_raw提交的数据转换为事件，返回None时忽略
+        :param intake_capacity: 原始回调队列容量
+        :param on_reject:       解析后的事件未能进入通道时调用 on_reject(event)，如移除事件的去重记录使飞书重推时可以再次处理
+        """
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_SHED, OVERFLOW_SPILL):
+            raise ValueError("unknown overflow policy: %s" % overflow)
+        if overflow == OVERFLOW_SPILL:
+            if not spill_dir:
+                raise ValueError("spill_dir is necessary for overflow policy: %s" % overflow)
+            os.makedirs(spill_dir, exist_ok=True)
+        self._lanes = [_Lane(i, handler, capacity, overflow, block_timeout, spill_dir) for i in range(lanes)]
+        self._resolver = resolver
+        self._on_reject = on_reject
+        self._intake = deque()
+        self._intake_capacity = intake_capacity
+        self._intake_cond = threading.Condition()
+        self._intake_closed = False
+        self._intake_thread = None
+        # 统计信息
+        self.intake_count = 0
+        self.intake_shed_count = 0
+        self.intake_error_count = 0
+        if resolver:
+            self._intake_thread = threading.Thread(target=self._run_intake, name="event-intake", daemon=True)
+            self._intake_thread.start()
+
+    @staticmethod
+    def event_key(event) -> str:
+        """
+        获取事件的会话标识：消息事件取chat_id，其余事件取相关用户的open_id
+        """
+        body = event.event
+        message = getattr(body, "message", None)
+        if message is not None and getattr(message, "chat_id", None):
+            return message.chat_id
+        for attr in ("sender", "reader", "operator"):
+            user = getattr(body, attr, None)
+            if user is not None:
+                for id_attr in ("sender_id", "reader_id", "operator_id"):
+                    user_id = getattr(user, id_attr, None)
+                    if user_id is not None and getattr(user_id, "open_id", None):
+                        return user_id.open_id
+        return event.header.event_id or ""
+
+    def submit(self, event, key: str = None) -> bool:
+        """
+        提交事件
+        :param event:   事件
+        :param key:     会话标识，为空时通过event_key获取
+        :return: 是否成功入队，队列满且被丢弃时返回False
+        """
+        if key is None:
+            key = self.event_key(event)
+        lane = self._lanes[zlib.crc32(key.encode("utf-8")) % len(self._lanes)]
+        return lane.put(event)
+
+    def submit_raw(self, payload) -> bool:
+        """
+        提交原始回调数据，由单独的线程按到达顺序批量解析后再分发，使请求线程可以尽快应答
+        :param payload: 原始回调数据，由resolver解析
+        :return: 是否成功入队
+        """
+        with self._intake_cond:
+            if self._intake_closed or len(self._intake) >= self._intake_capacity:
+                self.intake_shed_count += 1
+                return False
+            self._intake.append(payload)
+            self._intake_cond.notify()
+            return True
+
+    def _run_intake(self):
+        while True:
+            with self._intake_cond:
+                while not self._intake:
+                    if self._intake_closed:
+                        return
+                    self._intake_cond.wait()
+                batch = list(self._intake)
+                self._intake.clear()
+            # 按顺序解析，保证同一会话的事件进入通道的顺序与到达顺序一致
+            for payload in batch:
+                try:
+                    event = self._resolver(payload)
+                except BaseException as e:
+                    self.intake_error_count += 1
+                    logger.error("解析回调数据失败: %s" % e)
+                    continue
+                self.intake_count += 1
+                if event is not None and not self.submit(event):
+                    logger.error("事件队列已满，事件【%s】未被处理" % event.header.event_id)
+                    if self._on_reject is not None:
+                        try:
+                            self._on_reject(event)
+                        except BaseException as e:
+                            logger.error("处理未入队的事件失败: %s" % e)
+
+    def intake_stats(self) -> dict:
+        with self._intake_cond:
+            return {
+                "depth": len(self._intake),
+                "intake_count": self.intake_count,
+                "shed_count": self.intake_shed_count,
+                "error_count": self.intake_error_count
+            }
+
+    def stats(self) -> list:
+        result = []
+        for lane in self._lanes:
+            processed = lane.processed_count
+            result.append({
+                "lane": lane.index,
+                "depth": lane.depth(),
+                "processed_count": processed,
+                "shed_count": lane.shed_count,
+                "spill_count": lane.spill_count,
+                "wait_avg": lane.wait_total / processed if processed else 0.0,
+                "wait_max": lane.wait_max
+            })
+        return result
+
+    def close(self, timeout: float = 10):
+        """
+        停止接收事件，等待通道中已有的事件处理完成
+        """
+        deadline = time.time() + timeout
+        if self._intake_thread:
+            with self._intake_cond:
+                self._intake_closed = True
+                self._intake_cond.notify_all()
+            self._intake_thread.join(timeout)
+        for lane in self._lanes:
+            lane.close(max(0.0, deadline - time.time()))
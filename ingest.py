@@ -0,0 +1,241 @@
+import base64
+import hashlib
+import hmac
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import utils
+from models import InvalidEventException
+from utils import AESCipher
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = utils.get_logger()
+
+JSON_CODEC_AUTO = "auto"
+JSON_CODEC_STD = "json"
+JSON_CODEC_ORJSON = "orjson"
+
+DEFAULT_DEDUP_CAPACITY = 10000
+# 飞书在回调失败后会在数小时内多次重推，去重时间窗口需要覆盖重推周期
+DEFAULT_DEDUP_TTL = 6 * 3600
+
+
+class SqliteDedupBackend(object):
+    """
+    基于SQLite的共享去重存储，多个工作进程指向同一个数据库文件即可互相去重
+    """
+
+    def __init__(self, db_path: str, ttl: int = DEFAULT_DEDUP_TTL):
+        """
+        初始化共享去重存储
+        :param db_path: 数据库文件路径
+        :param ttl:     去重记录保留时间(秒)
+        """
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS seen_event (event_id TEXT PRIMARY KEY, seen_at REAL NOT NULL)")
+
+    def add(self, event_id: str, now: float) -> bool:
+        """
+        记录事件
+        :return: 事件是否为首次出现
+        """
+        with self._lock:
+            if now - self._last_purge > 60:
+                self._conn.execute("DELETE FROM seen_event WHERE seen_at < ?", (now - self._ttl,))
+                self._last_purge = now
+            cursor = self._conn.execute("INSERT OR IGNORE INTO seen_event (event_id, seen_at) VALUES (?, ?)",
+                                        (event_id, now))
+            if cursor.rowcount:
+                return True
+            # 记录已过期但尚未清理时视为首次出现
+            cursor = self._conn.execute("UPDATE seen_event SET seen_at = ? WHERE event_id = ? AND seen_at < ?",
+                                        (now, event_id, now - self._ttl))
+            return cursor.rowcount > 0
+
+    def remove(self, event_id: str):
+        with self._lock:
+            self._conn.execute("DELETE FROM seen_event WHERE event_id = ?", (event_id,))
+
+
+class EventDeduplicator(object):
+    """
+    事件去重
+    按 header.event_id 去重，本地使用按条数限制大小的TTL缓存，可选共享存储供多个进程互相去重
+    """
+
+    def __init__(self, capacity: int = DEFAULT_DEDUP_CAPACITY, ttl: int = DEFAULT_DEDUP_TTL,
+                 backend: SqliteDedupBackend = None):
+        """
+        初始化事件去重
+        :param capacity:    本地缓存最大条数，超出时淘汰最早的记录
+        :param ttl:         去重时间窗口(秒)
+        :param backend:     共享去重存储，为空时仅在本进程内去重
+        """
+        self._capacity = capacity
+        self._ttl = ttl
+        self._backend = backend
+        self._lock = threading.Lock()
+        # event_id -> 首次出现时间，按插入顺序即时间顺序排列
+        self._seen = OrderedDict()
+        # 统计信息
+        self.hit_count = 0
+        self.miss_count = 0
+        self.backend_hit_count = 0
+
+    def is_duplicate(self, event_id: str) -> bool:
+        """
+        判断事件是否重复，首次出现的事件会被记录
+        :param event_id: 事件ID
+        :return:
+        """
+        if not event_id:
+            return False
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            if event_id in self._seen:
+                self.hit_count += 1
+                return True
+            self._seen[event_id] = now
+            if len(self._seen) > self._capacity:
+                self._seen.popitem(last=False)
+        if self._backend:
+            try:
+                if not self._backend.add(event_id, now):
+                    with self._lock:
+                        self.backend_hit_count += 1
+                    return True
+            except BaseException as e:
+                # 共享存储不可用时退化为本地去重
+                logger.error("事件去重共享存储不可用: %s" % e)
+        with self._lock:
+            self.miss_count += 1
+        return False
+
+    def forget(self, event_id: str):
+        """
+        移除事件记录，事件未能处理而需要飞书重推时调用
+        :param event_id: 事件ID
+        :return:
+        """
+        with self._lock:
+            self._seen.pop(event_id, None)
+        if self._backend:
+            try:
+                self._backend.remove(event_id)
+            except BaseException as e:
+                logger.error("事件去重共享存储不可用: %s" % e)
+
+    def _expire(self, now: float):
+        seen = self._seen
+        deadline = now - self._ttl
+        while seen:
+            event_id, seen_at = next(iter(seen.items()))
+            if seen_at >= deadline:
+                break
+            seen.popitem(last=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._seen),
+                "hit_count": self.hit_count,
+                "miss_count": self.miss_count,
+                "backend_hit_count": self.backend_hit_count
+            }
+
+
+class _StdJsonCodec(object):
+    name = JSON_CODEC_STD
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class _OrjsonCodec(object):
+    name = JSON_CODEC_ORJSON
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+def get_json_codec(name: str = JSON_CODEC_AUTO):
+    """
+    获取JSON解析器
+    :param name: JSON_CODEC_AUTO / JSON_CODEC_STD / JSON_CODEC_ORJSON，auto时已安装orjson则使用orjson
+    :return:
+    """
+    if name == JSON_CODEC_ORJSON or (name == JSON_CODEC_AUTO and orjson is not None):
+        if orjson is None:
+            raise ImportError("JSON_CODEC=orjson 需要安装 orjson")
+        return _OrjsonCodec
+    return _StdJsonCodec
+
+
+class CallbackDecoder(object):
+    """
+    回调解码器
+    AES密钥与解密上下文只初始化一次；签名直接对原始请求体增量计算，在解密前完成校验；
+    外层与内层JSON各解析一次
+    """
+
+    def __init__(self, encrypt_key: str, json_codec=None):
+        """
+        初始化回调解码器
+        :param encrypt_key: ENCRYPT_KEY，为空时不解密
+        :param json_codec:  JSON解析器，见 get_json_codec
+        """
+        self._encrypt_key = (encrypt_key or "").encode("utf-8")
+        self._cipher = AESCipher(encrypt_key) if encrypt_key else None
+        self._json = json_codec or get_json_codec()
+
+    def verify_signature(self, body: bytes, headers) -> bool:
+        """
+        校验请求签名
+        :param body:    原始请求体
+        :param headers: 请求头
+        :return: 请求头中没有签名时返回False
+        :raise InvalidEventException: 签名不正确
+        """
+        timestamp = headers.get("X-Lark-Request-Timestamp")
+        nonce = headers.get("X-Lark-Request-Nonce")
+        signature = headers.get("X-Lark-Signature")
+        if timestamp is None or nonce is None or signature is None:
+            return False
+        h = hashlib.sha256((timestamp + nonce).encode("utf-8"))
+        h.update(self._encrypt_key)
+        h.update(body)
+        if not hmac.compare_digest(h.hexdigest(), signature):
+            raise InvalidEventException("invalid signature in event")
+        return True
+
+    def decode(self, body: bytes) -> dict:
+        """
+        解析并解密回调数据
+        :param body: 原始请求体
+        :return: 解密后的回调数据
+        """
+        data = self._json.loads(body)
+        encrypt_data = data.get("encrypt")
+        if encrypt_data is None:
+            if self._cipher is None:
+                # data haven't been encrypted
+                return data
+            raise InvalidEventException("request is not encrypted")
+        if self._cipher is None:
+            raise Exception("ENCRYPT_KEY is necessary")
+        return self._json.loads(self._cipher.decrypt(base64.b64decode(encrypt_data)))
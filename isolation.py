@@ -0,0 +1,226 @@
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+
+import utils
+
+logger = utils.get_logger()
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30.0
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+
+
+class PluginTimeoutError(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    熔断器
+    连续失败（异常、超时或执行过慢）达到阈值后熔断，熔断期间跳过调用；
+    熔断时间结束后放行一次试探调用，成功则恢复，失败则继续熔断
+    """
+
+    def __init__(self, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 reset_timeout: float = DEFAULT_RESET_TIMEOUT):
+        """
+        初始化熔断器
+        :param failure_threshold:   连续失败多少次后熔断，0表示不熔断
+        :param reset_timeout:       熔断持续时间(秒)
+        """
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._open_until = 0.0
+        self._trial = False
+        self.state = BREAKER_CLOSED
+
+    def allow(self) -> bool:
+        if self.state == BREAKER_CLOSED:
+            return True
+        with self._lock:
+            if self.state == BREAKER_OPEN and time.monotonic() >= self._open_until:
+                self.state = BREAKER_HALF_OPEN
+                self._trial = False
+            if self.state == BREAKER_HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            return self.state == BREAKER_CLOSED
+
+    def record(self, success: bool) -> bool:
+        """
+        记录调用结果
+        :return: 本次调用是否导致熔断
+        """
+        if success and self.state == BREAKER_CLOSED and not self._failures:
+            return False
+        with self._lock:
+            if success:
+                self._failures = 0
+                self.state = BREAKER_CLOSED
+                return False
+            self._failures += 1
+            if self.state == BREAKER_HALF_OPEN or \
+                    (self._failure_threshold and self._failures >= self._failure_threshold):
+                self.state = BREAKER_OPEN
+                self._open_until = time.monotonic() + self._reset_timeout
+                return True
+            return False
+
+
+class PluginRunner(object):
+    """
+    插件执行器
+    为单个插件提供执行超时、熔断与进程池执行，状态随插件信息保留，插件重新加载后重置
+    """
+
+    def __init__(self, name: str, breaker: CircuitBreaker, timeout: float = None, slow_call: float = None,
+                 process_pool=None, module_name: str = None, module_path: str = None):
+        """
+        初始化插件执行器
+        :param name:        插件名称
+        :param breaker:     熔断器
+        :param timeout:     执行超时时间(秒)，为空时不限制
+        :param slow_call:   执行时间超过该值(秒)时视为失败，为空时不判断
+        :param process_pool: 返回 ProcessPoolExecutor 的方法，为空时在本进程中执行
+        :param module_name: 插件模块名，进程池执行时使用
+        :param module_path: 插件文件路径，进程池执行时使用
+        """
+        self.name = name
+        self.breaker = breaker
+        self.timeout = timeout or None
+        self.slow_call = slow_call or None
+        self._process_pool = process_pool
+        self._module_name = module_name
+        self._module_path = module_path
+        # 统计信息
+        self.call_count = 0
+        self.failure_count = 0
+        self.timeout_count = 0
+        self.skip_count = 0
+
+    @property
+    def in_process_pool(self) -> bool:
+        return self._process_pool is not None
+
+    def allow(self) -> bool:
+        if self.breaker.allow():
+            return True
+        self.skip_count += 1
+        return False
+
+    def call(self, handler, is_coroutine: bool, event, tools, thread_pool: ThreadPoolExecutor):
+        """
+        在当前线程中执行插件，设置了超时时间时在线程池中执行并等待
+        """
+        started_at = time.monotonic()
+        try:
+            if self._process_pool is not None:
+                future = self._process_pool().submit(run_in_process, self._module_name, self._module_path,
+                                                     event.snapshot())
+                result = future.result(self.timeout)
+            elif is_coroutine:
+                coroutine = handler(event, tools)
+                result = asyncio.run(asyncio.wait_for(coroutine, self.timeout) if self.timeout else coroutine)
+            elif self.timeout:
+                result = thread_pool.submit(handler, event, tools).result(self.timeout)
+            else:
+                result = handler(event, tools)
+        except (FutureTimeoutError, asyncio.TimeoutError):
+            self._finish(started_at, timed_out=True)
+            raise PluginTimeoutError("插件【%s】执行超时(%s秒)" % (self.name, self.timeout)) from None
+        except BaseException:
+            self._finish(started_at, failed=True)
+            raise
+        self._finish(started_at)
+        return result
+
+    async def call_async(self, handler, is_coroutine: bool, event, tools, loop):
+        """
+        在事件循环中执行插件：异步插件直接await，同步插件放入线程池执行
+        """
+        started_at = time.monotonic()
+        try:
+            if self._process_pool is not None:
+                awaitable = asyncio.wrap_future(self._process_pool().submit(
+                    run_in_process, self._module_name, self._module_path, event.snapshot()))
+            elif is_coroutine:
+                awaitable = handler(event, tools)
+            else:
+                awaitable = loop.run_in_executor(None, handler, event, tools)
+            result = await (asyncio.wait_for(awaitable, self.timeout) if self.timeout else awaitable)
+        except asyncio.TimeoutError:
+            self._finish(started_at, timed_out=True)
+            raise PluginTimeoutError("插件【%s】执行超时(%s秒)" % (self.name, self.timeout)) from None
+        except BaseException:
+            self._finish(started_at, failed=True)
+            raise
+        self._finish(started_at)
+        return result
+
+    def _finish(self, started_at: float, failed: bool = False, timed_out: bool = False):
+        elapsed = time.monotonic() - started_at
+        self.call_count += 1
+        if timed_out:
+            self.timeout_count += 1
+        if failed:
+            self.failure_count += 1
+        slow = self.slow_call is not None and elapsed > self.slow_call
+        if self.breaker.record(not (failed or timed_out or slow)):
+            logger.warning("插件【%s】连续失败、超时或执行过慢，已熔断，暂停调用" % self.name)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "state": self.breaker.state,
+            "process_pool": self.in_process_pool,
+            "call_count": self.call_count,
+            "failure_count": self.failure_count,
+            "timeout_count": self.timeout_count,
+            "skip_count": self.skip_count
+        }
+
+
+def create_process_pool(workers: int = None) -> ProcessPoolExecutor:
+    """
+    创建插件进程池，使用spawn方式启动，避免fork时复制其他线程持有的锁
+    """
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+# 子进程中已导入的插件：模块名 -> (文件修改时间, 模块)
+_PROCESS_MODULES = {}
+
+
+def run_in_process(module_name: str, module_path: str, snapshot: dict):
+    """
+    在子进程中执行插件
+    子进程中不调用插件的init，handler_event的tools参数为None；插件文件修改后重新导入
+    :param module_name: 插件模块名
+    :param module_path: 插件文件路径
+    :param snapshot:    事件快照，见 ReceiveMessage.snapshot
+    :return: handler_event的返回值，需要可以序列化
+    """
+    from models import restore_snapshot
+    mtime = os.stat(module_path).st_mtime_ns
+    cached = _PROCESS_MODULES.get(module_name)
+    if cached is None or cached[0] != mtime:
+        spec = importlib.util.spec_from_file_location(module_name, module_path)
+        mod = importlib.util.module_from_spec(spec)
+        sys.modules[module_name] = mod
+        spec.loader.exec_module(mod)
+        cached = _PROCESS_MODULES[module_name] = (mtime, mod)
+    result = cached[1].handler_event(restore_snapshot(snapshot), None)
+    if asyncio.iscoroutine(result):
+        result = asyncio.run(result)
+    return result
@@ -1,21 +1,49 @@
-import functools
-import json
+import asyncio
+import importlib.util
+import inspect
+import queue
+import sys
+import threading
 import utils
 import os
 import time
 import traceback
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
 
-from dotenv import find_dotenv, load_dotenv
 from flask import request
 
-from api import MessageApiClient
+from api import MessageApiClient, AsyncMessageApiClient
 from enums import LarkEvent, PluginType
-from models import Event, ReceiveMessage, ApiRequest
-
-load_dotenv(find_dotenv())
+from isolation import CircuitBreaker, PluginRunner, create_process_pool, DEFAULT_FAILURE_THRESHOLD, \
+    DEFAULT_RESET_TIMEOUT
+from manifest import PluginManifest
+from matcher import KeywordAutomaton, MessageFilter
+from models import Event, ReceiveMessage, ApiRequest, RenderMessage
+from outbox import Outbox
+from router import Router, ROUTE_FOUND
+from scheduler import OutboundScheduler
+from store import JournalStore, REMOVED, DEFAULT_COMPACT_BYTES, DEFAULT_FLUSH_THRESHOLD, freeze, thaw
 
 logger = utils.get_logger()
 
+_EVENT_TYPES = tuple(item.value for item in LarkEvent)
+
+DEFAULT_INIT_WORKERS = 8
+DEFAULT_HANDLER_WORKERS = 32
+DEFAULT_INIT_TIMEOUT = 30.0
+# 插件初始化结果
+_INIT_OK = "成功"
+_INIT_FAILED = "初始化失败"
+_INIT_TIMEOUT = "初始化超时"
+_INIT_DEPENDENCY_FAILED = "依赖不可用"
+
+# 需要包装后再交给插件处理的事件
+_EVENT_WRAPPERS = {
+    LarkEvent.IM_MESSAGE_RECEIVE.value: ReceiveMessage
+}
+
 
 class PluginInfo(object):
     """
@@ -28,20 +56,54 @@ class PluginInfo(object):
                  plugin_type: PluginType = PluginType.EVENT,
                  plugin_event: LarkEvent = None,
                  api_path: str = None,
-                 weight=0):
+                 weight=0,
+                 keywords=None,
+                 regex=None,
+                 at_me: bool = False,
+                 chat_type=None,
+                 sender_type=None,
+                 group_ids=None,
+                 depends=None,
+                 init_timeout: float = None,
+                 timeout: float = None,
+                 process_pool: bool = False,
+                 api_methods=None,
+                 api_sync: bool = False):
         """
         初始化插件信息
+        以下过滤条件仅针对接收消息事件(IM_MESSAGE_RECEIVE)，全部满足时才调用插件，不设置则接收所有消息
         :param plugin_name: 插件名称，建议控制在18个字符以内
         :param plugin_type: 插件类型，详见 PluginType
         :param plugin_event: 注册事件
-        :param api_path: API路径，建议控制在30个字符以内
+        :param api_path: API路径，建议控制在30个字符以内，支持路径参数，如 /hook/{name}，参数见 ApiRequest.path_params
         :param weight: 插件权重，仅针对事件型插件，权重越大越先调用
+        :param keywords: 关键词或关键词列表，文本消息包含任意一个即命中（不区分大小写）
+        :param regex: 正则表达式或列表，与关键词任意一个命中即可
+        :param at_me: 是否必须@机器人
+        :param chat_type: 会话类型或列表，如 p2p / group
+        :param sender_type: 发送者类型或列表，如 user / app
+        :param group_ids: 允许的会话ID(chat_id)列表
+        :param depends: 依赖的插件名称列表，依赖的插件初始化成功后才会初始化本插件，如依赖 tools.topic_manager 时填写 ["Topic管理"]
+        :param init_timeout: 初始化超时时间(秒)，超时后插件被禁用，默认使用插件管理器的设置
+        :param timeout: 事件处理超时时间(秒)，超时视为失败，默认使用插件管理器的设置
+        :param process_pool: 是否在进程池中执行事件处理，适用于CPU密集型插件；
+                             子进程中不会调用init，handler_event收到的是消息快照，tools为None，返回RenderMessage时由主进程回复
+        :param api_methods: API允许的请求方法列表，如 ["POST"]，为空时接受任意方法
+        :param api_sync: API是否同步响应：为True时等待handler_api执行完成，并将返回值作为响应数据，
+                         返回 (状态码, 数据) 时同时指定状态码；默认异步执行并立即响应
         """
         self.name = plugin_name
         self.event_type = plugin_event
         self.type = plugin_type
         self.weight = weight
         self.api_path = api_path
+        self.message_filter = MessageFilter(keywords, regex, at_me, chat_type, sender_type, group_ids)
+        self.depends = tuple([depends] if isinstance(depends, str) else depends or ())
+        self.init_timeout = init_timeout
+        self.timeout = timeout
+        self.process_pool = process_pool
+        self.api_methods = tuple(m.upper() for m in api_methods) if api_methods else None
+        self.api_sync = api_sync
 
     def set_members(self, members):
         """
@@ -55,35 +117,340 @@ class PluginInfo(object):
 class ConfigManger(object):
     """
     配置管理器
+    配置全部保存在内存中，修改时只向日志追加该键的记录，见 JournalStore；
+    设置了刷新间隔时延迟写入：修改只标记该键，由后台线程定时将期间的全部修改合并为一次写入。
+    配置是不可变的快照（dict为MappingProxyType，list为tuple），修改时复制并替换快照，读取时无需加锁；
+    需要基于原值修改时使用 update，同一个键的修改按顺序执行。嵌套的配置可以通过 subtree 逐项修改
     注意！体积较大的数据建议自行创建文件进行管理！不要将比较大的数据写入配置中！
     """
     file_save_path = os.getenv("CONFIG_FILE_PATH")
-    config = {}
+    config = MappingProxyType({})
 
-    def __init__(self):
+    def __init__(self, file_save_path: str = None, compact_bytes: int = DEFAULT_COMPACT_BYTES,
+                 flush_interval: float = 0, flush_threshold: int = DEFAULT_FLUSH_THRESHOLD):
+        """
+        初始化配置管理器
+        :param file_save_path:  配置文件路径，默认为环境变量 CONFIG_FILE_PATH
+        :param compact_bytes:   配置日志超过该大小(字节)时压缩到配置文件
+        :param flush_interval:  延迟写入的刷新间隔(秒)，0表示每次修改立即写入
+        :param flush_threshold: 延迟写入时，待写入的键数达到该值后提前写入
+        """
         logger.info("===========ConfigManger INIT===========")
+        if file_save_path:
+            self.file_save_path = file_save_path
+        self._flush_interval = flush_interval
+        self._flush_threshold = max(1, flush_threshold)
+        # 替换快照时使用
+        self._lock = threading.Lock()
+        # 每个键的修改锁
+        self._key_locks = {}
+        # 保证写入按修改顺序进行
+        self._flush_lock = threading.Lock()
+        # 待写入的修改：键 -> None(整个键) 或 {子键, ...}
+        self._dirty = {}
+        self._pending = 0
+        self._save_requested = False
+        self._closed = False
+        # 统计信息：请求写入次数、实际写入次数、写入的记录数与压缩次数
+        self.write_requests = 0
+        self.write_count = 0
+        self.record_count = 0
+        self.compact_count = 0
+        self._store = JournalStore(self.file_save_path, compact_bytes=compact_bytes)
         self._load()
+        self._flush_event = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_loop, name="config-flusher", daemon=True)
+            self._flusher.start()
 
     def _load(self):
         logger.info("self.file_save_path >>> %s" % self.file_save_path)
-        with open(self.file_save_path, 'r') as r:
-            self.config = json.loads(r.read() or "{}")
+        self.config = MappingProxyType({key: freeze(value) for key, value in self._store.load().items()})
 
     def save(self):
-        with open(self.file_save_path, 'w') as w:
-            w.write(json.dumps(self.config, ensure_ascii=False, indent=2))
-        self._load()
+        """
+        将全部配置写入配置文件
+        """
+        with self._lock:
+            self._save_requested = True
+            self.write_requests += 1
+        self._written()
 
     def get(self, key: str, default=None):
+        """
+        获取配置值，dict与list以不可变的MappingProxyType与tuple返回，不能直接修改，
+        序列化时使用 json.dumps(value, default=store.json_default)，需要修改时使用 get_mutable 或 update
+        """
         return self.config.get(key, default)
 
+    def get_mutable(self, key: str, default=None):
+        """
+        获取配置值的可修改副本（dict与list），修改副本不会影响配置，修改后通过 put(key, value) 保存
+        """
+        return thaw(self.config.get(key, default))
+
+    def snapshot(self) -> MappingProxyType:
+        """
+        获取当前全部配置的不可变快照
+        """
+        return self.config
+
     def put(self, key: str, value):
-        self.config[key] = value
-        self.save()
+        value = freeze(value)
+        with self.key_lock(key):
+            self._replace(key, value)
 
     def remove(self, key: str):
-        del self.config[key]
-        self.save()
+        with self.key_lock(key):
+            if key not in self.config:
+                raise KeyError(key)
+            self._replace(key, REMOVED)
+
+    def update(self, key: str, func, default=None):
+        """
+        基于原值修改配置
+        :param func:    func(原值) -> 新值，原值为不可变对象
+        :param default: 配置不存在时传入func的值
+        :return: 新值
+        """
+        with self.key_lock(key):
+            value = freeze(func(self.config.get(key, default)))
+            self._replace(key, value)
+        return value
+
+    def subtree(self, key: str):
+        """
+        获取嵌套配置的操作对象，如 subtree("topic_data")，修改其中一项时只复制该层并只写入该项
+        """
+        return ConfigSubtree(self, key)
+
+    def key_lock(self, key: str) -> threading.Lock:
+        lock = self._key_locks.get(key)
+        if lock is None:
+            with self._lock:
+                lock = self._key_locks.setdefault(key, threading.Lock())
+        return lock
+
+    def _replace(self, key: str, value, sub_paths: list = None):
+        """
+        替换快照中的一个键，调用方需持有该键的修改锁
+        :param value:       新值，为REMOVED时删除
+        :param sub_paths:   只修改了 value 中的部分项时提供，如 [("news", "ou_xxx")]，用于只写入这些项
+        """
+        with self._lock:
+            config = self.config.copy()
+            if value is REMOVED:
+                config.pop(key, None)
+            else:
+                config[key] = value
+            self.config = MappingProxyType(config)
+            if sub_paths is None:
+                self._dirty[key] = None
+            elif key not in self._dirty:
+                self._dirty[key] = set(sub_paths)
+            elif self._dirty[key] is not None:
+                self._dirty[key].update(sub_paths)
+            self._pending += len(sub_paths) if sub_paths else 1
+            self.write_requests += 1
+        self._written()
+
+    def _written(self):
+        if self._flusher is None or self._closed:
+            self.flush()
+        elif self._pending >= self._flush_threshold:
+            self._flush_event.set()
+
+    def flush(self):
+        """
+        立即写入全部待写入的修改
+        """
+        with self._flush_lock:
+            with self._lock:
+                if not (self._dirty or self._save_requested):
+                    return
+                config, dirty, compact = self.config, self._dirty, self._save_requested
+                self._dirty = {}
+                self._pending = 0
+                self._save_requested = False
+            # 快照不可变，序列化时无需持有锁
+            requested, journaled = compact, False
+            try:
+                if not compact:
+                    lines = []
+                    for key, sub_paths in dirty.items():
+                        value = config.get(key, REMOVED)
+                        if sub_paths is None or value is REMOVED:
+                            lines.append(self._store.encode(key, value))
+                            continue
+                        # 父级已写入时不再写入其中的项
+                        written = set()
+                        for path in sorted(sub_paths, key=len):
+                            if any(path[:i] in written for i in range(1, len(path))):
+                                continue
+                            written.add(path)
+                            lines.append(self._store.encode(key, _lookup(value, path), path))
+                    self._store.append(lines)
+                    journaled = True
+                    self.record_count += len(lines)
+                    if self._store.needs_compaction():
+                        config = self.config
+                        compact = True
+                if compact:
+                    self._store.write_snapshot(self._store.encode_snapshot(config))
+                    self.compact_count += 1
+            except BaseException:
+                if not journaled:
+                    # 写入失败时保留待写入的修改，下次写入时重试
+                    self._restore(dirty, requested)
+                raise
+            self.write_count += 1
+
+    def _restore(self, dirty: dict, save_requested: bool):
+        with self._lock:
+            for key, sub_paths in dirty.items():
+                if key not in self._dirty:
+                    self._dirty[key] = sub_paths
+                elif sub_paths is None or self._dirty[key] is None:
+                    self._dirty[key] = None
+                else:
+                    self._dirty[key].update(sub_paths)
+                self._pending += len(sub_paths) if sub_paths else 1
+            self._save_requested = self._save_requested or save_requested
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._flush_event.wait(self._flush_interval)
+            self._flush_event.clear()
+            try:
+                self.flush()
+            except BaseException as e:
+                logger.error("配置写入失败: %s" % e)
+
+    def stats(self) -> dict:
+        return {
+            "write_requests": self.write_requests,
+            "write_count": self.write_count,
+            "record_count": self.record_count,
+            "compact_count": self.compact_count,
+            "pending": self._pending + self._save_requested
+        }
+
+    def close(self):
+        """
+        停止后台写入线程并写入全部待写入的修改，退出时调用
+        """
+        self._closed = True
+        if self._flusher is not None:
+            self._flush_event.set()
+            self._flusher.join()
+        self.flush()
+        logger.info("配置写入统计: %s" % self.stats())
+        self._store.close()
+
+
+def _lookup(value, path: tuple):
+    # 按路径获取嵌套配置中的值，不存在时返回REMOVED
+    for key in path:
+        if not isinstance(value, MappingProxyType) or key not in value:
+            return REMOVED
+        value = value[key]
+    return value
+
+
+def _patch(value, changes: dict) -> MappingProxyType:
+    """
+    复制嵌套配置中被修改的各层并应用修改，未修改的部分与原配置共用
+    被复制的每一层都是整体复制，开销与该层的项数成正比
+    :param changes: {路径(tuple): 新值或REMOVED}
+    """
+    # MappingProxyType.copy 直接复制底层的dict，比 dict(value) 逐项复制快得多
+    data = value.copy() if isinstance(value, MappingProxyType) else {}
+    nested = {}
+    for path, new_value in changes.items():
+        if len(path) > 1:
+            nested.setdefault(path[0], {})[path[1:]] = new_value
+        elif new_value is REMOVED:
+            data.pop(path[0], None)
+        else:
+            data[path[0]] = new_value
+    for key, sub_changes in nested.items():
+        data[key] = _patch(data.get(key), sub_changes)
+    return MappingProxyType(data)
+
+
+class ConfigSubtree(object):
+    """
+    嵌套配置的操作对象，见 ConfigManger.subtree
+    修改其中的项时只复制从顶层到该项所在的各层，并只写入修改的项；一次 apply 的全部修改只写入一次
+    """
+
+    def __init__(self, config_manger: ConfigManger, key: str, path: tuple = ()):
+        self._config_manger = config_manger
+        self.key = key
+        self.path = path
+
+    def snapshot(self) -> MappingProxyType:
+        """
+        获取该层配置的不可变快照，配置不存在时为空
+        """
+        value = _lookup(self._config_manger.get(self.key), self.path)
+        return value if isinstance(value, MappingProxyType) else MappingProxyType({})
+
+    def subtree(self, sub_key: str):
+        """
+        获取下一层配置的操作对象
+        """
+        return ConfigSubtree(self._config_manger, self.key, self.path + (sub_key,))
+
+    def get(self, sub_key: str, default=None):
+        return self.snapshot().get(sub_key, default)
+
+    def __contains__(self, sub_key: str) -> bool:
+        return sub_key in self.snapshot()
+
+    def put(self, sub_key: str, value):
+        self.apply({sub_key: value})
+
+    def put_many(self, items: dict):
+        self.apply(items)
+
+    def remove(self, sub_key: str):
+        with self._config_manger.key_lock(self.key):
+            if sub_key not in self.snapshot():
+                raise KeyError(sub_key)
+            self._apply({sub_key: REMOVED})
+
+    def remove_many(self, sub_keys):
+        """
+        删除多项，不存在的项忽略
+        """
+        self.apply({sub_key: REMOVED for sub_key in sub_keys})
+
+    def update(self, sub_key: str, func, default=None):
+        """
+        基于原值修改其中一项，参数见 ConfigManger.update
+        """
+        with self._config_manger.key_lock(self.key):
+            value = freeze(func(self.snapshot().get(sub_key, default)))
+            self._apply({sub_key: value})
+        return value
+
+    def apply(self, changes: dict):
+        """
+        批量修改
+        :param changes: {子键或子键路径(tuple): 新值或REMOVED}，如 {("news", "ou_xxx"): REMOVED}
+        """
+        with self._config_manger.key_lock(self.key):
+            self._apply(changes)
+
+    def _apply(self, changes: dict):
+        if not changes:
+            return
+        changes = {self.path + (path if isinstance(path, tuple) else (path,)): freeze(value)
+                   for path, value in changes.items()}
+        root = _patch(self._config_manger.get(self.key), changes)
+        self._config_manger._replace(self.key, root, list(changes))
 
 
 class PluginManagerTools(object):
@@ -93,157 +460,836 @@ class PluginManagerTools(object):
     工具性插件可以在初始化时将自身实例化后加入该类中已供别的插件使用
     """
 
-    def __init__(self, api_client: MessageApiClient, config_manger: ConfigManger, __logger=utils.get_logger()):
+    def __init__(self, api_client: MessageApiClient, config_manger: ConfigManger,
+                 async_api_client: AsyncMessageApiClient = None,
+                 outbound_scheduler: OutboundScheduler = None,
+                 outbox: Outbox = None, __logger=utils.get_logger()):
         """
         初始化插件工具
-        :param api_client:      飞书API
-        :param config_manger:   配置管理器
-        :param __logger:        日志工具
+        :param api_client:          飞书API
+        :param config_manger:       配置管理器
+        :param async_api_client:    异步飞书API，未安装aiohttp时为None
+        :param outbound_scheduler:  出站消息调度器，批量发送时使用以避免触发频率限制
+        :param outbox:              持久化出站消息队列，不能丢失的消息通过它发送
+        :param __logger:            日志工具
         """
         self.api_client: MessageApiClient = api_client
         self.config_manger: ConfigManger = config_manger
+        self.async_api_client: AsyncMessageApiClient = async_api_client
+        self.outbound_scheduler: OutboundScheduler = outbound_scheduler
+        self.outbox: Outbox = outbox
         self.logger = __logger
 
     def ok(self):
         pass
 
 
+def _static_args(value):
+    """
+    将插件清单中的参数还原为插件信息的参数
+    """
+    if isinstance(value, dict):
+        if "__enum__" in value:
+            return {"LarkEvent": LarkEvent, "PluginType": PluginType}[value["__enum__"]][value["name"]]
+        return {k: _static_args(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_static_args(v) for v in value]
+    return value
+
+
+class _LazyPlugin(object):
+    """
+    延迟加载的插件占位对象，首次调用时导入并初始化插件模块
+    """
+
+    def __init__(self, manager, name: str, path: str, plugin_info: PluginInfo, is_coroutine: bool):
+        self.__name__ = name
+        self.path = path
+        self.PLUGIN_INFO = plugin_info
+        self._manager = manager
+        self.loaded = False
+        self.module = None
+        if is_coroutine:
+            self.handler_event = self._async_handler_event
+        else:
+            self.handler_event = self._handler_event
+
+    def load(self):
+        """
+        导入并初始化插件模块
+        :return: 插件模块，加载失败时返回None
+        """
+        if self.loaded:
+            return self.module
+        return self._manager._load_lazy_plugin(self)
+
+    def _handler_event(self, event, tools):
+        mod = self.load()
+        if mod is not None:
+            return mod.handler_event(event, tools)
+
+    async def _async_handler_event(self, event, tools):
+        mod = await asyncio.get_running_loop().run_in_executor(None, self.load)
+        if mod is not None:
+            return await mod.handler_event(event, tools)
+
+    def handler_api(self, api_request, tools):
+        mod = self.load()
+        if mod is not None:
+            return mod.handler_api(api_request, tools)
+
+
+class _PluginSnapshot(object):
+    """
+    插件注册表快照，构建完成后不再修改，重新加载时整体替换
+    """
+    __slots__ = ("event_plugins", "api_plugins", "dispatch_table", "router")
+
+    def __init__(self, event_plugins: dict, api_plugins: dict, dispatch_table, router: Router):
+        self.event_plugins = event_plugins
+        self.api_plugins = api_plugins
+        self.dispatch_table = dispatch_table
+        self.router = router
+
+
 class PluginManager(object):
     """
     插件管理器
+    插件按文件加载，重新加载时只导入有变化的文件，构建新的注册表快照后整体替换，
+    正在分发的事件继续使用旧的快照，不会看到未构建完成的注册表
     """
-    EVENT_PLUGIN_DICT = dict()
-    API_PLUGIN_DICT = dict()
+    PLUGIN_DIR = "./plugin"
+    PLUGIN_PACKAGE = "plugin"
     PLUGIN_UPDATE_AT = 0
 
-    def __init__(self, api_client: MessageApiClient, config_manger: ConfigManger):
+    def __init__(self, api_client: MessageApiClient, config_manger: ConfigManger,
+                 async_api_client: AsyncMessageApiClient = None,
+                 outbound_scheduler: OutboundScheduler = None,
+                 outbox: Outbox = None,
+                 lazy_load: bool = False,
+                 manifest_path: str = None,
+                 init_workers: int = DEFAULT_INIT_WORKERS,
+                 init_timeout: float = DEFAULT_INIT_TIMEOUT,
+                 handler_timeout: float = None,
+                 slow_call: float = None,
+                 breaker_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 breaker_reset: float = DEFAULT_RESET_TIMEOUT,
+                 handler_workers: int = DEFAULT_HANDLER_WORKERS,
+                 process_workers: int = None):
         """
         初始化插件管理器
         :param api_client: 飞书API
         :param config_manger: 配置管理器
+        :param async_api_client: 异步飞书API
+        :param outbound_scheduler: 出站消息调度器
+        :param outbox: 持久化出站消息队列
+        :param lazy_load: 是否延迟加载插件：启动时只根据插件清单注册，事件或WEB请求首次命中时才导入并初始化
+        :param manifest_path: 插件清单缓存文件路径，为空时每次启动重新解析
+        :param init_workers: 同时初始化的插件数量
+        :param init_timeout: 插件初始化超时时间(秒)，超时的插件被禁用，插件信息中的init_timeout优先
+        :param handler_timeout: 事件处理超时时间(秒)，为空时不限制，插件信息中的timeout优先
+        :param slow_call: 事件处理耗时超过该值(秒)时视为失败，为空时不判断
+        :param breaker_threshold: 插件连续失败多少次后熔断，0表示不熔断
+        :param breaker_reset: 熔断持续时间(秒)
+        :param handler_workers: 设置了超时时间的同步插件在该线程池中执行
+        :param process_workers: 插件进程池的进程数，默认为CPU核数
         """
-        self.tools = PluginManagerTools(api_client, config_manger)
+        self.tools = PluginManagerTools(api_client, config_manger, async_api_client, outbound_scheduler, outbox)
+        self._snapshot = _PluginSnapshot({}, {}, MappingProxyType({}), Router())
+        self._reload_lock = threading.Lock()
+        # 模块名 -> 文件修改时间
+        self._file_mtimes = {}
+        # 模块名 -> 已初始化的插件模块
+        self._modules = {}
+        self._watcher = None
+        self._watcher_stop = threading.Event()
+        self._manifest = PluginManifest(manifest_path) if lazy_load else None
+        self._init_workers = max(1, init_workers)
+        self._init_timeout = init_timeout
+        # 模块名 -> 最近一次初始化的结果
+        self._init_report = {}
+        self._handler_timeout = handler_timeout
+        self._slow_call = slow_call
+        self._breaker_threshold = breaker_threshold
+        self._breaker_reset = breaker_reset
+        self._handler_pool = ThreadPoolExecutor(max_workers=handler_workers, thread_name_prefix="plugin-handler")
+        self._process_workers = process_workers
+        self._process_pool = None
+        self._process_pool_lock = threading.Lock()
+        # 关闭后不再创建进程池
+        self._closed = False
+        # 插件信息 -> 插件执行器
+        self._runners = weakref.WeakKeyDictionary()
         self._scanning_plugin()
 
+    @property
+    def EVENT_PLUGIN_DICT(self) -> dict:
+        return self._snapshot.event_plugins
+
+    @property
+    def API_PLUGIN_DICT(self) -> dict:
+        return self._snapshot.api_plugins
+
     def _scanning_plugin(self):
         """
         扫描并注册插件
         :return:
         """
-        now = int(time.time())
-        if now - self.PLUGIN_UPDATE_AT > 60:
-            for item in LarkEvent:
-                self.EVENT_PLUGIN_DICT[item.value] = list()
-
-            import pkgutil
-            # 1. 先扫描MOD，进行排序
-            mod_info_list = []
-            for finder, name, ispck in pkgutil.walk_packages(["./plugin"]):
-                loader = finder.find_module(name)  # 返回一个loader对象或者None。
-                if loader:
-                    mod = loader.load_module(name)  # 返回一个module对象或者raise an exception
-                    mod_members = dir(mod)
-                    if "PLUGIN_INFO" in mod_members:
-                        plugin_info: PluginInfo = mod.PLUGIN_INFO
-                        mod_info_list.append((plugin_info.weight, mod, mod_members))
-
-            def mod_info_list_sort(o1, o2):
-                if o1[0] > o2[0]:
-                    return -1
-                elif o1[1].PLUGIN_INFO.name < o2[1].PLUGIN_INFO.name:
-                    return 1
-                return 1
-
-            # 2. 将MOD进行初始化并归类
-            mod_info_list = sorted(mod_info_list, key=functools.cmp_to_key(mod_info_list_sort))
-            for weight, mod, mod_members in mod_info_list:
-                plugin_info: PluginInfo = mod.PLUGIN_INFO
-                if plugin_info.type == PluginType.EVENT and "handler_event" in mod_members:
-                    plugin_list: list = self.EVENT_PLUGIN_DICT.get(plugin_info.event_type.value)
-                    if plugin_list is None:
-                        logger.info("事件【%s】未被支持，事件处理插件【%s】已禁用" % (plugin_info.event_type.value, plugin_info.name))
+        self.reload()
+
+    def reload(self) -> dict:
+        """
+        检查插件文件的变化，只重新加载新增或修改过的插件，并移除已删除的插件
+        :return: 本次变化的模块名 {"loaded": [...], "removed": [...]}
+        """
+        with self._reload_lock:
+            files = self._plugin_files()
+            changed = [name for name, (path, mtime) in files.items() if self._file_mtimes.get(name) != mtime]
+            removed = [name for name in self._file_mtimes if name not in files]
+            if not changed and not removed:
+                return {"loaded": [], "removed": []}
+            modules = dict(self._modules)
+            for name in removed:
+                logger.info("插件文件【%s】已删除" % name)
+                self._file_mtimes.pop(name)
+                modules.pop(name, None)
+                sys.modules.pop(name, None)
+                self._unregister_commands(name)
+            loaded = []
+            to_init = {}
+            for name in changed:
+                path, mtime = files[name]
+                self._file_mtimes[name] = mtime
+                if self._manifest is not None:
+                    lazy = self._lazy_plugin(name, path)
+                    if lazy is not None:
+                        self._unregister_commands(name)
+                        modules[name] = lazy
+                        loaded.append(name)
+                        continue
+                mod = self._import_plugin(name, path)
+                if mod is None:
+                    # 导入失败（如文件正在编辑）时保留旧版本
+                    continue
+                to_init[name] = mod
+            # 新版本初始化成功前保留旧版本及其命令，初始化失败或超时时继续使用旧版本
+            old_commands = {name: self._owned_commands(name) for name in to_init}
+            forced = self._import_lazy_dependencies(to_init, modules)
+            succeeded = self._init_plugins(to_init, modules)
+            for name in succeeded:
+                modules[name] = to_init[name]
+                if name not in forced:
+                    loaded.append(name)
+            for name in old_commands:
+                self._swap_commands(name, old_commands[name], name in succeeded)
+                if name not in succeeded:
+                    old = modules.get(name)
+                    old = old.module if isinstance(old, _LazyPlugin) else old
+                    if old is not None:
+                        sys.modules[name] = old
                     else:
-                        logger.info("【%s】发现事件处理插件【%s】" % (plugin_info.event_type.value, plugin_info.name))
-                        plugin_info.set_members(mod_members)
-                        if "init" in mod_members:
-                            try:
-                                logger.info("\t\t事件处理插件【%s】开始初始化" % plugin_info.name)
-                                mod.init(self.tools)
-                                logger.info("\t\t事件处理插件【%s】初始化成功" % plugin_info.name)
-                            except BaseException as e:
-                                logger.info("\t\t事件处理插件【%s】初始化失败，已被禁用" % plugin_info.name, e)
-                                traceback.print_exc()
-                                continue
-                        plugin_list.append(mod)
-                        logger.info("\t\t事件处理插件【%s】加载成功" % plugin_info.name)
-                    if plugin_info.api_path and "handler_api" in mod_members:
-                        self.API_PLUGIN_DICT[plugin_info.api_path] = mod
-                        logger.info("\t\t事件处理插件【%s】已绑定至WEB路径【%s】" % (plugin_info.name, plugin_info.api_path))
-                elif plugin_info.type == PluginType.UTILS:
-                    logger.info("发现工具性插件【%s】" % plugin_info.name)
-                    if "init" in mod_members:
-                        try:
-                            logger.info("\t\t工具性插件【%s】开始初始化" % plugin_info.name)
-                            mod.init(self.tools)
-                            logger.info("\t\t工具性插件【%s】初始化成功" % plugin_info.name)
-                        except BaseException as e:
-                            logger.info("\t\t工具性插件【%s】初始化失败，已被禁用" % plugin_info.name, e)
-                            traceback.print_exc()
-                            continue
-                    logger.info("\t\t工具性插件【%s】加载完成" % plugin_info.name)
-                elif plugin_info.type == PluginType.WEB and "handler_api" in mod_members:
-                    logger.info("发现API插件【%s】" % plugin_info.name)
-                    if "init" in mod_members:
-                        try:
-                            logger.info("\t\tAPI插件【%s】开始初始化" % plugin_info.name)
-                            mod.init(self.tools)
-                            logger.info("\t\tAPI插件【%s】初始化成功" % plugin_info.name)
-                        except BaseException as e:
-                            logger.info("\t\tAPI插件【%s】初始化失败，已被禁用" % plugin_info.name, e)
-                            traceback.print_exc()
-                            continue
-                    self.API_PLUGIN_DICT[plugin_info.api_path] = mod
-                    logger.info("\t\tAPI插件【%s】已绑定至WEB路径【%s】" % (plugin_info.name, plugin_info.api_path))
-
-            self.PLUGIN_UPDATE_AT = now
-
-            logger.info("插件加载完成！")
-            for key in self.EVENT_PLUGIN_DICT:
-                logger.info("事件【%s】插件：" % key)
-                logger.info("\t\t| weight |    plugin name    |")
-                for mod in self.EVENT_PLUGIN_DICT[key]:
-                    mod_info: PluginInfo = mod.PLUGIN_INFO
-                    logger.info("\t\t| %s| %s|" % (str(mod_info.weight).ljust(7), mod_info.name.center(18)))
-            logger.info("API插件：")
-            logger.info("\t\t|           api path           |    plugin name    |")
-            for path in self.API_PLUGIN_DICT:
-                mod_info: PluginInfo = self.API_PLUGIN_DICT[path].PLUGIN_INFO
-                logger.info("\t\t|%s| %s|" % (path.center(30), mod_info.name.center(18)))
+                        sys.modules.pop(name, None)
+            self._finish_lazy_dependencies(forced, succeeded, modules)
+            if self._manifest is not None:
+                self._manifest.retain(files)
+                self._manifest.save()
+            self._modules = modules
+            self._snapshot = self._build_snapshot(modules)
+            self.PLUGIN_UPDATE_AT = int(time.time())
+            self._log_snapshot()
+            return {"loaded": loaded, "removed": removed}
+
+    def _unregister_commands(self, name: str):
+        # 插件删除或改为延迟加载时移除旧版本注册的命令，新版本在init中重新注册
+        command_engine = getattr(self.tools, "command_engine", None)
+        if command_engine is not None:
+            command_engine.unregister(name)
+
+    def _owned_commands(self, name: str) -> list:
+        command_engine = getattr(self.tools, "command_engine", None)
+        return command_engine.owned(name) if command_engine is not None else []
+
+    def _swap_commands(self, name: str, old_commands: list, succeeded: bool):
+        """
+        插件新版本初始化完成后处理命令：成功时移除新版本没有重新注册的旧命令，失败时恢复旧版本的命令
+        """
+        command_engine = getattr(self.tools, "command_engine", None)
+        if command_engine is None:
+            return
+        if succeeded:
+            command_engine.discard(old_commands)
+        else:
+            command_engine.restore(name, old_commands)
+
+    def _plugin_files(self) -> dict:
+        """
+        获取插件目录下的全部插件文件
+        :return: 模块名 -> (文件路径, 修改时间)
+        """
+        files = {}
+        for root, dirs, filenames in os.walk(self.PLUGIN_DIR):
+            dirs[:] = sorted(d for d in dirs if not d.startswith((".", "__")))
+            for filename in sorted(filenames):
+                if not filename.endswith(".py") or filename == "__init__.py":
+                    continue
+                path = os.path.join(root, filename)
+                rel = os.path.relpath(path, self.PLUGIN_DIR)[:-3]
+                name = ".".join([self.PLUGIN_PACKAGE] + rel.split(os.sep))
+                try:
+                    files[name] = (path, os.stat(path).st_mtime_ns)
+                except FileNotFoundError:
+                    continue
+        return files
+
+    @staticmethod
+    def _import_plugin(name: str, path: str):
+        """
+        从文件导入插件模块，每次都创建新的模块对象
+        :return: 插件模块，导入失败时返回None
+        """
+        old = sys.modules.get(name)
+        try:
+            spec = importlib.util.spec_from_file_location(name, path)
+            mod = importlib.util.module_from_spec(spec)
+            sys.modules[name] = mod
+            spec.loader.exec_module(mod)
+        except BaseException as e:
+            logger.error("插件文件【%s】导入失败: %s" % (path, e))
+            traceback.print_exc()
+            if old is not None:
+                sys.modules[name] = old
+            else:
+                sys.modules.pop(name, None)
+            return None
+        return mod
+
+    @staticmethod
+    def _plugin_label(plugin_info: PluginInfo, mod_members) -> str:
+        """
+        校验插件类型与必要的方法
+        :return: 插件类型名称，插件不可用时返回None
+        """
+        if plugin_info.type == PluginType.EVENT and "handler_event" in mod_members:
+            if plugin_info.event_type is None or plugin_info.event_type.value not in _EVENT_TYPES:
+                logger.info("事件【%s】未被支持，事件处理插件【%s】已禁用" % (plugin_info.event_type, plugin_info.name))
+                return None
+            logger.info("【%s】发现事件处理插件【%s】" % (plugin_info.event_type.value, plugin_info.name))
+            return "事件处理插件"
+        elif plugin_info.type == PluginType.UTILS:
+            logger.info("发现工具性插件【%s】" % plugin_info.name)
+            return "工具性插件"
+        elif plugin_info.type == PluginType.WEB and "handler_api" in mod_members:
+            logger.info("发现API插件【%s】" % plugin_info.name)
+            return "API插件"
+        return None
+
+    def _check_plugin(self, mod) -> str:
+        """
+        校验插件
+        :return: 插件类型名称，插件不可用时返回None
+        """
+        mod_members = dir(mod)
+        if "PLUGIN_INFO" not in mod_members:
+            return None
+        plugin_info: PluginInfo = mod.PLUGIN_INFO
+        label = self._plugin_label(plugin_info, mod_members)
+        if label is not None:
+            plugin_info.set_members(mod_members)
+        return label
+
+    def _init_plugins(self, mods: dict, available: dict) -> list:
+        """
+        并行初始化插件
+        依赖的插件初始化成功后才开始初始化；依赖不存在、初始化失败或超时的插件被禁用
+        :param mods:        模块名 -> 待初始化的插件模块
+        :param available:   模块名 -> 已加载的插件，可以作为依赖（尚未加载的延迟加载插件不可作为依赖，
+                            需先通过 _import_lazy_dependencies 加入待初始化的插件）
+        :return: 初始化成功的模块名列表
+        """
+        waiting = {}
+        for name, mod in mods.items():
+            label = self._check_plugin(mod)
+            if label is not None:
+                waiting[name] = (mod, label)
+        batch_names = {mod.PLUGIN_INFO.name for mod, label in waiting.values()}
+        ready_names = {mod.PLUGIN_INFO.name for mod in available.values()
+                       if not isinstance(mod, _LazyPlugin) or mod.module is not None} - batch_names
+        failed_names = set()
+        succeeded = []
+        # 模块名 -> (插件模块, 插件类型名称, 开始时间, 超时时间)
+        running = {}
+        done = queue.Queue()
+        report = {}
+
+        def finish(name, mod, label, status, elapsed):
+            plugin_info: PluginInfo = mod.PLUGIN_INFO
+            report[name] = {"name": plugin_info.name, "status": status, "elapsed": elapsed}
+            if status == _INIT_OK:
+                logger.info("\t\t%s【%s】加载成功" % (label, plugin_info.name))
+                if plugin_info.api_path and "handler_api" in plugin_info.members \
+                        and plugin_info.type != PluginType.UTILS:
+                    logger.info("\t\t%s【%s】已绑定至WEB路径【%s】" % (label, plugin_info.name, plugin_info.api_path))
+                ready_names.add(plugin_info.name)
+                succeeded.append(name)
+            else:
+                logger.info("\t\t%s【%s】%s，已被禁用" % (label, plugin_info.name, status))
+                failed_names.add(plugin_info.name)
+
+        while waiting or running:
+            for name, (mod, label) in list(waiting.items()):
+                depends = mod.PLUGIN_INFO.depends
+                if any(d in failed_names or (d not in ready_names and d not in batch_names) for d in depends):
+                    del waiting[name]
+                    finish(name, mod, label, _INIT_DEPENDENCY_FAILED, 0.0)
+                elif len(running) < self._init_workers and all(d in ready_names for d in depends):
+                    del waiting[name]
+                    if "init" not in mod.PLUGIN_INFO.members:
+                        finish(name, mod, label, _INIT_OK, 0.0)
+                        continue
+                    now = time.monotonic()
+                    running[name] = (mod, label, now, now + (mod.PLUGIN_INFO.init_timeout or self._init_timeout))
+                    threading.Thread(target=self._run_init, args=(name, mod, label, done),
+                                     name="plugin-init", daemon=True).start()
+            if not running:
+                # 剩余的插件之间存在循环依赖
+                for name, (mod, label) in waiting.items():
+                    finish(name, mod, label, _INIT_DEPENDENCY_FAILED, 0.0)
+                break
+            try:
+                timeout = min(deadline for mod, label, started_at, deadline in running.values()) - time.monotonic()
+                name, error, elapsed = done.get(timeout=max(0.0, timeout))
+                if name in running:
+                    mod, label, started_at, deadline = running.pop(name)
+                    finish(name, mod, label, _INIT_OK if error is None else _INIT_FAILED, elapsed)
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for name in [n for n, r in running.items() if r[3] <= now]:
+                # 无法强制结束初始化线程，只将插件禁用
+                mod, label, started_at, deadline = running.pop(name)
+                finish(name, mod, label, _INIT_TIMEOUT, now - started_at)
+        self._init_report.update(report)
+        self._log_init_report(report)
+        return succeeded
+
+    def _run_init(self, name: str, mod, label: str, done: queue.Queue):
+        plugin_info: PluginInfo = mod.PLUGIN_INFO
+        started_at = time.monotonic()
+        error = None
+        try:
+            logger.info("\t\t%s【%s】开始初始化" % (label, plugin_info.name))
+            mod.init(self.tools)
+            logger.info("\t\t%s【%s】初始化成功" % (label, plugin_info.name))
+        except BaseException as e:
+            logger.info("\t\t%s【%s】初始化失败" % (label, plugin_info.name), e)
+            traceback.print_exc()
+            error = e
+        done.put((name, error, time.monotonic() - started_at))
+
+    @staticmethod
+    def _log_init_report(report: dict):
+        if not report:
+            return
+        logger.info("插件初始化：")
+        logger.info("\t\t|    plugin name    |     status     | time(ms) |")
+        for item in sorted(report.values(), key=lambda r: -r["elapsed"]):
+            logger.info("\t\t| %s| %s| %s|" % (item["name"].center(18), item["status"].center(14),
+                                                  ("%.1f" % (item["elapsed"] * 1000)).rjust(9)))
+
+    def init_report(self) -> list:
+        """
+        获取插件初始化报告
+        :return: [{"module": 模块名, "name": 插件名称, "status": 状态, "elapsed": 耗时(秒)}, ...]，按耗时从大到小排列
+        """
+        return sorted(({"module": k, **v} for k, v in self._init_report.items()), key=lambda r: -r["elapsed"])
+
+    def _lazy_plugin(self, name: str, path: str):
+        """
+        根据插件清单注册延迟加载的插件
+        :return: _LazyPlugin，插件信息无法静态解析或为工具性插件时返回None，需要立即导入
+        """
+        info = self._manifest.entry(name, path)
+        if not info or not info["static"]:
+            return None
+        try:
+            plugin_info = PluginInfo(*_static_args(info["args"]), **_static_args(info["kwargs"]))
+        except BaseException as e:
+            logger.error("插件文件【%s】的插件信息无法从清单构造: %s" % (path, e))
+            return None
+        # 工具性插件在初始化时向插件工具注册自身，需要立即加载
+        if plugin_info.type == PluginType.UTILS:
+            return None
+        functions = info["functions"]
+        mod_members = ["PLUGIN_INFO"] + list(functions)
+        label = self._plugin_label(plugin_info, mod_members)
+        if label is None:
+            return None
+        plugin_info.set_members(mod_members)
+        logger.info("\t\t%s【%s】已注册，首次调用时加载" % (label, plugin_info.name))
+        return _LazyPlugin(self, name, path, plugin_info, functions.get("handler_event", False))
+
+    def _import_lazy_dependencies(self, to_init: dict, modules: dict) -> dict:
+        """
+        导入待初始化的插件所依赖的延迟加载插件，加入 to_init 与依赖它的插件一起初始化，
+        保证依赖的插件在本插件初始化前已执行init
+        :return: 模块名 -> 被提前加载的 _LazyPlugin
+        """
+        lazy_plugins = {mod.PLUGIN_INFO.name: (name, mod) for name, mod in modules.items()
+                        if isinstance(mod, _LazyPlugin) and not mod.loaded and name not in to_init}
+        forced = {}
+        pending = list(to_init.values())
+        while pending and lazy_plugins:
+            plugin_info = getattr(pending.pop(), "PLUGIN_INFO", None)
+            for depend in (plugin_info.depends if plugin_info is not None else ()):
+                name, lazy = lazy_plugins.pop(depend, (None, None))
+                if lazy is None:
+                    continue
+                logger.info("插件【%s】被其他插件依赖，立即加载" % depend)
+                forced[name] = lazy
+                mod = self._import_plugin(name, lazy.path)
+                if mod is not None:
+                    to_init[name] = mod
+                    pending.append(mod)
+        return forced
+
+    @staticmethod
+    def _finish_lazy_dependencies(forced: dict, succeeded: list, modules: dict):
+        # 以真实模块替换被提前加载的占位对象，加载失败的插件被禁用
+        for name, lazy in forced.items():
+            lazy.loaded = True
+            if name in succeeded:
+                lazy.module = modules[name]
+            elif modules.get(name) is lazy:
+                modules.pop(name)
+
+    def _load_lazy_plugin(self, lazy) -> object:
+        """
+        导入并初始化延迟加载的插件，成功后以真实模块替换注册表中的占位对象
+        :return: 插件模块，加载失败时返回None并禁用插件
+        """
+        with self._reload_lock:
+            if not lazy.loaded and self._activate_lazy_plugins([lazy]):
+                self._snapshot = self._build_snapshot(self._modules)
+            return lazy.module
+
+    def _activate_lazy_plugins(self, plugins) -> bool:
+        """
+        加载延迟加载的插件，需持有_reload_lock
+        :return: 注册表中的插件是否有变化
+        """
+        modules = dict(self._modules)
+        imported = {}
+        for lazy in plugins:
+            if lazy.loaded:
+                continue
+            mod = self._import_plugin(lazy.__name__, lazy.path)
+            if mod is not None:
+                imported[lazy.__name__] = mod
+        forced = self._import_lazy_dependencies(imported, modules)
+        succeeded = set(self._init_plugins(imported, modules))
+        for name in forced:
+            if name in succeeded:
+                modules[name] = imported[name]
+        self._finish_lazy_dependencies(forced, succeeded, modules)
+        changed = bool(forced)
+        for lazy in plugins:
+            if lazy.loaded:
+                continue
+            mod = imported.get(lazy.__name__) if lazy.__name__ in succeeded else None
+            lazy.module = mod
+            lazy.loaded = True
+            # 加载期间插件文件可能已被重新加载，此时不再替换
+            if modules.get(lazy.__name__) is lazy:
+                if mod is None:
+                    modules.pop(lazy.__name__)
+                else:
+                    modules[lazy.__name__] = mod
+                changed = True
+        if changed:
+            self._modules = modules
+        return changed
+
+    def warm_up(self):
+        """
+        加载全部尚未加载的插件
+        """
+        with self._reload_lock:
+            plugins = [mod for mod in self._modules.values() if isinstance(mod, _LazyPlugin)]
+            if self._activate_lazy_plugins(plugins):
+                self._snapshot = self._build_snapshot(self._modules)
+
+    def start_warm_up(self):
+        """
+        在后台线程中加载全部尚未加载的插件
+        """
+        threading.Thread(target=self.warm_up, name="plugin-warm-up", daemon=True).start()
+
+    def _build_snapshot(self, modules: dict) -> _PluginSnapshot:
+        """
+        根据已初始化的插件构建新的注册表快照
+        """
+        event_plugins = {event_type: [] for event_type in _EVENT_TYPES}
+        api_plugins = {}
+        api_routes = []
+        # 权重越大越先调用，权重相同时按模块名排序
+        for name in sorted(modules, key=lambda n: (-modules[n].PLUGIN_INFO.weight, n)):
+            mod = modules[name]
+            plugin_info: PluginInfo = mod.PLUGIN_INFO
+            if plugin_info.type == PluginType.EVENT:
+                event_plugins[plugin_info.event_type.value].append(mod)
+                if plugin_info.api_path and "handler_api" in plugin_info.members:
+                    api_plugins[plugin_info.api_path] = mod
+                    api_routes.append((plugin_info.api_path, mod))
+            elif plugin_info.type == PluginType.WEB:
+                api_plugins[plugin_info.api_path] = mod
+                api_routes.append((plugin_info.api_path, mod))
+        return _PluginSnapshot(event_plugins, api_plugins, self._compile_dispatch_table(event_plugins),
+                               self._compile_router(api_routes))
+
+    @staticmethod
+    def _compile_router(api_routes: list) -> Router:
+        """
+        将API插件编译为路由前缀树
+        :param api_routes: [(API路径, 插件), ...]，按权重排序
+        """
+        router = Router()
+        for path, mod in api_routes:
+            try:
+                router.add(path, mod, mod.PLUGIN_INFO.api_methods)
+            except ValueError as e:
+                logger.error("API插件【%s】的WEB路径【%s】与其他插件冲突，已忽略: %s" % (mod.PLUGIN_INFO.name, path, e))
+        return router
+
+    def _log_snapshot(self):
+        snapshot = self._snapshot
+        logger.info("插件加载完成！")
+        for key in snapshot.event_plugins:
+            logger.info("事件【%s】插件：" % key)
+            logger.info("\t\t| weight |    plugin name    |")
+            for mod in snapshot.event_plugins[key]:
+                mod_info: PluginInfo = mod.PLUGIN_INFO
+                logger.info("\t\t| %s| %s|" % (str(mod_info.weight).ljust(7), mod_info.name.center(18)))
+        logger.info("API插件：")
+        logger.info("\t\t| method |           api path           |    plugin name    |")
+        for path, method, mod in snapshot.router.routes():
+            mod_info: PluginInfo = mod.PLUGIN_INFO
+            logger.info("\t\t| %s|%s| %s|" % ((method or "*").ljust(7), path.center(30), mod_info.name.center(18)))
+
+    def start_watcher(self, interval: float = 2.0):
+        """
+        启动插件文件监视线程，定时检查插件文件的修改时间并重新加载有变化的插件
+        :param interval: 检查间隔(秒)
+        """
+        if self._watcher is not None:
+            return
+        self._watcher_stop.clear()
+        self._watcher = threading.Thread(target=self._watch, args=(interval,), name="plugin-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        if self._watcher is None:
+            return
+        self._watcher_stop.set()
+        self._watcher.join()
+        self._watcher = None
+
+    def _watch(self, interval: float):
+        while not self._watcher_stop.wait(interval):
+            try:
+                self.reload()
+            except BaseException as e:
+                logger.error("插件重新加载失败: %s" % e)
+                traceback.print_exc()
+
+    def _compile_dispatch_table(self, event_plugins: dict):
+        """
+        将已注册的事件插件编译为只读的分发表：
+        事件类型 -> (事件包装类, ((处理方法, 是否为协程, 插件信息, 消息过滤器, 插件执行器), ...), 关键词自动机, 不受关键词限制的插件序号)
+        插件按权重排序，处理方法返回真值时不再调用后续插件；
+        同一事件下所有插件的关键词编译为一个自动机，每条消息只扫描一次，未命中关键词的插件不会被遍历
+        """
+        table = {}
+        for event_type, mods in event_plugins.items():
+            if not mods:
+                continue
+            handlers = []
+            automaton = KeywordAutomaton()
+            ungated = []
+            for index, mod in enumerate(mods):
+                message_filter = getattr(mod.PLUGIN_INFO, "message_filter", None)
+                if message_filter is not None and message_filter.is_empty():
+                    message_filter = None
+                if message_filter is not None and event_type != LarkEvent.IM_MESSAGE_RECEIVE.value:
+                    logger.warning("插件【%s】的过滤条件仅对接收消息事件生效，已忽略" % mod.PLUGIN_INFO.name)
+                    message_filter = None
+                if message_filter is not None:
+                    for keyword in message_filter.keywords:
+                        automaton.add(keyword, index)
+                if message_filter is None or not message_filter.keyword_only():
+                    ungated.append(index)
+                handlers.append((mod.handler_event, inspect.iscoroutinefunction(mod.handler_event),
+                                 mod.PLUGIN_INFO, message_filter, self._runner(mod)))
+            if len(automaton):
+                automaton.build()
+            else:
+                automaton = None
+            table[event_type] = (_EVENT_WRAPPERS.get(event_type), tuple(handlers), automaton, frozenset(ungated))
+        return MappingProxyType(table)
+
+    @staticmethod
+    def _matched_handlers(entry, event):
+        """
+        按过滤条件筛选需要调用的插件，保持权重顺序
+        """
+        wrapper, handlers, automaton, ungated = entry
+        if automaton is None:
+            indices = range(len(handlers))
+            keyword_hits = ()
+        else:
+            keyword_hits = automaton.search(event.text_content) if event.is_text else ()
+            indices = sorted(ungated.union(keyword_hits))
+        for index in indices:
+            handler, is_coroutine, plugin_info, message_filter, runner = handlers[index]
+            if message_filter is None or message_filter.match(event, index in keyword_hits):
+                yield handler, is_coroutine, plugin_info, runner
+
+    def _runner(self, mod) -> PluginRunner:
+        """
+        获取插件执行器，执行器随插件信息保留，插件重新加载后熔断状态与统计信息重置
+        """
+        plugin_info: PluginInfo = mod.PLUGIN_INFO
+        runner = self._runners.get(plugin_info)
+        if runner is None:
+            process_pool = None
+            if plugin_info.process_pool:
+                process_pool = self._get_process_pool
+            runner = PluginRunner(plugin_info.name,
+                                  CircuitBreaker(self._breaker_threshold, self._breaker_reset),
+                                  timeout=plugin_info.timeout or self._handler_timeout,
+                                  slow_call=self._slow_call,
+                                  process_pool=process_pool,
+                                  module_name=mod.__name__,
+                                  module_path=getattr(mod, "__file__", None) or getattr(mod, "path", None))
+            self._runners[plugin_info] = runner
+        return runner
+
+    def _get_process_pool(self):
+        with self._process_pool_lock:
+            if self._closed:
+                raise RuntimeError("cannot schedule new futures after shutdown")
+            if self._process_pool is None:
+                self._process_pool = create_process_pool(self._process_workers)
+            return self._process_pool
+
+    def _reply_process_result(self, event, result):
+        # 进程池中执行的插件无法使用插件工具，返回消息时由主进程回复
+        if isinstance(result, RenderMessage) and isinstance(event, ReceiveMessage):
+            self.tools.api_client.reply_message(event.msg_id, result)
+
+    def plugin_stats(self) -> list:
+        """
+        获取事件插件的执行统计与熔断状态
+        """
+        result = []
+        for event_type, entry in self._snapshot.dispatch_table.items():
+            for handler, is_coroutine, plugin_info, message_filter, runner in entry[1]:
+                result.append(dict(runner.stats(), event_type=event_type))
+        return result
+
+    def close(self):
+        """
+        停止插件文件监视并关闭插件执行使用的线程池与进程池
+        """
+        self.stop_watcher()
+        self._handler_pool.shutdown(wait=False)
+        with self._process_pool_lock:
+            self._closed = True
+            if self._process_pool is not None:
+                self._process_pool.shutdown(wait=False)
+                self._process_pool = None
 
     def with_event(self, event: Event):
-        for key in self.EVENT_PLUGIN_DICT:
-            if key == event.event_type():
-                if key == LarkEvent.IM_MESSAGE_RECEIVE.value:
-                    event = ReceiveMessage(event)
-                for mod in self.EVENT_PLUGIN_DICT.get(key):
-                    try:
-                        if mod.handler_event(event, self.tools):
-                            return
-                    except BaseException as e:
-                        logger.info(mod.PLUGIN_INFO)
-                        logger.info("插件【%s】发生错误:" % mod.PLUGIN_INFO.name)
-                        traceback.print_exc()
-
-    def with_api(self, api_request: ApiRequest):
-        mod = self.API_PLUGIN_DICT[api_request.path]
+        entry = self._snapshot.dispatch_table.get(event.event_type())
+        if entry is None:
+            return
+        wrapper = entry[0]
+        if wrapper:
+            event = wrapper(event)
+        tools = self.tools
+        for handler, is_coroutine, plugin_info, runner in self._matched_handlers(entry, event):
+            if not runner.allow():
+                continue
+            try:
+                result = runner.call(handler, is_coroutine, event, tools, self._handler_pool)
+                if runner.in_process_pool:
+                    self._reply_process_result(event, result)
+                if result:
+                    return
+            except BaseException as e:
+                logger.info(plugin_info)
+                logger.info("插件【%s】发生错误:" % plugin_info.name)
+                traceback.print_exc()
+
+    async def async_with_event(self, event: Event):
+        """
+        在事件循环中处理事件：异步插件直接await，同步插件放入线程池执行
+        :param event: 事件
+        :return:
+        """
+        entry = self._snapshot.dispatch_table.get(event.event_type())
+        if entry is None:
+            return
+        loop = asyncio.get_running_loop()
+        wrapper = entry[0]
+        if wrapper:
+            # 构造时可能会查询发送者信息，属于阻塞操作
+            event = await loop.run_in_executor(None, wrapper, event)
+        tools = self.tools
+        for handler, is_coroutine, plugin_info, runner in self._matched_handlers(entry, event):
+            if not runner.allow():
+                continue
+            try:
+                result = await runner.call_async(handler, is_coroutine, event, tools, loop)
+                if runner.in_process_pool:
+                    await loop.run_in_executor(None, self._reply_process_result, event, result)
+                if result:
+                    return
+            except BaseException as e:
+                logger.info(plugin_info)
+                logger.info("插件【%s】发生错误:" % plugin_info.name)
+                traceback.print_exc()
+
+    def with_api(self, api_request: ApiRequest, raise_error: bool = False):
+        """
+        调用API插件
+        :param api_request: API请求，见 route_api
+        :param raise_error: 插件发生错误时是否抛出异常，同步响应时使用
+        :return: handler_api的返回值
+        """
+        mod = api_request.plugin or self._snapshot.api_plugins.get(api_request.path)
         if mod:
             try:
-                mod.handler_api(api_request, self.tools)
+                return mod.handler_api(api_request, self.tools)
             except BaseException as e:
                 logger.info("插件【%s】发生错误:" % mod.PLUGIN_INFO.name)
                 traceback.print_exc()
+                if raise_error:
+                    raise
+
+    def route_api(self, req: request) -> tuple:
+        """
+        按请求方法与路径匹配API插件
+        :param req: 请求
+        :return: (ApiRequest, ROUTE_FOUND)，未匹配时为 (None, ROUTE_NOT_FOUND / ROUTE_METHOD_NOT_ALLOWED)
+        """
+        match = self._snapshot.router.match(req.method, req.path)
+        if match.status != ROUTE_FOUND:
+            return None, match.status
+        api_request = ApiRequest(req)
+        api_request.path_params = match.params
+        api_request.plugin = match.target
+        return api_request, ROUTE_FOUND
 
     def config_path(self, req: request) -> ApiRequest:
-        mod = self.API_PLUGIN_DICT[request.path]
-        if mod:
-            return ApiRequest(req)
+        api_request, status = self.route_api(req)
+        return api_request
@@ -0,0 +1,152 @@
+import ast
+import hashlib
+import json
+import os
+import threading
+
+import utils
+
+logger = utils.get_logger()
+
+# 插件信息中允许静态解析的枚举
+_STATIC_ENUMS = ("LarkEvent", "PluginType")
+# 插件模块中需要记录的方法
+_PLUGIN_FUNCTIONS = ("init", "handler_event", "handler_api")
+MANIFEST_VERSION = 1
+
+
+class _NotStatic(Exception):
+    pass
+
+
+def _static_value(node):
+    """
+    解析插件信息的参数，只支持字面量与 LarkEvent.X / PluginType.X
+    """
+    if isinstance(node, ast.Attribute) and isinstance(node.value, ast.Name) and node.value.id in _STATIC_ENUMS:
+        return {"__enum__": node.value.id, "name": node.attr}
+    if isinstance(node, (ast.List, ast.Tuple, ast.Set)):
+        return [_static_value(item) for item in node.elts]
+    try:
+        return ast.literal_eval(node)
+    except ValueError:
+        raise _NotStatic()
+
+
+def extract_plugin_info(source: str) -> dict:
+    """
+    不导入模块，从源码中解析插件信息
+    :param source: 插件源码
+    :return: {"static": 是否可以静态解析, "args": [...], "kwargs": {...}, "functions": {方法名: 是否为协程}}，
+             不是插件时返回None
+    """
+    tree = ast.parse(source)
+    info_call = None
+    functions = {}
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)) and node.name in _PLUGIN_FUNCTIONS:
+            functions[node.name] = isinstance(node, ast.AsyncFunctionDef)
+        elif isinstance(node, ast.Assign) and any(isinstance(t, ast.Name) and t.id == "PLUGIN_INFO"
+                                                  for t in node.targets):
+            info_call = node.value
+        elif isinstance(node, ast.AnnAssign) and isinstance(node.target, ast.Name) \
+                and node.target.id == "PLUGIN_INFO":
+            info_call = node.value
+    if info_call is None:
+        return None
+    result = {"static": False, "args": [], "kwargs": {}, "functions": functions}
+    if not (isinstance(info_call, ast.Call) and isinstance(info_call.func, ast.Name)
+            and info_call.func.id == "PluginInfo"):
+        return result
+    try:
+        result["args"] = [_static_value(arg) for arg in info_call.args]
+        for keyword in info_call.keywords:
+            if keyword.arg is None:
+                raise _NotStatic()
+            result["kwargs"][keyword.arg] = _static_value(keyword.value)
+    except _NotStatic:
+        result["args"], result["kwargs"] = [], {}
+        return result
+    result["static"] = True
+    return result
+
+
+class PluginManifest(object):
+    """
+    插件清单缓存
+    记录每个插件文件的哈希值与静态解析出的插件信息，文件内容不变时无需导入模块即可注册插件
+    """
+
+    def __init__(self, path: str):
+        """
+        初始化插件清单
+        :param path: 清单文件路径
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._dirty = False
+        self.hit_count = 0
+        self.miss_count = 0
+        self._load()
+
+    def _load(self):
+        if not self._path or not os.path.exists(self._path):
+            return
+        try:
+            with open(self._path, "r") as r:
+                data = json.loads(r.read() or "{}")
+            if data.get("version") == MANIFEST_VERSION:
+                self._entries = data.get("plugins", {})
+        except BaseException as e:
+            logger.error("插件清单【%s】读取失败，将重新生成: %s" % (self._path, e))
+
+    def entry(self, name: str, path: str) -> dict:
+        """
+        获取插件文件的清单记录，文件哈希值变化时重新解析
+        :param name: 模块名
+        :param path: 文件路径
+        :return: 见 extract_plugin_info，解析失败或不是插件时返回None
+        """
+        with open(path, "rb") as r:
+            content = r.read()
+        digest = hashlib.sha1(content).hexdigest()
+        with self._lock:
+            cached = self._entries.get(name)
+            if cached is not None and cached.get("hash") == digest:
+                self.hit_count += 1
+                return cached.get("info")
+        try:
+            info = extract_plugin_info(content.decode("utf-8"))
+        except BaseException as e:
+            logger.error("插件文件【%s】解析失败: %s" % (path, e))
+            info = None
+        with self._lock:
+            self.miss_count += 1
+            self._entries[name] = {"hash": digest, "info": info}
+            self._dirty = True
+        return info
+
+    def retain(self, names):
+        """
+        移除已删除的插件文件的记录
+        """
+        names = set(names)
+        with self._lock:
+            for name in [n for n in self._entries if n not in names]:
+                del self._entries[name]
+                self._dirty = True
+
+    def save(self):
+        with self._lock:
+            if not self._dirty or not self._path:
+                return
+            data = json.dumps({"version": MANIFEST_VERSION, "plugins": self._entries}, ensure_ascii=False, indent=2)
+            self._dirty = False
+        tmp_path = self._path + ".tmp"
+        try:
+            with open(tmp_path, "w") as w:
+                w.write(data)
+            os.replace(tmp_path, self._path)
+        except BaseException as e:
+            logger.error("插件清单【%s】保存失败: %s" % (self._path, e))
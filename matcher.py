@@ -0,0 +1,146 @@
+import re
+from collections import deque
+
+
+class KeywordAutomaton(object):
+    """
+    关键词自动机(Aho-Corasick)
+    所有插件的关键词编译为一个自动机，每条消息只需扫描一遍即可得到全部命中的关键词；
+    匹配不区分大小写
+    """
+
+    def __init__(self):
+        # 节点的转移表、失败指针与命中的关键词归属
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [set()]
+        self._delta = None
+        self._terminal = None
+        self._built = False
+
+    def __len__(self):
+        return len(self._goto) - 1
+
+    def add(self, keyword: str, payload):
+        """
+        添加关键词
+        :param keyword: 关键词
+        :param payload: 关键词命中时返回的对象，如插件在分发表中的序号
+        """
+        if not keyword:
+            return
+        node = 0
+        for char in keyword.lower():
+            nxt = self._goto[node].get(char)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][char] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append(set())
+            node = nxt
+        self._output[node].add(payload)
+        self._built = False
+
+    def build(self):
+        """
+        计算失败指针并展开为完整的转移表，添加完关键词后调用
+        """
+        goto, fail, output = self._goto, self._fail, self._output
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in goto[node].items():
+                queue.append(nxt)
+                state = fail[node]
+                while state and char not in goto[state]:
+                    state = fail[state]
+                fail[nxt] = goto[state].get(char, 0)
+                output[nxt] |= output[fail[nxt]]
+        # 按广度优先顺序合并失败节点的转移，扫描时每个字符只需一次查表
+        delta = [goto[0]] + [None] * (len(goto) - 1)
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            delta[node] = {**delta[fail[node]], **goto[node]}
+            queue.extend(goto[node].values())
+        self._delta = delta
+        self._terminal = {node: frozenset(o) for node, o in enumerate(output) if o}
+        self._built = True
+
+    def search(self, text: str) -> set:
+        """
+        扫描文本
+        :param text: 文本
+        :return: 命中的关键词对应的payload集合
+        """
+        if not self._built:
+            self.build()
+        delta, terminal = self._delta, self._terminal
+        result = set()
+        node = 0
+        for char in text.lower():
+            node = delta[node].get(char, 0)
+            if node in terminal:
+                result |= terminal[node]
+        return result
+
+
+def _to_tuple(value) -> tuple:
+    if value is None:
+        return ()
+    if isinstance(value, (str, re.Pattern)):
+        return (value,)
+    return tuple(value)
+
+
+class MessageFilter(object):
+    """
+    消息过滤器
+    由插件信息中声明的条件构成，全部条件满足时才调用插件；
+    关键词与正则表达式任意一个命中即视为文本条件满足
+    """
+
+    def __init__(self, keywords=None, regex=None, at_me: bool = False, chat_type=None, sender_type=None,
+                 group_ids=None):
+        """
+        初始化消息过滤器，参数见 PluginInfo
+        """
+        self.keywords = tuple(k for k in _to_tuple(keywords) if k)
+        self.patterns = tuple(re.compile(p) if isinstance(p, str) else p for p in _to_tuple(regex))
+        self.at_me = at_me
+        self.chat_types = frozenset(_to_tuple(chat_type))
+        self.sender_types = frozenset(_to_tuple(sender_type))
+        self.group_ids = frozenset(_to_tuple(group_ids))
+
+    def is_empty(self) -> bool:
+        return not (self.keywords or self.patterns or self.at_me or self.chat_types or self.sender_types
+                    or self.group_ids)
+
+    def keyword_only(self) -> bool:
+        """
+        文本条件是否只有关键词，此时未命中关键词的消息可以直接跳过
+        """
+        return bool(self.keywords) and not self.patterns
+
+    def match(self, receive_message, keyword_hit: bool) -> bool:
+        """
+        判断消息是否满足条件
+        :param receive_message: 入站信息
+        :param keyword_hit:     关键词自动机是否命中了该过滤器的关键词
+        :return:
+        """
+        if self.chat_types and receive_message.msg_type not in self.chat_types:
+            return False
+        if self.sender_types and receive_message.sender_type not in self.sender_types:
+            return False
+        if self.group_ids and receive_message.group_id not in self.group_ids:
+            return False
+        if self.keywords or self.patterns:
+            if not receive_message.is_text:
+                return False
+            if not keyword_hit and not any(p.search(receive_message.text_content) for p in self.patterns):
+                return False
+        if self.at_me and not receive_message.at_me():
+            return False
+        return True
@@ -5,12 +5,14 @@ import os
 import time
 from enum import Enum
 
-from flask import request
+from flask import request, has_request_context
 
+from cache import LoadingCache
 from utils import dict_2_obj
 
-_USER_INFO_DICT = {}
 _SELF_OPEN_ID = os.getenv("SELF_OPEN_ID")
+# 事件签名校验所需的请求头
+SIGNATURE_HEADERS = ("X-Lark-Request-Timestamp", "X-Lark-Request-Nonce", "X-Lark-Signature")
 
 
 class UserInfo(object):
@@ -36,25 +38,42 @@ class UserInfo(object):
 
     @staticmethod
     def find_user_with_open_id(open_id, union_id: str = None, name: str = None):
-        user_info = _USER_INFO_DICT.get(open_id)
-        if not user_info or int(time.time()) - user_info.createAt > 3600:
-            from app import message_api_client
-            try:
-                user_info_data = message_api_client.get_user_info_with_open_id(open_id)
-                if user_info_data["data"] and user_info_data["data"]["user"]:
-                    data_user = user_info_data["data"]["user"]
-                    user_info = UserInfo(open_id,
-                                         data_user["union_id"],
-                                         data_user["name"],
-                                         data_user["description"])
-                    _USER_INFO_DICT[open_id] = user_info
-            except BaseException as e:
-                if name or union_id:
-                    user_info = UserInfo(open_id, union_id, name, "")
-                    _USER_INFO_DICT[open_id] = user_info
-
+        """
+        查找用户信息，优先从缓存中获取，见 USER_INFO_CACHE
+        :param union_id:    查询失败时使用的union_id
+        :param name:        查询失败时使用的用户名
+        :return: UserInfo，查询失败且没有提供union_id与用户名时返回None
+        """
+        user_info = USER_INFO_CACHE.get(open_id)
+        if user_info is None and (name or union_id):
+            user_info = UserInfo(open_id, union_id, name, "")
         return user_info
 
+    @staticmethod
+    def load_with_open_id(open_id):
+        """
+        通过接口查询用户信息
+        :return: UserInfo，用户不存在时返回None
+        """
+        from app import message_api_client
+        user_info_data = message_api_client.get_user_info_with_open_id(open_id)
+        if user_info_data["data"] and user_info_data["data"]["user"]:
+            data_user = user_info_data["data"]["user"]
+            return UserInfo(open_id,
+                            data_user["union_id"],
+                            data_user["name"],
+                            data_user["description"])
+        return None
+
+
+# 用户信息缓存：过期后先返回旧值并在后台刷新，查询失败的用户在 USER_CACHE_NEGATIVE_TTL 内不再查询
+USER_INFO_CACHE = LoadingCache(UserInfo.load_with_open_id,
+                               capacity=int(os.getenv("USER_CACHE_CAPACITY") or 10000),
+                               ttl=float(os.getenv("USER_CACHE_TTL") or 3600),
+                               stale_ttl=float(os.getenv("USER_CACHE_STALE_TTL") or 24 * 3600),
+                               negative_ttl=float(os.getenv("USER_CACHE_NEGATIVE_TTL") or 300),
+                               name="user-info")
+
 
 class Event(object):
     """
@@ -63,24 +82,82 @@ class Event(object):
     callback_handler = None
 
     # event base
-    def __init__(self, dict_data, token, encrypt_key):
+    def __init__(self, dict_data, token, encrypt_key, headers=None, body: bytes = None, verified: bool = False):
+        """
+        初始化事件
+        :param dict_data:   解密后的事件数据
+        :param token:       VERIFICATION_TOKEN
+        :param encrypt_key: ENCRYPT_KEY
+        :param headers:     请求头，为空时从flask.request中获取
+        :param body:        原始请求体，为空时从flask.request中获取
+        :param verified:    签名是否已校验（如 CallbackDecoder.verify_signature），已校验时不再重复计算
+        """
         # event check and init
         header = dict_data.get("header")
         event = dict_data.get("event")
         if header is None or event is None:
             raise InvalidEventException("request is not callback event(v2)")
+        self.raw = dict_data
         self.header = dict_2_obj(header)
         self.event = dict_2_obj(event)
-        self._validate(token, encrypt_key)
+        self._validate(token, encrypt_key, headers, body, verified)
         self._event_type = self.header.event_type
 
-    def _validate(self, token, encrypt_key):
+    def snapshot(self) -> dict:
+        """
+        获取可以序列化的事件快照，用于在其他进程中还原事件，见 restore_snapshot
+        """
+        return {"type": "event", "raw": self.raw}
+
+    @staticmethod
+    def _restore(raw: dict):
+        # 快照中的事件已在主进程中校验过
+        event = Event.__new__(Event)
+        event.raw = raw
+        event.header = dict_2_obj(raw["header"])
+        event.event = dict_2_obj(raw["event"])
+        event._event_type = event.header.event_type
+        return event
+
+    @staticmethod
+    def from_raw(body: bytes, headers, token, encrypt_key, decoder=None):
+        """
+        从原始请求体与请求头构造事件，不依赖flask请求上下文，可以在工作线程中执行
+        :param body:        原始请求体
+        :param headers:     请求头，至少包含 SIGNATURE_HEADERS，见 capture_headers
+        :param token:       VERIFICATION_TOKEN
+        :param encrypt_key: ENCRYPT_KEY
+        :param decoder:     回调解码器(ingest.CallbackDecoder)，批量构造时应传入以复用解密上下文
+        :return:
+        """
+        if decoder is None:
+            from ingest import CallbackDecoder
+            decoder = CallbackDecoder(encrypt_key)
+        verified = decoder.verify_signature(body, headers)
+        return Event(decoder.decode(body), token, encrypt_key, headers=headers, body=body, verified=verified)
+
+    @staticmethod
+    def capture_headers(headers) -> dict:
+        """
+        提取签名校验所需的请求头，便于将请求放入队列后在其他线程中构造事件
+        """
+        return {name: headers.get(name) for name in SIGNATURE_HEADERS if headers.get(name) is not None}
+
+    def _validate(self, token, encrypt_key, headers=None, body: bytes = None, verified: bool = False):
         if self.header.token != token:
             raise InvalidEventException("invalid token")
-        timestamp = request.headers.get("X-Lark-Request-Timestamp")
-        nonce = request.headers.get("X-Lark-Request-Nonce")
-        signature = request.headers.get("X-Lark-Signature")
-        body = request.data
+        if verified:
+            return
+        if headers is None or body is None:
+            if not has_request_context():
+                raise InvalidEventException("headers and body are necessary outside of request context")
+            headers = request.headers if headers is None else headers
+            body = request.data if body is None else body
+        timestamp = headers.get("X-Lark-Request-Timestamp")
+        nonce = headers.get("X-Lark-Request-Nonce")
+        signature = headers.get("X-Lark-Signature")
+        if timestamp is None or nonce is None or signature is None:
+            raise InvalidEventException("signature is missing in event")
         bytes_b1 = (timestamp + nonce + encrypt_key).encode("utf-8")
         bytes_b = bytes_b1 + body
         h = hashlib.sha256(bytes_b)
@@ -96,7 +173,20 @@ class ReceiveMessage(object):
     请求信息封装
     """
 
-    def __init__(self, event: Event):
+    @staticmethod
+    def from_raw(body: bytes, headers, token, encrypt_key, decoder=None):
+        """
+        从原始请求体与请求头构造消息，参数见 Event.from_raw
+        """
+        return ReceiveMessage(Event.from_raw(body, headers, token, encrypt_key, decoder))
+
+    def __init__(self, event: Event, sender_info: UserInfo = None, lookup_sender: bool = True):
+        """
+        初始化消息
+        :param event:           事件
+        :param sender_info:     发送者信息，为空且lookup_sender为True时查询
+        :param lookup_sender:   是否查询发送者信息
+        """
         self.event = event
         self.message = event.event.message
         self.msg_type = event.event.message.chat_type
@@ -120,8 +210,17 @@ class ReceiveMessage(object):
         self.sender_open_id = event.event.sender.sender_id.open_id
         self.sender_id = event.event.sender.sender_id
         self.sender_type = event.event.sender.sender_type
-        self.sender_info = UserInfo.find_user_with_open_id(self.sender_open_id,
-                                                           name=self.sender_id.name if self.sender_id else None)
+        self.sender_info = sender_info
+        if sender_info is None and lookup_sender:
+            self.sender_info = UserInfo.find_user_with_open_id(self.sender_open_id,
+                                                               name=self.sender_id.name if self.sender_id else None)
+
+    def snapshot(self) -> dict:
+        """
+        获取可以序列化的消息快照（原始事件数据与发送者信息），用于在其他进程中还原消息，见 restore_snapshot
+        """
+        return {"type": "receive_message", "raw": self.event.raw,
+                "sender_info": vars(self.sender_info) if self.sender_info else None}
 
     def at_me(self) -> bool:
         if self.mentions:
@@ -131,6 +230,23 @@ class ReceiveMessage(object):
         return False
 
 
+def restore_snapshot(snapshot: dict):
+    """
+    从快照还原事件或消息，不会重新校验事件与查询发送者信息
+    :param snapshot: Event.snapshot 或 ReceiveMessage.snapshot 的返回值
+    :return: Event 或 ReceiveMessage
+    """
+    event = Event._restore(snapshot["raw"])
+    if snapshot["type"] != "receive_message":
+        return event
+    sender_info = None
+    if snapshot.get("sender_info"):
+        data = snapshot["sender_info"]
+        sender_info = UserInfo(data["open_id"], data["union_id"], data["username"], data["description"])
+        sender_info.createAt = data.get("createAt", sender_info.createAt)
+    return ReceiveMessage(event, sender_info, lookup_sender=False)
+
+
 class ApiRequest(object):
     """
     API请求
@@ -148,12 +264,16 @@ class ApiRequest(object):
         self.is_json: bool = False
         if req.is_json:
             self.is_json = True
-            self.json = request.get_json()
+            self.json = req.get_json()
         elif self.data and chr(self.data[0]) in ['{', '[']:
             self.is_json = True
             self.json = json.loads(self.data)
         self.method: str = req.method
         self.request = req
+        # 路径参数，如API路径 /hook/{name} 中的 name
+        self.path_params: dict = {}
+        # 匹配到的API插件
+        self.plugin = None
 
     def is_post(self):
         return self.method.upper() == "POST"
@@ -0,0 +1,308 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import utils
+from api import MessageApiClient
+from models import RenderMessage
+from scheduler import OutboundScheduler, ENDPOINT_MESSAGE, ENDPOINT_REPLY, KIND_OPEN_ID, KIND_CHAT_ID, KIND_REPLY
+
+logger = utils.get_logger()
+
+DEFAULT_WORKERS = 4
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_POLL_INTERVAL = 0.5
+DEFAULT_BACKOFF_BASE = 2.0
+DEFAULT_BACKOFF_MAX = 600.0
+# 已发送消息的去重键保留时间(秒)
+DEFAULT_DEDUP_RETENTION = 86400
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+    id          INTEGER PRIMARY KEY AUTOINCREMENT,
+    dedup_key   TEXT UNIQUE,
+    kind        TEXT NOT NULL,
+    target      TEXT,
+    body        TEXT NOT NULL,
+    attempts    INTEGER NOT NULL DEFAULT 0,
+    next_at     REAL NOT NULL,
+    last_error  TEXT,
+    created_at  REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_outbox_next_at ON outbox (next_at);
+CREATE TABLE IF NOT EXISTS outbox_sent (
+    dedup_key   TEXT PRIMARY KEY,
+    sent_at     REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS outbox_dead (
+    id          INTEGER PRIMARY KEY,
+    dedup_key   TEXT,
+    kind        TEXT NOT NULL,
+    target      TEXT,
+    body        TEXT NOT NULL,
+    attempts    INTEGER NOT NULL,
+    last_error  TEXT,
+    created_at  REAL NOT NULL,
+    dead_at     REAL NOT NULL
+);
+"""
+
+
+class Outbox(object):
+    """
+    持久化出站消息队列
+    消息先写入SQLite(WAL)再由发送线程池投递，进程重启后未投递的消息会继续发送（至少一次）；
+    入队只追加到内存缓冲区，由后台线程批量提交，发送失败的消息按指数退避重试，超过次数后转入死信表
+    """
+
+    def __init__(self, api_client: MessageApiClient, db_path: str,
+                 workers: int = DEFAULT_WORKERS,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 scheduler: OutboundScheduler = None,
+                 poll_interval: float = DEFAULT_POLL_INTERVAL,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE,
+                 backoff_max: float = DEFAULT_BACKOFF_MAX,
+                 dedup_retention: int = DEFAULT_DEDUP_RETENTION):
+        """
+        初始化出站消息队列
+        :param api_client:      飞书API
+        :param db_path:         数据库文件路径
+        :param workers:         发送线程数
+        :param max_attempts:    最大投递次数，超过后转入死信表
+        :param scheduler:       出站消息调度器，提供时通过调度器限流发送
+        :param poll_interval:   检查待重试消息的间隔(秒)
+        :param backoff_base:    重试的初始等待时间(秒)
+        :param backoff_max:     重试的最大等待时间(秒)
+        :param dedup_retention: 已发送消息的去重键保留时间(秒)
+        """
+        self._api_client = api_client
+        self._db_path = db_path
+        self._workers = workers
+        self._max_attempts = max_attempts
+        self._scheduler = scheduler
+        self._poll_interval = poll_interval
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._dedup_retention = dedup_retention
+        self._cond = threading.Condition()
+        self._db_lock = threading.Lock()
+        self._buffer = []
+        self._results = []
+        self._in_flight = set()
+        self._closed = False
+        self._enqueued_seq = 0
+        self._committed_seq = 0
+        # 统计信息
+        self._sent_count = 0
+        self._retry_count = 0
+        self._dead_count = 0
+        self._commit_count = 0
+        self._conn = self._connect()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbox")
+        self._thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self._thread.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self._db_path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def send_message_with_open_id(self, msg: RenderMessage, dedup_key: str = None):
+        self.enqueue(KIND_OPEN_ID, msg.receive_id, msg.json(), dedup_key)
+
+    def send_message_with_group_id(self, msg: RenderMessage, dedup_key: str = None):
+        self.enqueue(KIND_CHAT_ID, msg.receive_id, msg.json(), dedup_key)
+
+    def reply_message(self, messages_id: str, msg: RenderMessage, dedup_key: str = None):
+        self.enqueue(KIND_REPLY, messages_id, msg.json(), dedup_key)
+
+    def enqueue(self, kind: str, target: str, body: dict, dedup_key: str = None):
+        """
+        消息入队，仅写入内存缓冲区，由后台线程批量提交
+        需要确认消息已落盘时调用flush()
+        :param kind:        KIND_OPEN_ID / KIND_CHAT_ID / KIND_REPLY
+        :param target:      接收者ID，回复消息时为被回复的消息ID
+        :param body:        RenderMessage.json()的结果
+        :param dedup_key:   去重键，相同去重键的消息只会发送一次
+        :return:
+        """
+        row = (dedup_key, kind, target, json.dumps(body, ensure_ascii=False), time.time())
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Outbox is closed")
+            self._buffer.append(row)
+            self._enqueued_seq += 1
+            if len(self._buffer) == 1:
+                self._cond.notify_all()
+
+    def flush(self, timeout: float = None) -> bool:
+        """
+        等待已入队的消息提交到数据库
+        :param timeout: 超时时间(秒)
+        :return: 是否在超时前完成
+        """
+        with self._cond:
+            target = self._enqueued_seq
+            self._cond.notify_all()
+            return self._cond.wait_for(lambda: self._committed_seq >= target, timeout)
+
+    def stats(self) -> dict:
+        with self._cond:
+            stats = {
+                "buffered": len(self._buffer),
+                "in_flight": len(self._in_flight),
+                "sent_count": self._sent_count,
+                "retry_count": self._retry_count,
+                "dead_count": self._dead_count,
+                "commit_count": self._commit_count
+            }
+        with self._db_lock:
+            stats["queue_depth"] = self._conn.execute("SELECT COUNT(*) FROM outbox").fetchone()[0]
+            stats["dead_letter_count"] = self._conn.execute("SELECT COUNT(*) FROM outbox_dead").fetchone()[0]
+        return stats
+
+    def dead_letters(self, limit: int = 100) -> list:
+        with self._db_lock:
+            cursor = self._conn.execute("SELECT id, dedup_key, kind, target, body, attempts, last_error, dead_at "
+                                        "FROM outbox_dead ORDER BY id DESC LIMIT ?", (limit,))
+            columns = [c[0] for c in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    def close(self, timeout: float = 10):
+        """
+        停止投递，提交缓冲区中的消息并等待正在发送的消息完成
+        数据库连接由后台线程在退出时关闭，超时后后台线程仍在运行时不关闭连接，未完成的消息在下次启动后继续投递
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("出站消息队列未能在%s秒内完成投递，剩余消息将在下次启动后继续投递" % timeout)
+            self._pool.shutdown(wait=False)
+        else:
+            self._pool.shutdown(wait=True)
+
+    def _run(self):
+        try:
+            self._loop()
+        finally:
+            with self._db_lock:
+                self._conn.close()
+
+    def _loop(self):
+        last_purge = 0.0
+        while True:
+            with self._cond:
+                if not self._buffer and not self._results and not self._closed:
+                    self._cond.wait(self._poll_interval)
+                pending, self._buffer = self._buffer, []
+                results, self._results = self._results, []
+                seq = self._enqueued_seq
+                closed = self._closed
+                capacity = 0 if closed else self._workers * 2 - len(self._in_flight)
+                exclude = list(self._in_flight)
+            # 同一个事务内完成入队、结果回写与领取，批量提交；数据库操作不持有入队锁
+            now = time.time()
+            with self._db_lock:
+                try:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    if pending:
+                        self._insert(pending)
+                    for row_id, error in results:
+                        self._apply_result(now, row_id, error)
+                    claimed = self._claim(now, capacity, exclude) if capacity > 0 else []
+                    if now - last_purge > 60:
+                        self._conn.execute("DELETE FROM outbox_sent WHERE sent_at < ?",
+                                           (now - self._dedup_retention,))
+                        last_purge = now
+                    self._conn.execute("COMMIT")
+                except BaseException as e:
+                    self._conn.execute("ROLLBACK")
+                    logger.error("出站消息队列提交失败: %s" % e)
+                    with self._cond:
+                        # 保留未提交的数据，下次循环重试
+                        self._buffer = pending + self._buffer
+                        self._results = results + self._results
+                    time.sleep(self._poll_interval)
+                    continue
+            with self._cond:
+                self._commit_count += 1
+                self._committed_seq = seq
+                self._in_flight.update(row[0] for row in claimed)
+                self._cond.notify_all()
+                if closed and not self._in_flight and not self._results and not self._buffer:
+                    return
+            for row in claimed:
+                self._pool.submit(self._deliver, *row)
+            if closed:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._results or not self._in_flight, self._poll_interval)
+
+    def _insert(self, rows: list):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR IGNORE INTO outbox (dedup_key, kind, target, body, next_at, created_at) "
+            "SELECT ?, ?, ?, ?, ?, ? WHERE ? IS NULL OR NOT EXISTS "
+            "(SELECT 1 FROM outbox_sent WHERE dedup_key = ?)",
+            [(dedup_key, kind, target, body, now, created_at, dedup_key, dedup_key)
+             for dedup_key, kind, target, body, created_at in rows])
+
+    def _claim(self, now: float, limit: int, exclude: list) -> list:
+        sql = "SELECT id, kind, target, body, attempts FROM outbox WHERE next_at <= ?"
+        if exclude:
+            sql += " AND id NOT IN (%s)" % ",".join("?" * len(exclude))
+        sql += " ORDER BY next_at, id LIMIT ?"
+        return self._conn.execute(sql, [now] + exclude + [limit]).fetchall()
+
+    def _apply_result(self, now: float, row_id: int, error: BaseException):
+        if error is None:
+            self._conn.execute("INSERT OR REPLACE INTO outbox_sent (dedup_key, sent_at) "
+                               "SELECT dedup_key, ? FROM outbox WHERE id = ? AND dedup_key IS NOT NULL",
+                               (now, row_id))
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            self._sent_count += 1
+            return
+        self._conn.execute("UPDATE outbox SET attempts = attempts + 1, last_error = ? WHERE id = ?",
+                           (str(error), row_id))
+        attempts = self._conn.execute("SELECT attempts FROM outbox WHERE id = ?", (row_id,)).fetchone()[0]
+        if attempts >= self._max_attempts:
+            self._conn.execute("INSERT INTO outbox_dead (id, dedup_key, kind, target, body, attempts, last_error, "
+                               "created_at, dead_at) SELECT id, dedup_key, kind, target, body, attempts, last_error, "
+                               "created_at, ? FROM outbox WHERE id = ?", (now, row_id))
+            self._conn.execute("DELETE FROM outbox WHERE id = ?", (row_id,))
+            self._dead_count += 1
+            logger.error("出站消息【%s】投递%s次失败，已转入死信表: %s" % (row_id, attempts, error))
+            return
+        delay = getattr(error, "retry_after", None)
+        if delay is None:
+            delay = min(self._backoff_max, self._backoff_base * (2 ** (attempts - 1)))
+            delay += random.uniform(0, delay / 2)
+        self._conn.execute("UPDATE outbox SET next_at = ? WHERE id = ?", (now + delay, row_id))
+        self._retry_count += 1
+
+    def _deliver(self, row_id: int, kind: str, target: str, body: str, attempts: int):
+        error = None
+        try:
+            req_body = json.loads(body)
+            if kind == KIND_REPLY:
+                fn, args, endpoint = self._api_client.reply_message_json, (target, req_body), ENDPOINT_REPLY
+            else:
+                fn, args, endpoint = self._api_client.send_message_json, (kind, req_body), ENDPOINT_MESSAGE
+            if self._scheduler:
+                self._scheduler.submit(endpoint, target, fn, *args).result()
+            else:
+                fn(*args)
+        except BaseException as e:
+            error = e
+        with self._cond:
+            self._in_flight.discard(row_id)
+            self._results.append((row_id, error))
+            self._cond.notify_all()
@@ -11,7 +11,10 @@ PLUGIN_INFO = PluginInfo(
     api_path="/plugin/example",
     # 插件类型
     plugin_type=PluginType.EVENT,
-    weight=500
+    weight=500,
+    # 过滤条件（可选），仅在消息满足全部条件时调用插件：包含关键词hello且@了机器人
+    keywords=["hello"],
+    at_me=True
 )
 
 
@@ -26,9 +29,7 @@ def handler_event(receive_message: ReceiveMessage, tools: PluginManagerTools):
     :param tools: 插件工具
     :return:
     """
-    if receive_message.is_text and "hello" in receive_message.text_content.lower() and receive_message.at_me():
-        tools.api_client.reply_message(receive_message.msg_id, RenderMessage.text("Hi!"))
-    pass
+    tools.api_client.reply_message(receive_message.msg_id, RenderMessage.text("Hi!"))
 
 
 def handler_api(api_request: ApiRequest, tools: PluginManagerTools):
@@ -1,15 +1,24 @@
+from command import CommandEngine
 from enums import LarkEvent
 from manager import PluginInfo, PluginManagerTools
 from models import ReceiveMessage
 
 PLUGIN_INFO: PluginInfo = PluginInfo(plugin_name="Command处理",
                                      plugin_event=LarkEvent.IM_MESSAGE_RECEIVE,
-                                     weight=0)
+                                     weight=0,
+                                     # 只处理以 / 开头的消息（可以先@机器人，群聊中未@机器人时不回复未知命令）
+                                     regex=r"^\s*(@_user_\d+\s*)*/")
 
 
 def init(tools: PluginManagerTools):
-    tools.ok()
+    """
+    初始化命令引擎，其他插件依赖本插件（depends=["Command处理"]）后在init中注册命令：
+    tools.command_engine.register("/deploy <env:dev|prod> [--force]", deploy, "部署服务")
+    """
+    # 重新加载本插件时保留其他插件已注册的命令
+    if getattr(tools, "command_engine", None) is None:
+        setattr(tools, "command_engine", CommandEngine())
 
 
 def handler_event(receive_message: ReceiveMessage, tools: PluginManagerTools):
-    pass
\ No newline at end of file
+    tools.command_engine.dispatch(receive_message, tools)
@@ -1,20 +1,35 @@
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
-import app
+from api import MessageApiClient
 from enums import ReceiveType, PluginType
 from manager import PluginInfo, PluginManagerTools, ConfigManger
+from models import RenderMessage
+from scheduler import OutboundScheduler, ENDPOINT_MESSAGE
+from store import REMOVED
 from utils import singleton
 
 PLUGIN_INFO: PluginInfo = PluginInfo(plugin_name="Topic管理", weight=1000, plugin_type=PluginType.UTILS)
 
 _TOPIC_MANAGER_KEY = "topic_data"
+_INIT_KEY = "__init__"
+# 不使用出站消息调度器时，发布消息的并发数
+DEFAULT_PUBLISH_CONCURRENCY = 16
+_RECEIVE_ID_TYPES = {ReceiveType.USER: "open_id", ReceiveType.GROUP: "chat_id"}
+# 主题层级分隔符与通配符：* 匹配一层，# 匹配零或多层
+TOPIC_SEPARATOR = "."
+WILDCARD_ONE = "*"
+WILDCARD_ANY = "#"
+# 主题匹配结果的最大缓存数量
+_MATCH_CACHE_SIZE = 4096
 
 
 def init(tools: PluginManagerTools):
-    manager = TopicManager(tools.config_manger)
+    manager = TopicManager(tools.config_manger, tools.api_client, tools.outbound_scheduler)
     setattr(tools, "topic_manager", manager)
     if not manager.CONFIG_MANGER.get(_TOPIC_MANAGER_KEY):
-        manager.CONFIG_MANGER.put(_TOPIC_MANAGER_KEY, {"__init__": time.strftime("%Y-%m-%d %H:%M:%S")})
+        manager.CONFIG_MANGER.put(_TOPIC_MANAGER_KEY, {_INIT_KEY: time.strftime("%Y-%m-%d %H:%M:%S")})
 
 
 class TopicSubscriber:
@@ -30,37 +45,430 @@ class TopicSubscriber:
             "name": self.user_name
         }
 
+    @property
+    def key(self) -> str:
+        return _subscriber_key(self.open_id, self.receive_type.value)
+
+    @staticmethod
+    def load(data):
+        return TopicSubscriber(data["id"], ReceiveType(data["type"]), data.get("name"))
+
+
+def _subscriber_key(subscriber_id: str, receive_type: str) -> str:
+    # 同一ID可能同时作为用户与群组订阅，按 类型:ID 保存
+    return "%s:%s" % (receive_type, subscriber_id)
+
+
+def _subscriber_keys(subscriber_id: str, receive_type: ReceiveType = None) -> list:
+    types = list(ReceiveType) if receive_type is None else [receive_type]
+    return [_subscriber_key(subscriber_id, t.value) for t in types]
+
+
+class _TopicNode(object):
+    __slots__ = ("children", "topic")
+
+    def __init__(self):
+        self.children = {}
+        # 在此结束的订阅主题
+        self.topic = None
+
+
+class TopicTrie(object):
+    """
+    主题前缀树
+    订阅主题按 . 分层，可以使用通配符：alerts.*.db 匹配 alerts.prod.db，alerts.# 匹配 alerts 及其下的全部主题；
+    查找匹配的订阅主题只需沿发布主题的各层向下查找，与订阅主题的数量无关
+    """
+
+    def __init__(self):
+        self._root = _TopicNode()
+
+    def add(self, topic: str):
+        node = self._root
+        for segment in topic.split(TOPIC_SEPARATOR):
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _TopicNode()
+            node = child
+        node.topic = topic
+
+    def remove(self, topic: str):
+        path = []
+        node = self._root
+        for segment in topic.split(TOPIC_SEPARATOR):
+            path.append((node, segment))
+            node = node.children.get(segment)
+            if node is None:
+                return
+        node.topic = None
+        # 删除不再使用的节点
+        for parent, segment in reversed(path):
+            child = parent.children[segment]
+            if child.topic is not None or child.children:
+                break
+            del parent.children[segment]
+
+    def match(self, topic: str) -> list:
+        """
+        查找与发布主题匹配的全部订阅主题
+        :param topic: 发布主题，不能包含通配符
+        """
+        result = []
+        self._match(self._root, topic.split(TOPIC_SEPARATOR), 0, result)
+        return result
+
+    def _match(self, node: _TopicNode, segments: list, index: int, result: list):
+        any_node = node.children.get(WILDCARD_ANY)
+        if any_node is not None:
+            # # 可以匹配剩余的任意层，包括零层
+            for i in range(index, len(segments) + 1):
+                self._match(any_node, segments, i, result)
+        if index == len(segments):
+            if node.topic is not None and node.topic not in result:
+                result.append(node.topic)
+            return
+        for key in (segments[index], WILDCARD_ONE):
+            child = node.children.get(key)
+            if child is not None:
+                self._match(child, segments, index + 1, result)
+
+
+def _is_pattern(topic: str) -> bool:
+    return any(segment in (WILDCARD_ONE, WILDCARD_ANY) for segment in topic.split(TOPIC_SEPARATOR))
+
+
+def _check_topic(topic: str):
+    # 主题的每一层不能为空，通配符只能单独作为一层
+    for segment in topic.split(TOPIC_SEPARATOR):
+        if not segment or (segment not in (WILDCARD_ONE, WILDCARD_ANY)
+                           and (WILDCARD_ONE in segment or WILDCARD_ANY in segment)):
+            raise ValueError("invalid topic: %s" % topic)
+
+
+class PublishResult(object):
+    """
+    发布结果
+    results为每个订阅者的发送结果：{"id", "type", "ok", "error", "latency"}，latency为从提交到完成的时间(秒)
+    """
+
+    def __init__(self, topic_name: str, results: list, elapsed: float):
+        self.topic_name = topic_name
+        self.results = results
+        self.elapsed = elapsed
+        self.total = len(results)
+        self.failures = [r for r in results if not r["ok"]]
+        self.sent = self.total - len(self.failures)
+
+    @property
+    def ok(self) -> bool:
+        return not self.failures
+
+    def latency(self, percent: float) -> float:
+        """
+        获取发送耗时的百分位数(秒)，如 latency(99)
+        """
+        latencies = sorted(r["latency"] for r in self.results if r["latency"] is not None)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * percent / 100))]
+
+    def dump(self) -> dict:
+        return {
+            "topic": self.topic_name,
+            "total": self.total,
+            "sent": self.sent,
+            "failed": len(self.failures),
+            "elapsed": self.elapsed,
+            "latency_p50": self.latency(50),
+            "latency_p99": self.latency(99),
+            "failures": self.failures
+        }
+
 
 @singleton
 class TopicManager(object):
+    """
+    订阅主题管理
+    每个主题保存为 类型:订阅者ID -> 订阅者 的映射，订阅、取消订阅与判断是否订阅均为按ID查找，
+    不指定订阅者类型时匹配用户与群组两种类型；
+    内存中另外维护 类型:订阅者ID -> 主题集合 的反向索引，用于查询订阅者订阅的全部主题。
+    批量操作的全部修改只写入一次配置。
+    配置为写时复制的不可变快照（见 ConfigManger），每次订阅或取消订阅都要复制整个主题的订阅者映射，
+    开销与该主题的订阅者数量成正比，大量修改时应使用批量操作分摊复制的开销。
+    主题可以分层并使用通配符订阅（见 TopicTrie），发布时通过主题前缀树查找匹配的订阅主题，
+    每个发布主题的订阅者会被缓存，订阅变化时清空缓存
+    """
 
-    def __init__(self, config_manager: ConfigManger):
+    def __init__(self, config_manager: ConfigManger, api_client: MessageApiClient = None,
+                 outbound_scheduler: OutboundScheduler = None):
         if config_manager:
             self.CONFIG_MANGER = config_manager
+            self._api_client = api_client
+            self._outbound_scheduler = outbound_scheduler
+            self._topics = config_manager.subtree(_TOPIC_MANAGER_KEY)
+            self._lock = threading.RLock()
+            # 订阅者ID -> 订阅的主题，值为不可变集合，读取时无需加锁
+            self._reverse = {}
+            self._trie = TopicTrie()
+            # 发布主题 -> 订阅者，_generation 在订阅变化时增加
+            self._match_cache = {}
+            self._generation = 0
+            self._migrate()
+            for topic, subscribers in self._topic_items():
+                self._trie.add(topic)
+                for key in subscribers:
+                    self._reverse[key] = self._reverse.get(key, frozenset()) | {topic}
+
+    def _invalidate(self):
+        self._generation += 1
+        self._match_cache = {}
 
-    def _get_topic_data(self) -> dict:
-        data = self.CONFIG_MANGER.get(_TOPIC_MANAGER_KEY)
-        return self.CONFIG_MANGER.get(_TOPIC_MANAGER_KEY, {})
+    def _migrate(self):
+        # 旧版本的主题保存为订阅者列表，转换为按 类型:ID 保存并去除重复的订阅者
+        changes = {}
+        for topic, subscribers in self._topics.snapshot().items():
+            if isinstance(subscribers, tuple):
+                changes[topic] = {_subscriber_key(s["id"], s["type"]): dict(s) for s in subscribers
+                                  if "id" in s and "type" in s}
+            elif topic != _INIT_KEY and any(key != _subscriber_key(s["id"], s["type"])
+                                            for key, s in subscribers.items()):
+                # 按ID保存的主题
+                changes[topic] = {_subscriber_key(s["id"], s["type"]): dict(s) for s in subscribers.values()}
+        if changes:
+            self._topics.put_many(changes)
+
+    def _get_topic_data(self):
+        return self._topics.snapshot()
+
+    def _topic_items(self):
+        return [(topic, subscribers) for topic, subscribers in self._get_topic_data().items()
+                if topic != _INIT_KEY]
 
     def get_subscribers(self, topic_name: str) -> list:
-        return self._get_topic_data().get(topic_name, [])
+        """
+        获取主题的全部订阅者
+        :return: [TopicSubscriber, ...]
+        """
+        return [TopicSubscriber.load(s) for s in self._get_topic_data().get(topic_name, {}).values()]
+
+    def is_subscribed(self, topic_name: str, subscriber_id: str, receive_type: ReceiveType = None) -> bool:
+        subscribers = self._get_topic_data().get(topic_name, ())
+        return any(key in subscribers for key in _subscriber_keys(subscriber_id, receive_type))
+
+    def subscriber_count(self, topic_name: str) -> int:
+        return len(self._get_topic_data().get(topic_name, ()))
+
+    def subscribed_topics(self, subscriber_id: str, receive_type: ReceiveType = None) -> frozenset:
+        """
+        获取订阅者订阅的全部主题
+        """
+        return frozenset().union(*(self._reverse.get(key, ()) for key in _subscriber_keys(subscriber_id, receive_type)))
 
     def add_subscriber(self, topic_name: str, subscriber: TopicSubscriber):
-        topic_data: dict = self._get_topic_data()
-        subscribers: list = topic_data.get(topic_name, [])
-        subscribers.append(subscriber)
-        topic_data[topic_name] = subscribers
-        TopicManager.CONFIG_MANGER.save()
+        """
+        订阅主题，已订阅时更新订阅者信息
+        """
+        self.add_subscribers(topic_name, [subscriber])
+
+    def add_subscribers(self, topic_name: str, subscribers: list):
+        """
+        批量订阅主题，全部订阅只写入一次配置，主题的订阅者映射也只复制一次
+        :param topic_name: 主题，可以使用通配符，见 TopicTrie
+        """
+        _check_topic(topic_name)
+        if not subscribers:
+            return
+        with self._lock:
+            self._topics.apply({(topic_name, s.key): s.dump() for s in subscribers})
+            self._trie.add(topic_name)
+            self._invalidate()
+            for s in subscribers:
+                self._reverse[s.key] = self._reverse.get(s.key, frozenset()) | {topic_name}
+
+    def remove_subscriber(self, topic_name: str, subscriber_id: str, receive_type: ReceiveType = None) -> bool:
+        """
+        取消订阅主题
+        :return: 是否订阅过该主题
+        """
+        return bool(self.remove_subscribers(topic_name, [subscriber_id], receive_type))
+
+    def remove_subscribers(self, topic_name: str, subscriber_ids: list, receive_type: ReceiveType = None) -> int:
+        """
+        批量取消订阅主题，全部修改只写入一次配置，主题的订阅者映射也只复制一次
+        :param receive_type: 订阅者类型，为空时取消该ID的用户与群组订阅
+        :return: 取消订阅的数量
+        """
+        with self._lock:
+            subscribers = self._get_topic_data().get(topic_name, {})
+            keys = [key for i in set(subscriber_ids) for key in _subscriber_keys(i, receive_type)
+                    if key in subscribers]
+            self._topics.apply({(topic_name, key): REMOVED for key in keys})
+            self._invalidate()
+            for key in keys:
+                self._discard_reverse(key, topic_name)
+        return len(keys)
+
+    def unsubscribe_all(self, subscriber_id: str, receive_type: ReceiveType = None) -> frozenset:
+        """
+        取消订阅者的全部订阅，如机器人被移出群组时
+        :return: 取消订阅的主题
+        """
+        topics = frozenset()
+        with self._lock:
+            for key in _subscriber_keys(subscriber_id, receive_type):
+                removed = self._reverse.pop(key, frozenset())
+                self._topics.apply({(topic, key): REMOVED for topic in removed})
+                topics |= removed
+            self._invalidate()
+        return topics
+
+    def _discard_reverse(self, key: str, topic_name: str):
+        topics = self._reverse.get(key, frozenset()) - {topic_name}
+        if topics:
+            self._reverse[key] = topics
+        else:
+            self._reverse.pop(key, None)
 
     def topic_list(self):
-        topic_data: dict = self._get_topic_data()
-        return topic_data.keys()
+        return [topic for topic, subscribers in self._topic_items()]
 
     def has_topic(self, topic):
-        if self._get_topic_data().get(topic):
-            return True
-        return False
+        return topic != _INIT_KEY and topic in self._get_topic_data()
 
     def create_topic(self, topic):
-        self._get_topic_data()[topic] = []
-        app.config_manger.save()
+        _check_topic(topic)
+        with self._lock:
+            if not self.has_topic(topic):
+                self._topics.put(topic, {})
+                self._trie.add(topic)
+
+    def remove_topic(self, topic):
+        """
+        删除主题及其全部订阅
+        """
+        with self._lock:
+            subscribers = self._get_topic_data().get(topic)
+            if subscribers is None:
+                return
+            self._topics.remove(topic)
+            self._trie.remove(topic)
+            self._invalidate()
+            for key in subscribers:
+                self._discard_reverse(key, topic)
+
+    def match_topics(self, topic_name: str) -> list:
+        """
+        查找与发布主题匹配的全部订阅主题，包括主题本身与匹配的通配符主题
+        """
+        return self._trie.match(topic_name)
+
+    def match_subscribers(self, topic_name: str) -> tuple:
+        """
+        获取发布主题的全部订阅者（包括通配符主题的订阅者），同一订阅者只出现一次
+        :return: 订阅者数据的元组，见 TopicSubscriber.dump
+        """
+        cached = self._match_cache.get(topic_name)
+        if cached is not None:
+            return cached
+        generation = self._generation
+        topic_data = self._get_topic_data()
+        subscribers = {}
+        for topic in self.match_topics(topic_name):
+            subscribers.update(topic_data.get(topic, {}))
+        result = tuple(subscribers.values())
+        with self._lock:
+            if generation == self._generation:
+                if len(self._match_cache) >= _MATCH_CACHE_SIZE:
+                    self._match_cache = {}
+                self._match_cache[topic_name] = result
+        return result
+
+    def publish(self, topic_name: str, message: RenderMessage, use_scheduler: bool = True,
+                concurrency: int = DEFAULT_PUBLISH_CONCURRENCY, timeout: float = None) -> PublishResult:
+        """
+        向主题的全部订阅者（包括匹配的通配符主题的订阅者）发送消息
+        消息只序列化一次，按订阅者替换接收者ID后并发发送；有出站消息调度器时两种发送方式都受调度器的频率限制，
+        触发频率限制时自动重试，发送速度由 OUTBOUND_ENDPOINT_RATE 决定
+        :param topic_name:      主题，不能包含通配符
+        :param message:         消息，接收者ID无需设置
+        :param use_scheduler:   是否通过出站消息调度器的等待队列发送，为False或没有调度器时使用线程池直接发送，
+                                有调度器时直接发送同样从调度器的令牌桶获取令牌（见 OutboundScheduler.call）
+        :param concurrency:     直接发送时的并发数
+        :param timeout:         等待发送完成的时间(秒)，为空时一直等待。超时后未开始发送的消息被取消，error为"timeout"，
+                                可以重新发送；正在发送的消息error为"in_flight"，可能仍会送达，重新发送可能重复
+        :return: PublishResult，超时后不再变化
+        """
+        if _is_pattern(topic_name):
+            raise ValueError("cannot publish to a wildcard topic: %s" % topic_name)
+        started_at = time.monotonic()
+        subscribers = self.match_subscribers(topic_name)
+        body = message.json()
+        results = [{"id": s["id"], "type": s["type"], "ok": False, "error": None, "latency": None}
+                   for s in subscribers]
+        if not results:
+            return PublishResult(topic_name, results, 0.0)
+
+        def send(result: dict):
+            return self._api_client.send_message_json(_RECEIVE_ID_TYPES[ReceiveType(result["type"])],
+                                                      {**body, "receive_id": result["id"]})
+
+        # 超时后不再修改发送结果，结果以超时时的状态为准
+        lock = threading.Lock()
+        closed = [False]
+
+        def record(result: dict, submit_at: float, error: BaseException = None):
+            result["latency"] = time.monotonic() - submit_at
+            result["ok"] = error is None
+            result["error"] = None if error is None else str(error)
+
+        def finish(result: dict, submit_at: float, error: BaseException = None):
+            with lock:
+                if not closed[0]:
+                    record(result, submit_at, error)
+
+        pool = None
+        submit_times = []
+        if use_scheduler and self._outbound_scheduler is not None:
+            futures = []
+            for result in results:
+                submit_at = time.monotonic()
+                submit_times.append(submit_at)
+                future = self._outbound_scheduler.submit(ENDPOINT_MESSAGE, result["id"], send, result)
+                future.add_done_callback(
+                    lambda f, r=result, t=submit_at: None if f.cancelled() else finish(r, t, f.exception()))
+                futures.append(future)
+        else:
+            scheduler = self._outbound_scheduler
+
+            def send_direct(result: dict, submit_at: float):
+                try:
+                    if scheduler is not None:
+                        scheduler.call(ENDPOINT_MESSAGE, result["id"], send, result)
+                    else:
+                        send(result)
+                except BaseException as e:
+                    finish(result, submit_at, e)
+                else:
+                    finish(result, submit_at)
+
+            pool = ThreadPoolExecutor(max_workers=min(concurrency, len(results)), thread_name_prefix="topic-publish")
+            submit_at = time.monotonic()
+            submit_times = [submit_at] * len(results)
+            futures = [pool.submit(send_direct, result, submit_at) for result in results]
+        wait(futures, timeout)
+        with lock:
+            closed[0] = True
+            for result, future, submit_at in zip(results, futures, submit_times):
+                if result["latency"] is not None:
+                    continue
+                if future.cancel():
+                    # 尚未开始发送的消息已取消
+                    result["error"] = "timeout"
+                elif future.done():
+                    # 已完成但完成回调尚未执行
+                    record(result, submit_at, future.exception())
+                else:
+                    result["error"] = "in_flight"
+        if pool is not None:
+            pool.shutdown(wait=False)
+        return PublishResult(topic_name, results, time.monotonic() - started_at)
@@ -0,0 +1,135 @@
+HTTP_METHODS = ("GET", "POST", "PUT", "PATCH", "DELETE", "HEAD", "OPTIONS")
+
+ROUTE_FOUND = 200
+ROUTE_NOT_FOUND = 404
+ROUTE_METHOD_NOT_ALLOWED = 405
+
+
+class _Node(object):
+    __slots__ = ("children", "param_name", "param_child", "handlers")
+
+    def __init__(self):
+        # 静态路径段 -> 子节点
+        self.children = {}
+        # 路径参数，如 /hook/{name} 中的 name
+        self.param_name = None
+        self.param_child = None
+        # 请求方法 -> 处理对象，None表示接受任意方法
+        self.handlers = None
+
+
+class RouteMatch(object):
+    __slots__ = ("status", "target", "params", "allowed_methods")
+
+    def __init__(self, status: int, target=None, params: dict = None, allowed_methods=()):
+        self.status = status
+        self.target = target
+        self.params = params or {}
+        self.allowed_methods = allowed_methods
+
+
+_NOT_FOUND = RouteMatch(ROUTE_NOT_FOUND)
+
+
+class Router(object):
+    """
+    路由前缀树
+    按路径段匹配，静态路径段优先于路径参数(/hook/{name})，可以按请求方法过滤；
+    路由全部添加完成后不再修改，重新加载插件时构建新的路由
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        # 不含路径参数的路由直接按路径查找
+        self._static = {}
+
+    def add(self, path: str, target, methods=None):
+        """
+        添加路由
+        :param path:    路径，如 /plugin/example 或 /hook/{name}
+        :param target:  路由命中时返回的对象
+        :param methods: 允许的请求方法列表，为空时接受任意方法
+        :raise ValueError: 路由冲突
+        """
+        node = self._root
+        segments = _split(path)
+        for segment in segments:
+            if segment.startswith("{") and segment.endswith("}"):
+                name = segment[1:-1]
+                if node.param_child is None:
+                    node.param_name = name
+                    node.param_child = _Node()
+                elif node.param_name != name:
+                    raise ValueError("conflicting path parameter {%s} in route: %s" % (name, path))
+                node = node.param_child
+            else:
+                node = node.children.setdefault(segment, _Node())
+        if node.handlers is None:
+            node.handlers = {}
+        for method in ([m.upper() for m in methods] if methods else [None]):
+            if method in node.handlers:
+                raise ValueError("duplicate route: %s %s" % (method or "*", path))
+            node.handlers[method] = target
+        if all(not (s.startswith("{") and s.endswith("}")) for s in segments):
+            self._static["/" + "/".join(segments)] = node
+
+    def match(self, method: str, path: str) -> RouteMatch:
+        """
+        匹配路由
+        :param method:  请求方法
+        :param path:    请求路径
+        :return: RouteMatch，status为 ROUTE_FOUND / ROUTE_NOT_FOUND / ROUTE_METHOD_NOT_ALLOWED
+        """
+        params = None
+        node = self._static.get(path)
+        if node is None:
+            params = {}
+            node = self._match_node(self._root, _split(path), 0, params)
+            if node is None:
+                return _NOT_FOUND
+        handlers = node.handlers
+        target = handlers.get(method)
+        if target is None:
+            target = handlers.get(method.upper()) or handlers.get(None)
+            if target is None:
+                return RouteMatch(ROUTE_METHOD_NOT_ALLOWED, allowed_methods=tuple(sorted(m for m in handlers if m)))
+        return RouteMatch(ROUTE_FOUND, target, params)
+
+    def _match_node(self, node: _Node, segments: list, index: int, params: dict):
+        if index == len(segments):
+            return node if node.handlers else None
+        child = node.children.get(segments[index])
+        if child is not None:
+            found = self._match_node(child, segments, index + 1, params)
+            if found is not None:
+                return found
+        if node.param_child is not None and segments[index]:
+            found = self._match_node(node.param_child, segments, index + 1, params)
+            if found is not None:
+                params[node.param_name] = segments[index]
+                return found
+        return None
+
+    def routes(self) -> list:
+        """
+        获取全部路由
+        :return: [(路径, 请求方法, 处理对象), ...]
+        """
+        result = []
+
+        def walk(node, prefix):
+            if node.handlers:
+                for method, target in node.handlers.items():
+                    result.append((prefix or "/", method, target))
+            for segment, child in node.children.items():
+                walk(child, prefix + "/" + segment)
+            if node.param_child is not None:
+                walk(node.param_child, prefix + "/{%s}" % node.param_name)
+
+        walk(self._root, "")
+        return result
+
+
+def _split(path: str) -> list:
+    path = path.strip("/")
+    return path.split("/") if path else []
@@ -17,4 +17,9 @@ fi
 DIR_NAME=$(dirname "$0")
 BASE_PATH=$(realpath "$DIR_NAME")
 cd "$BASE_PATH" || return 1
-setsid /usr/bin/python3 -m flask run --port=2020 --host=0.0.0.0 &
\ No newline at end of file
+# SERVER_MODE=asgi 时使用ASGI服务器启动（需要安装uvicorn）
+if [[ "${SERVER_MODE}" == "asgi" ]]; then
+  setsid /usr/bin/python3 -m uvicorn asgi:app --port=2020 --host=0.0.0.0 &
+else
+  setsid /usr/bin/python3 -m flask run --port=2020 --host=0.0.0.0 &
+fi
\ No newline at end of file
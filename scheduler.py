@@ -0,0 +1,406 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import utils
+from api import MessageApiClient, LarkException
+from models import RenderMessage
+
+logger = utils.get_logger()
+
+# 飞书发送消息接口默认频率限制
+DEFAULT_ENDPOINT_RATE = 50
+DEFAULT_RECEIVER_RATE = 5
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_BASE = 1.0
+DEFAULT_BACKOFF_MAX = 60.0
+# 关闭时等待队列中的请求发送完成的时间(秒)
+DEFAULT_CLOSE_TIMEOUT = 10
+
+ENDPOINT_MESSAGE = "message"
+ENDPOINT_REPLY = "reply"
+# 针对单个会话的频率限制错误码，其余频率限制按接口处理
+RECEIVER_RATE_LIMIT_CODE = 230020
+
+# 消息类型，即持久化出站消息队列(outbox)中的kind：发送给用户、发送给群组与回复消息
+KIND_OPEN_ID = "open_id"
+KIND_CHAT_ID = "chat_id"
+KIND_REPLY = "reply"
+
+
+class TokenBucket(object):
+    """
+    令牌桶
+    非线程安全，由调度器加锁后使用
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        初始化令牌桶
+        :param rate:        每秒补充的令牌数
+        :param capacity:    桶容量（允许的突发量），默认与rate相同
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+
+    def _fill(self, now: float):
+        if now > self._updated_at:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+
+    def wait_time(self, now: float) -> float:
+        """
+        获取下一个令牌还需等待的时间(秒)，0表示可以立即获取
+        """
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._fill(now)
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def consume(self, now: float):
+        self._fill(now)
+        self._tokens -= 1
+
+    def is_full(self, now: float) -> bool:
+        if now < self._paused_until:
+            return False
+        self._fill(now)
+        return self._tokens >= self.capacity
+
+    def pause(self, until: float):
+        """
+        服务端返回频率限制时暂停发放令牌
+        """
+        self._paused_until = max(self._paused_until, until)
+        self._tokens = 0
+        self._updated_at = until
+
+
+class _OutboundJob(object):
+    __slots__ = ("endpoint", "receive_id", "fn", "args", "future", "attempts", "submit_at", "seq", "handoff")
+
+    def __init__(self, endpoint, receive_id, fn, args, seq: int, handoff: tuple = None):
+        self.endpoint = endpoint
+        self.receive_id = receive_id
+        self.fn = fn
+        self.args = args
+        self.future = Future()
+        self.attempts = 0
+        self.submit_at = time.monotonic()
+        # 提交顺序，重新排队时保持不变
+        self.seq = seq
+        # 关闭时仍未发送的消息转交给持久化队列的参数 (kind, target, body)
+        self.handoff = handoff
+
+
+class OutboundScheduler(object):
+    """
+    出站消息调度器
+    按接口与接收者分别维护令牌桶，超出频率的消息进入等待队列而不是直接失败；
+    服务端返回频率限制时按Retry-After或指数退避重新排队
+    """
+
+    def __init__(self, api_client: MessageApiClient,
+                 workers: int = 10,
+                 endpoint_rate: float = DEFAULT_ENDPOINT_RATE,
+                 receiver_rate: float = DEFAULT_RECEIVER_RATE,
+                 max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                 backoff_base: float = DEFAULT_BACKOFF_BASE,
+                 backoff_max: float = DEFAULT_BACKOFF_MAX):
+        """
+        初始化出站消息调度器
+        :param api_client:      飞书API
+        :param workers:         发送线程数
+        :param endpoint_rate:   每个接口每秒最大请求数
+        :param receiver_rate:   每个接收者(用户/群组)每秒最大消息数
+        :param max_attempts:    触发频率限制后的最大尝试次数
+        :param backoff_base:    指数退避的初始等待时间(秒)
+        :param backoff_max:     指数退避的最大等待时间(秒)
+        """
+        self._api_client = api_client
+        self._endpoint_rate = endpoint_rate
+        self._receiver_rate = receiver_rate
+        self._max_attempts = max_attempts
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._endpoint_buckets = {}
+        self._receiver_buckets = {}
+        self._heap = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+        self._deadline = None
+        self._handoff = None
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="outbound")
+        # 统计信息
+        self._in_flight = 0
+        self._dispatched_count = 0
+        self._sent_count = 0
+        self._rate_limited_count = 0
+        self._failed_count = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._thread = threading.Thread(target=self._run, name="outbound-scheduler", daemon=True)
+        self._thread.start()
+
+    def send_message_with_open_id(self, msg: RenderMessage) -> Future:
+        return self.submit(ENDPOINT_MESSAGE, msg.receive_id, self._api_client.send_message_with_open_id, msg,
+                           handoff=(KIND_OPEN_ID, msg.receive_id, msg.json()))
+
+    def send_message_with_group_id(self, msg: RenderMessage) -> Future:
+        return self.submit(ENDPOINT_MESSAGE, msg.receive_id, self._api_client.send_message_with_group_id, msg,
+                           handoff=(KIND_CHAT_ID, msg.receive_id, msg.json()))
+
+    def reply_message(self, messages_id: str, msg: RenderMessage, chat_id: str = None) -> Future:
+        """
+        回复消息
+        :param messages_id: 被回复的消息ID
+        :param msg:         消息体
+        :param chat_id:     消息所在的会话ID，提供时按会话限流，否则按消息ID限流
+        :return:
+        """
+        return self.submit(ENDPOINT_REPLY, chat_id or messages_id, self._api_client.reply_message, messages_id, msg,
+                           handoff=(KIND_REPLY, messages_id, msg.json()))
+
+    def submit(self, endpoint: str, receive_id: str, fn, *args, handoff: tuple = None) -> Future:
+        """
+        提交出站请求
+        :param endpoint:    接口名称，同一接口共用一个令牌桶
+        :param receive_id:  接收者ID，同一接收者共用一个令牌桶，为空时仅按接口限流
+        :param fn:          实际执行请求的方法
+        :param args:        方法参数
+        :param handoff:     关闭时仍未发送则转交给持久化队列，为 Outbox.enqueue 的参数 (kind, target, body)，见 close
+        :return: concurrent.futures.Future，结果为fn的返回值；开始发送前调用cancel()可以取消发送
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("OutboundScheduler is closed")
+            job = _OutboundJob(endpoint, receive_id, fn, args, next(self._seq), handoff)
+            self._push(job, job.submit_at)
+        return job.future
+
+    def call(self, endpoint: str, receive_id: str, fn, *args):
+        """
+        在调用线程中执行出站请求，不进入等待队列，但与队列中的请求共用令牌桶：
+        令牌不足时阻塞等待，触发频率限制时同样暂停令牌桶并重试
+        :param endpoint:    接口名称，见 submit
+        :param receive_id:  接收者ID，见 submit
+        :param fn:          实际执行请求的方法
+        :param args:        方法参数
+        :return: fn的返回值
+        """
+        attempts = 0
+        while True:
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("OutboundScheduler is closed")
+                now = time.monotonic()
+                endpoint_bucket = self._bucket(self._endpoint_buckets, endpoint, self._endpoint_rate)
+                receiver_bucket = None
+                if receive_id:
+                    receiver_bucket = self._bucket(self._receiver_buckets, receive_id, self._receiver_rate)
+                wait = endpoint_bucket.wait_time(now)
+                if receiver_bucket:
+                    wait = max(wait, receiver_bucket.wait_time(now))
+                if wait <= 0:
+                    endpoint_bucket.consume(now)
+                    if receiver_bucket:
+                        receiver_bucket.consume(now)
+            if wait > 0:
+                # 不在条件变量上等待，避免占用调度线程的唤醒通知
+                time.sleep(wait)
+                continue
+            attempts += 1
+            try:
+                result = fn(*args)
+            except LarkException as e:
+                with self._cond:
+                    if e.is_rate_limited and attempts < self._max_attempts:
+                        until = self._rate_limited(endpoint, receive_id, e, attempts)
+                    else:
+                        self._failed_count += 1
+                        until = None
+                if until is None:
+                    raise
+                # 令牌桶暂停到可以重试的时间，下一轮获取令牌时等待
+            except BaseException:
+                with self._cond:
+                    self._failed_count += 1
+                raise
+            else:
+                with self._cond:
+                    self._sent_count += 1
+                return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            dispatched = self._dispatched_count
+            return {
+                "queue_depth": len(self._heap),
+                "in_flight": self._in_flight,
+                "sent_count": self._sent_count,
+                "failed_count": self._failed_count,
+                "rate_limited_count": self._rate_limited_count,
+                "wait_avg": self._wait_total / dispatched if dispatched else 0.0,
+                "wait_max": self._wait_max
+            }
+
+    def close(self, wait: bool = True, timeout: float = DEFAULT_CLOSE_TIMEOUT, handoff=None):
+        """
+        停止接收请求，在超时前继续发送队列中的请求
+        :param wait:    是否等待队列中的请求发送完成
+        :param timeout: 等待时间(秒)，为空时一直等待；超时后仍在排队（如频率限制退避中）的请求不再发送
+        :param handoff: 超时后未发送的消息的转交方法 handoff(kind, target, body)，如 Outbox.enqueue，
+                        转交后消息的Future以RuntimeError结束；为空或请求不支持转交时直接以RuntimeError结束
+        """
+        with self._cond:
+            self._closed = True
+            self._handoff = handoff
+            if timeout is not None:
+                self._deadline = time.monotonic() + (timeout if wait else 0)
+            elif not wait:
+                self._deadline = time.monotonic()
+            self._cond.notify_all()
+        # 调度线程在队列清空或超时后退出
+        self._thread.join()
+        with self._cond:
+            remaining = [job for ready_at, seq, job in self._heap]
+            self._heap = []
+        for job in remaining:
+            self._abandon(job)
+        self._pool.shutdown(wait=wait and timeout is None)
+
+    def _abandon(self, job: _OutboundJob):
+        # 关闭时未发送的请求
+        handoff = self._handoff
+        error = RuntimeError("OutboundScheduler closed before the request was sent")
+        if handoff is not None and job.handoff is not None:
+            try:
+                handoff(*job.handoff)
+                error = RuntimeError("OutboundScheduler closed, the request was handed off")
+            except BaseException as e:
+                logger.error("出站请求转交失败【%s】【%s】: %s" % (job.endpoint, job.receive_id, e))
+        with self._cond:
+            self._failed_count += 1
+        if not job.future.cancelled():
+            job.future.set_exception(error)
+
+    def _push(self, job: _OutboundJob, ready_at: float):
+        heapq.heappush(self._heap, (ready_at, job.seq, job))
+        self._cond.notify()
+
+    def _bucket(self, buckets: dict, key, rate: float) -> TokenBucket:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate)
+        return bucket
+
+    def _prune_buckets(self, now: float):
+        # 已回满的接收者令牌桶与新建的没有区别，可以删除以限制内存占用
+        for key in [k for k, b in self._receiver_buckets.items() if b.is_full(now)]:
+            del self._receiver_buckets[key]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._deadline is not None and now >= self._deadline:
+                        # 关闭超时，剩余的请求由close处理
+                        return
+                    if self._heap:
+                        break
+                    # 关闭后等待正在发送的请求完成，触发频率限制的请求会重新排队
+                    if self._closed and not self._in_flight:
+                        return
+                    self._cond.wait(None if self._deadline is None else self._deadline - now)
+                ready_at, seq, job = self._heap[0]
+                if ready_at > now:
+                    self._cond.wait(ready_at - now if self._deadline is None else min(ready_at, self._deadline) - now)
+                    continue
+                heapq.heappop(self._heap)
+                if job.attempts == 0 and job.future.cancelled():
+                    continue
+                endpoint_bucket = self._bucket(self._endpoint_buckets, job.endpoint, self._endpoint_rate)
+                receiver_bucket = None
+                if job.receive_id:
+                    receiver_bucket = self._bucket(self._receiver_buckets, job.receive_id, self._receiver_rate)
+                wait = endpoint_bucket.wait_time(now)
+                if receiver_bucket:
+                    wait = max(wait, receiver_bucket.wait_time(now))
+                if wait > 0:
+                    # 保留原序号，同一接收者的消息仍按提交顺序发送
+                    heapq.heappush(self._heap, (now + wait, seq, job))
+                    continue
+                if job.attempts == 0 and not job.future.set_running_or_notify_cancel():
+                    continue
+                endpoint_bucket.consume(now)
+                if receiver_bucket:
+                    receiver_bucket.consume(now)
+                self._in_flight += 1
+                self._dispatched_count += 1
+                if self._dispatched_count % 4096 == 0:
+                    self._prune_buckets(now)
+                waited = now - job.submit_at
+                self._wait_total += waited
+                self._wait_max = max(self._wait_max, waited)
+            self._pool.submit(self._execute, job)
+
+    def _execute(self, job: _OutboundJob):
+        job.attempts += 1
+        try:
+            result = job.fn(*job.args)
+        except LarkException as e:
+            if e.is_rate_limited and job.attempts < self._max_attempts:
+                with self._cond:
+                    self._in_flight -= 1
+                    until = self._rate_limited(job.endpoint, job.receive_id, e, job.attempts)
+                    abandon = self._deadline is not None and until >= self._deadline
+                    if not abandon:
+                        self._push(job, until)
+                if abandon:
+                    self._abandon(job)
+                return
+            self._finish(job, error=e)
+        except BaseException as e:
+            self._finish(job, error=e)
+        else:
+            self._finish(job, result=result)
+
+    def _rate_limited(self, endpoint, receive_id, e: LarkException, attempts: int) -> float:
+        # 服务端返回频率限制时暂停对应的令牌桶，返回可以重试的时间，需持有锁
+        delay = e.retry_after
+        if delay is None:
+            delay = min(self._backoff_max, self._backoff_base * (2 ** (attempts - 1)))
+            delay += random.uniform(0, delay / 2)
+        logger.info("出站请求触发频率限制【%s】【%s】，%.2f秒后重试" % (endpoint, receive_id, delay))
+        self._rate_limited_count += 1
+        until = time.monotonic() + delay
+        if receive_id and e.code == RECEIVER_RATE_LIMIT_CODE:
+            self._bucket(self._receiver_buckets, receive_id, self._receiver_rate).pause(until)
+        else:
+            self._bucket(self._endpoint_buckets, endpoint, self._endpoint_rate).pause(until)
+        return until
+
+    def _finish(self, job: _OutboundJob, result=None, error: BaseException = None):
+        with self._cond:
+            self._in_flight -= 1
+            if error is None:
+                self._sent_count += 1
+            else:
+                self._failed_count += 1
+            if self._closed:
+                self._cond.notify_all()
+        if error is None:
+            job.future.set_result(result)
+        else:
+            logger.error("出站请求失败【%s】【%s】: %s" % (job.endpoint, job.receive_id, error))
+            job.future.set_exception(error)
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import threading
+from types import MappingProxyType
+
+import utils
+
+logger = utils.get_logger()
+
+# 日志文件超过该大小(字节)且超过快照大小时压缩
+DEFAULT_COMPACT_BYTES = 1024 * 1024
+# 延迟写入时，待写入的键数达到该值后提前写入
+DEFAULT_FLUSH_THRESHOLD = 1000
+
+_OP_BASE = "base"
+_OP_PUT = "put"
+_OP_REMOVE = "remove"
+# encode 的配置值，表示删除该键
+REMOVED = object()
+
+
+class JournalStore(object):
+    """
+    配置存储
+    由快照文件(db.json)与追加写的日志文件组成：每次修改只向日志追加一行并fsync，写入开销与配置总量无关；
+    日志过大时将全部数据写入临时文件并替换快照，再重建日志。日志第一行记录所基于快照的哈希值，
+    启动时读取快照并重放与之匹配的日志：替换快照后、重建日志前崩溃时旧日志不再重放；
+    日志最后一行不完整（写入时进程崩溃）时丢弃该行
+    """
+
+    def __init__(self, snapshot_path: str, journal_path: str = None, compact_bytes: int = DEFAULT_COMPACT_BYTES):
+        """
+        初始化配置存储
+        :param snapshot_path:   快照文件路径，即原有的db.json，首次启动时以其为快照创建日志
+        :param journal_path:    日志文件路径，默认为快照文件路径加 .journal
+        :param compact_bytes:   日志文件超过该大小(字节)且超过快照大小时压缩，0表示只在save时压缩
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or snapshot_path + ".journal"
+        self._compact_bytes = compact_bytes
+        self._lock = threading.Lock()
+        self._journal = None
+        self._journal_size = 0
+        self._snapshot_size = 0
+
+    def load(self) -> dict:
+        """
+        读取快照并重放日志
+        :return: 全部配置
+        """
+        content = b""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, "rb") as r:
+                content = r.read()
+        data = json.loads(content.decode("utf-8") or "{}")
+        self._snapshot_size = len(content)
+        base = hashlib.sha1(content).hexdigest()
+        replayed, valid_size = 0, 0
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, "rb") as r:
+                for line in r:
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record["op"] == _OP_BASE:
+                        if record["hash"] != base:
+                            logger.info("配置日志【%s】已压缩到配置文件，不再重放" % self.journal_path)
+                            break
+                    elif not valid_size:
+                        logger.warning("配置日志【%s】缺少快照记录，已忽略" % self.journal_path)
+                        break
+                    elif "sub" in record:
+                        path = record["sub"]
+                        if isinstance(path, str):
+                            path = [path]
+                        parent = data
+                        for key in [record["key"]] + path[:-1]:
+                            if not isinstance(parent.get(key), dict):
+                                parent[key] = {}
+                            parent = parent[key]
+                        if record["op"] == _OP_PUT:
+                            parent[path[-1]] = record["value"]
+                        else:
+                            parent.pop(path[-1], None)
+                        replayed += 1
+                    elif record["op"] == _OP_PUT:
+                        data[record["key"]] = record["value"]
+                        replayed += 1
+                    else:
+                        data.pop(record["key"], None)
+                        replayed += 1
+                    valid_size += len(line)
+            if valid_size and valid_size != os.path.getsize(self.journal_path):
+                logger.warning("配置日志【%s】末尾存在不完整的记录，已丢弃" % self.journal_path)
+            if replayed:
+                logger.info("配置日志【%s】重放%d条记录" % (self.journal_path, replayed))
+        self._journal = open(self.journal_path, "r+b" if valid_size else "w+b")
+        if valid_size:
+            self._journal.truncate(valid_size)
+            self._journal.seek(valid_size)
+            self._journal_size = valid_size
+        else:
+            self._reset_journal(base)
+        return data
+
+    def _reset_journal(self, base: str):
+        line = (json.dumps({"op": _OP_BASE, "hash": base}) + "\n").encode("utf-8")
+        self._journal.seek(0)
+        self._journal.truncate(0)
+        self._journal.write(line)
+        self._journal.flush()
+        os.fsync(self._journal.fileno())
+        self._journal_size = len(line)
+
+    @staticmethod
+    def encode(key: str, value, sub_path: tuple = None) -> bytes:
+        """
+        将修改编码为一条日志记录
+        :param value:       配置值，为REMOVED时表示删除
+        :param sub_path:    修改的是配置 key 中的嵌套项时提供，如 ("news", "ou_xxx")，见 ConfigSubtree
+        """
+        if value is REMOVED:
+            record = {"op": _OP_REMOVE, "key": key}
+        else:
+            record = {"op": _OP_PUT, "key": key, "value": value}
+        if sub_path is not None:
+            record["sub"] = list(sub_path)
+        return (json.dumps(record, ensure_ascii=False, default=json_default) + "\n").encode("utf-8")
+
+    def append(self, lines: list):
+        """
+        追加日志记录，一批记录只fsync一次
+        :param lines: encode 的返回值列表
+        """
+        if not lines:
+            return
+        content = b"".join(lines)
+        with self._lock:
+            self._journal.write(content)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._journal_size += len(content)
+
+    def needs_compaction(self) -> bool:
+        return bool(self._compact_bytes) and self._journal_size > max(self._compact_bytes, self._snapshot_size)
+
+    @staticmethod
+    def encode_snapshot(data: dict) -> bytes:
+        return json.dumps(data, ensure_ascii=False, indent=2, default=json_default).encode("utf-8")
+
+    def write_snapshot(self, content: bytes):
+        """
+        写入临时文件后替换快照，并重建基于新快照的日志
+        :param content: encode_snapshot 的返回值
+        """
+        tmp_path = self.snapshot_path + ".tmp"
+        with self._lock:
+            with open(tmp_path, "wb") as w:
+                w.write(content)
+                w.flush()
+                os.fsync(w.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+            _fsync_dir(self.snapshot_path)
+            self._snapshot_size = len(content)
+            self._reset_journal(hashlib.sha1(content).hexdigest())
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+
+
+def _fsync_dir(path: str):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def freeze(value):
+    """
+    将配置值转换为不可变对象：dict转换为MappingProxyType，list转换为tuple
+    """
+    if isinstance(value, MappingProxyType):
+        return value
+    if isinstance(value, dict):
+        return MappingProxyType({k: freeze(v) for k, v in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
+def thaw(value):
+    """
+    将不可变的配置值还原为可以修改的dict与list
+    """
+    if isinstance(value, (dict, MappingProxyType)):
+        return {k: thaw(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [thaw(v) for v in value]
+    return value
+
+
+def json_default(value):
+    # 用于json.dumps序列化不可变的配置值
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
@@ -0,0 +1,87 @@
+import threading
+import time
+
+import pytest
+
+from api import TenantAccessTokenManager
+
+
+class _Fetcher(object):
+    def __init__(self, expire: int = 7200):
+        self.expire = expire
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.error = None
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        return "t%d" % self.calls, self.expire
+
+
+def test_single_flight_refresh():
+    fetcher = _Fetcher()
+    fetcher.release.clear()
+    manager = TenantAccessTokenManager(fetcher)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(manager.get())) for _ in range(8)]
+    threads[0].start()
+    assert fetcher.started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # 等待其余线程进入等待
+    time.sleep(0.1)
+    fetcher.release.set()
+    for thread in threads:
+        thread.join(5)
+    assert fetcher.calls == 1
+    assert results == ["t1"] * 8
+    assert manager.stats()["wait_count"] == 7
+
+
+def test_get_without_block():
+    manager = TenantAccessTokenManager(_Fetcher())
+    assert manager.get(block=False) == ""
+    assert manager.get() == "t1"
+    assert manager.get(block=False) == "t1"
+
+
+def test_invalidate_only_current_token():
+    fetcher = _Fetcher()
+    manager = TenantAccessTokenManager(fetcher)
+    assert manager.get() == "t1"
+    manager.invalidate("t1")
+    assert manager.get() == "t2"
+    # 已被其他线程刷新的旧令牌失效时不影响新令牌
+    manager.invalidate("t1")
+    assert manager.get() == "t2"
+    assert fetcher.calls == 2
+
+
+def test_refresh_ahead_in_background():
+    fetcher = _Fetcher(expire=100)
+    manager = TenantAccessTokenManager(fetcher, refresh_ahead=200)
+    assert manager.get() == "t1"
+    # 临近过期时返回当前令牌并在后台刷新
+    assert manager.get() == "t1"
+    deadline = time.time() + 5
+    while manager.token != "t2" and time.time() < deadline:
+        time.sleep(0.01)
+    assert manager.token == "t2"
+    assert manager.stats()["background_refresh_count"] >= 1
+
+
+def test_refresh_failure_is_retried():
+    fetcher = _Fetcher()
+    fetcher.error = RuntimeError("unavailable")
+    manager = TenantAccessTokenManager(fetcher)
+    with pytest.raises(RuntimeError):
+        manager.get()
+    fetcher.error = None
+    assert manager.get() == "t2"
+    assert manager.stats()["error_count"] == 1
@@ -0,0 +1,117 @@
+import threading
+import time
+
+import pytest
+
+from cache import LoadingCache
+
+
+class _Clock(object):
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return _Clock()
+
+
+def test_single_flight():
+    calls = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def loader(key):
+        calls.append(key)
+        started.set()
+        release.wait(5)
+        return key.upper()
+
+    loading_cache = LoadingCache(loader, name="test")
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(loading_cache.get("a"))) for _ in range(8)]
+    threads[0].start()
+    assert started.wait(5)
+    for thread in threads[1:]:
+        thread.start()
+    # 等待其余线程进入等待
+    time.sleep(0.1)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert calls == ["a"]
+    assert results == ["A"] * 8
+    assert loading_cache.stats()["load_count"] == 1
+    loading_cache.close()
+
+
+def test_negative_caching(clock):
+    calls = []
+
+    def loader(key):
+        calls.append(key)
+        raise RuntimeError("unavailable")
+
+    loading_cache = LoadingCache(loader, negative_ttl=300, name="test", clock=clock)
+    assert loading_cache.get("a") is None
+    clock.now += 299
+    assert loading_cache.get("a") is None
+    assert len(calls) == 1
+    assert loading_cache.stats()["negative_hit_count"] == 1
+    clock.now += 2
+    assert loading_cache.get("a") is None
+    assert len(calls) == 2
+    loading_cache.close()
+
+
+def test_no_negative_caching(clock):
+    calls = []
+    loading_cache = LoadingCache(lambda key: calls.append(key), negative_ttl=0, name="test", clock=clock)
+    loading_cache.get("a")
+    loading_cache.get("a")
+    assert len(calls) == 2
+    assert len(loading_cache) == 0
+    loading_cache.close()
+
+
+def test_stale_value_refreshed_in_background(clock):
+    values = iter(["v1", "v2"])
+    loading_cache = LoadingCache(lambda key: next(values), ttl=10, stale_ttl=100, name="test", clock=clock)
+    assert loading_cache.get("a") == "v1"
+    clock.now += 11
+    # 过期后先返回旧值，同时在后台刷新
+    assert loading_cache.get("a") == "v1"
+    loading_cache.close()
+    loading_cache._refresher.shutdown(wait=True)
+    assert loading_cache.get("a") == "v2"
+    assert loading_cache.stats()["refresh_count"] == 1
+
+
+def test_failed_refresh_keeps_stale_value(clock):
+    values = iter(["v1", None])
+    loading_cache = LoadingCache(lambda key: next(values), ttl=10, stale_ttl=100, negative_ttl=5, name="test",
+                                 clock=clock)
+    loading_cache.close()
+    assert loading_cache.get("a") == "v1"
+    clock.now += 11
+    # 已关闭时同步刷新，刷新失败时继续使用旧值
+    assert loading_cache.get("a") == "v1"
+    assert loading_cache.get("a") == "v1"
+    assert loading_cache.stats()["load_failure_count"] == 1
+
+
+def test_capacity_evicts_least_recently_used(clock):
+    loading_cache = LoadingCache(lambda key: key, capacity=2, name="test", clock=clock)
+    loading_cache.get("a")
+    loading_cache.get("b")
+    loading_cache.get("a")
+    loading_cache.get("c")
+    assert loading_cache.stats()["eviction_count"] == 1
+    loading_cache.invalidate("c")
+    assert len(loading_cache) == 1
+    assert loading_cache.get("a") == "a"
+    assert loading_cache.stats()["load_count"] == 3
+    loading_cache.close()
@@ -0,0 +1,109 @@
+import pytest
+
+from command import CommandEngine, CommandError
+from enums import ReceiveType
+
+
+def _handler(receive_message, args, tools):
+    return args
+
+
+@pytest.fixture
+def engine():
+    engine = CommandEngine()
+    engine.register("/deploy <env:dev|prod> [count:int] [-f|--force] [--tag <name>]", _handler, owner="deploy")
+    engine.register("/topic add <topic> [ids...]", _handler, owner="topic")
+    engine.register("/topic", _handler, owner="topic")
+    return engine
+
+
+def test_resolve_longest_path(engine):
+    command, args = engine.resolve("/topic add news ou_1 ou_2")
+    assert command.name == "/topic add"
+    assert args == {"topic": "news", "ids": ["ou_1", "ou_2"]}
+    command, args = engine.resolve("/topic")
+    assert command.name == "/topic"
+
+
+def test_resolve_params_and_options(engine):
+    command, args = engine.resolve("@_user_1 /deploy prod 3 --force --tag=v1")
+    assert args == {"env": "prod", "count": 3, "force": True, "tag": "v1"}
+    _, args = engine.resolve('/deploy dev --tag "release 1"')
+    assert args == {"env": "dev", "count": None, "force": False, "tag": "release 1"}
+
+
+def test_resolve_not_a_command(engine):
+    assert engine.resolve("hello /deploy") is None
+
+
+def test_resolve_errors(engine):
+    with pytest.raises(CommandError) as e:
+        engine.resolve("/unknown")
+    assert e.value.command is None
+    with pytest.raises(CommandError) as e:
+        engine.resolve("/deploy test")
+    assert e.value.command.name == "/deploy"
+    with pytest.raises(CommandError):
+        engine.resolve("/deploy dev 1 2")
+
+
+def test_register_conflict_and_unregister(engine):
+    with pytest.raises(ValueError):
+        engine.register("/topic add <name>", _handler, owner="other")
+    engine.unregister("topic")
+    with pytest.raises(CommandError):
+        engine.resolve("/topic add news")
+    engine.register("/topic add <name>", _handler, owner="other")
+    assert [c.name for c in engine.commands()] == ["/deploy", "/help", "/topic add"]
+
+
+def test_restore_and_discard_owned_commands(engine):
+    old = engine.owned("topic")
+    assert sorted(command.name for path, command in old) == ["/topic", "/topic add"]
+    # 新版本初始化失败时恢复旧版本的命令
+    engine.register("/topic list", _handler, owner="topic")
+    engine.restore("topic", old)
+    assert [c.name for c in engine.commands()] == ["/deploy", "/help", "/topic", "/topic add"]
+    with pytest.raises(CommandError):
+        engine.resolve("/topic list")
+    # 新版本初始化成功后移除其不再注册的旧命令
+    engine.register("/topic add <topic>", _handler, owner="topic")
+    engine.discard(old)
+    assert [c.name for c in engine.commands()] == ["/deploy", "/help", "/topic add"]
+    assert engine.resolve("/topic add news")[1] == {"topic": "news"}
+    with pytest.raises(CommandError):
+        engine.resolve("/topic")
+
+
+class _Message(object):
+    msg_id = "om_1"
+    is_text = True
+
+    def __init__(self, text: str, msg_type: str, at_me: bool = False):
+        self.text_content = text
+        self.msg_type = msg_type
+        self._at_me = at_me
+
+    def at_me(self) -> bool:
+        return self._at_me
+
+
+class _ApiClient(object):
+    def __init__(self):
+        self.replies = []
+
+    def reply_message(self, msg_id, msg):
+        self.replies.append((msg_id, msg))
+
+
+class _Tools(object):
+    def __init__(self):
+        self.api_client = _ApiClient()
+
+
+def test_dispatch_unknown_command_in_group(engine):
+    tools = _Tools()
+    assert not engine.dispatch(_Message("/unknown", ReceiveType.GROUP.value), tools)
+    assert engine.dispatch(_Message("@_user_1 /unknown", ReceiveType.GROUP.value, at_me=True), tools)
+    assert engine.dispatch(_Message("/unknown", ReceiveType.USER.value), tools)
+    assert len(tools.api_client.replies) == 2
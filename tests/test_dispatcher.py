@@ -0,0 +1,146 @@
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from dispatcher import EventDispatcher, OVERFLOW_BLOCK, OVERFLOW_SHED, OVERFLOW_SPILL
+
+
+class _Handler(object):
+    """
+    记录处理顺序，release 置位前阻塞处理线程
+    """
+
+    def __init__(self):
+        self.handled = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, item):
+        self.started.set()
+        self.release.wait(5)
+        self.handled.append(item)
+
+
+def _wait_for(predicate, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_events_of_one_chat_are_ordered():
+    handler = _Handler()
+    handler.release.set()
+    dispatcher = EventDispatcher(handler, lanes=4)
+    for i in range(50):
+        assert dispatcher.submit(("oc_%d" % (i % 5), i), key="oc_%d" % (i % 5))
+    dispatcher.close()
+    assert len(handler.handled) == 50
+    for chat in range(5):
+        assert [i for key, i in handler.handled if key == "oc_%d" % chat] == list(range(chat, 50, 5))
+
+
+def test_lane_overflow_shed():
+    handler = _Handler()
+    dispatcher = EventDispatcher(handler, lanes=1, capacity=2, overflow=OVERFLOW_SHED)
+    assert dispatcher.submit(0, key="oc_1")
+    assert handler.started.wait(5)
+    assert dispatcher.submit(1, key="oc_1")
+    assert dispatcher.submit(2, key="oc_1")
+    # 通道已满时直接丢弃
+    assert not dispatcher.submit(3, key="oc_1")
+    handler.release.set()
+    dispatcher.close()
+    assert handler.handled == [0, 1, 2]
+    assert dispatcher.stats()[0]["shed_count"] == 1
+
+
+def test_lane_overflow_block_times_out():
+    handler = _Handler()
+    dispatcher = EventDispatcher(handler, lanes=1, capacity=1, overflow=OVERFLOW_BLOCK, block_timeout=0.1)
+    assert dispatcher.submit(0, key="oc_1")
+    assert handler.started.wait(5)
+    assert dispatcher.submit(1, key="oc_1")
+    started = time.monotonic()
+    assert not dispatcher.submit(2, key="oc_1")
+    assert time.monotonic() - started >= 0.1
+    handler.release.set()
+    dispatcher.close()
+    assert handler.handled == [0, 1]
+
+
+def test_lane_overflow_block_waits_for_space():
+    handler = _Handler()
+    dispatcher = EventDispatcher(handler, lanes=1, capacity=1, overflow=OVERFLOW_BLOCK, block_timeout=5)
+    assert dispatcher.submit(0, key="oc_1")
+    assert handler.started.wait(5)
+    assert dispatcher.submit(1, key="oc_1")
+    threading.Timer(0.1, handler.release.set).start()
+    assert dispatcher.submit(2, key="oc_1")
+    dispatcher.close()
+    assert handler.handled == [0, 1, 2]
+
+
+def test_lane_overflow_spill_keeps_order(tmp_path):
+    handler = _Handler()
+    dispatcher = EventDispatcher(handler, lanes=1, capacity=2, overflow=OVERFLOW_SPILL, spill_dir=str(tmp_path))
+    assert dispatcher.submit(0, key="oc_1")
+    assert handler.started.wait(5)
+    for i in range(1, 10):
+        assert dispatcher.submit(i, key="oc_1")
+    assert dispatcher.stats()[0]["spill_count"] == 7
+    handler.release.set()
+    assert _wait_for(lambda: len(handler.handled) == 10)
+    dispatcher.close()
+    # 溢出到磁盘的事件在内存中的事件之后按顺序处理
+    assert handler.handled == list(range(10))
+    assert dispatcher.stats()[0]["depth"] == 0
+
+
+def test_spill_requires_directory():
+    with pytest.raises(ValueError):
+        EventDispatcher(_Handler(), overflow=OVERFLOW_SPILL)
+
+
+def _event(chat_id: str, event_id: str):
+    return SimpleNamespace(header=SimpleNamespace(event_id=event_id),
+                           event=SimpleNamespace(message=SimpleNamespace(chat_id=chat_id)))
+
+
+def test_raw_callbacks_are_resolved_in_order():
+    handler = _Handler()
+    handler.release.set()
+    # 重复的回调由resolver返回None忽略
+    dispatcher = EventDispatcher(handler, lanes=2,
+                                 resolver=lambda i: _event("oc_%d" % (i % 2), "e%d" % i) if i % 3 else None)
+    for i in range(1, 10):
+        assert dispatcher.submit_raw(i)
+    assert _wait_for(lambda: dispatcher.intake_stats()["intake_count"] == 9)
+    dispatcher.close()
+    assert [e.header.event_id for e in handler.handled if e.event.message.chat_id == "oc_1"] == ["e1", "e5", "e7"]
+    assert [e.header.event_id for e in handler.handled if e.event.message.chat_id == "oc_0"] == ["e2", "e4", "e8"]
+
+
+def test_rejected_raw_callback_calls_on_reject():
+    handler = _Handler()
+    rejected = []
+    dispatcher = EventDispatcher(handler, lanes=1, capacity=1, overflow=OVERFLOW_SHED,
+                                 resolver=lambda event_id: _event("oc_1", event_id), on_reject=rejected.append)
+    assert dispatcher.submit(_event("oc_1", "e0"))
+    assert handler.started.wait(5)
+    assert dispatcher.submit_raw("e1")
+    assert dispatcher.submit_raw("e2")
+    # 通道已满，未入队的事件交给on_reject（如移除去重记录）
+    assert _wait_for(lambda: rejected)
+    handler.release.set()
+    dispatcher.close()
+    assert [e.header.event_id for e in rejected] == ["e2"]
+    assert [e.header.event_id for e in handler.handled] == ["e0", "e1"]
+
+
+def test_intake_thread_only_with_resolver():
+    dispatcher = EventDispatcher(_Handler(), lanes=1)
+    assert not any(t.name == "event-intake" for t in threading.enumerate())
+    dispatcher.close()
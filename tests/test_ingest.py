@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import json
+import os
+
+import pytest
+from Crypto.Cipher import AES
+
+import ingest
+from ingest import EventDeduplicator, SqliteDedupBackend, CallbackDecoder, get_json_codec, JSON_CODEC_STD
+from models import InvalidEventException
+
+
+class _Clock(object):
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_dedup_within_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(ingest.time, "time", clock)
+    dedup = EventDeduplicator(ttl=60)
+    assert not dedup.is_duplicate("e1")
+    clock.now += 59
+    assert dedup.is_duplicate("e1")
+    assert dedup.stats()["hit_count"] == 1
+
+
+def test_dedup_expires_after_ttl(monkeypatch):
+    clock = _Clock()
+    monkeypatch.setattr(ingest.time, "time", clock)
+    dedup = EventDeduplicator(ttl=60)
+    assert not dedup.is_duplicate("e1")
+    clock.now += 61
+    assert not dedup.is_duplicate("e1")
+    assert dedup.is_duplicate("e1")
+
+
+def test_dedup_capacity_evicts_oldest():
+    dedup = EventDeduplicator(capacity=2)
+    for event_id in ("e1", "e2", "e3"):
+        assert not dedup.is_duplicate(event_id)
+    assert dedup.stats()["size"] == 2
+    assert not dedup.is_duplicate("e1")
+    assert dedup.is_duplicate("e3")
+
+
+def test_dedup_empty_event_id_is_never_duplicate():
+    dedup = EventDeduplicator()
+    assert not dedup.is_duplicate("")
+    assert not dedup.is_duplicate("")
+
+
+def test_dedup_forget():
+    dedup = EventDeduplicator()
+    assert not dedup.is_duplicate("e1")
+    dedup.forget("e1")
+    assert not dedup.is_duplicate("e1")
+
+
+def test_sqlite_backend_ttl(tmp_path):
+    backend = SqliteDedupBackend(str(tmp_path / "dedup.db"), ttl=60)
+    assert backend.add("e1", 1000.0)
+    assert not backend.add("e1", 1059.0)
+    # 记录过期但尚未清理时视为首次出现
+    assert backend.add("e1", 1120.0)
+    backend.remove("e1")
+    assert backend.add("e1", 1121.0)
+
+
+def test_dedup_shared_between_processes(tmp_path):
+    path = str(tmp_path / "dedup.db")
+    first = EventDeduplicator(backend=SqliteDedupBackend(path))
+    second = EventDeduplicator(backend=SqliteDedupBackend(path))
+    assert not first.is_duplicate("e1")
+    assert second.is_duplicate("e1")
+    assert second.stats()["backend_hit_count"] == 1
+
+
+def _encrypt(encrypt_key: str, data: dict) -> bytes:
+    plain = json.dumps(data).encode("utf-8")
+    pad = AES.block_size - len(plain) % AES.block_size
+    iv = os.urandom(AES.block_size)
+    cipher = AES.new(hashlib.sha256(encrypt_key.encode("utf-8")).digest(), AES.MODE_CBC, iv)
+    encrypted = base64.b64encode(iv + cipher.encrypt(plain + bytes([pad]) * pad)).decode("utf-8")
+    return json.dumps({"encrypt": encrypted}).encode("utf-8")
+
+
+def _sign(encrypt_key: str, body: bytes, timestamp: str = "1700000000", nonce: str = "nonce") -> dict:
+    signature = hashlib.sha256((timestamp + nonce + encrypt_key).encode("utf-8") + body).hexdigest()
+    return {"X-Lark-Request-Timestamp": timestamp, "X-Lark-Request-Nonce": nonce, "X-Lark-Signature": signature}
+
+
+@pytest.mark.parametrize("codec", [None, JSON_CODEC_STD])
+def test_decode_encrypted_callback(codec):
+    data = {"header": {"event_id": "e1"}, "event": {"text": "中文"}}
+    decoder = CallbackDecoder("key", get_json_codec(codec) if codec else None)
+    body = _encrypt("key", data)
+    assert decoder.verify_signature(body, _sign("key", body))
+    assert decoder.decode(body) == data
+
+
+def test_verify_signature():
+    decoder = CallbackDecoder("key")
+    body = _encrypt("key", {})
+    assert not decoder.verify_signature(body, {})
+    with pytest.raises(InvalidEventException):
+        decoder.verify_signature(body + b" ", _sign("key", body))
+
+
+def test_decode_requires_matching_encryption():
+    with pytest.raises(InvalidEventException):
+        CallbackDecoder("key").decode(b'{"type": "url_verification"}')
+    assert CallbackDecoder("").decode(b'{"type": "url_verification"}') == {"type": "url_verification"}
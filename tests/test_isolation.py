@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from isolation import CircuitBreaker, PluginRunner, PluginTimeoutError, BREAKER_CLOSED, BREAKER_OPEN, \
+    BREAKER_HALF_OPEN
+
+
+def test_breaker_trips_after_consecutive_failures():
+    breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+    assert not breaker.record(False)
+    assert not breaker.record(False)
+    # 成功后重新计数
+    assert not breaker.record(True)
+    assert not breaker.record(False)
+    assert not breaker.record(False)
+    assert breaker.record(False)
+    assert breaker.state == BREAKER_OPEN
+    assert not breaker.allow()
+
+
+def test_breaker_half_open_trial():
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.05)
+    assert breaker.record(False)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    # 熔断结束后只放行一次试探调用
+    assert breaker.allow()
+    assert breaker.state == BREAKER_HALF_OPEN
+    assert not breaker.allow()
+    # 试探失败时继续熔断
+    assert breaker.record(False)
+    assert not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == BREAKER_CLOSED
+    assert breaker.allow() and breaker.allow()
+
+
+def test_breaker_disabled():
+    breaker = CircuitBreaker(failure_threshold=0)
+    for _ in range(100):
+        assert not breaker.record(False)
+    assert breaker.allow()
+
+
+def test_runner_timeout_trips_breaker():
+    release = threading.Event()
+    runner = PluginRunner("slow", CircuitBreaker(failure_threshold=2, reset_timeout=60), timeout=0.05)
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        for _ in range(2):
+            assert runner.allow()
+            with pytest.raises(PluginTimeoutError):
+                runner.call(lambda event, tools: release.wait(5), False, None, None, pool)
+        release.set()
+    assert not runner.allow()
+    stats = runner.stats()
+    assert (stats["state"], stats["timeout_count"], stats["skip_count"]) == (BREAKER_OPEN, 2, 1)
+
+
+def test_runner_slow_call_counts_as_failure():
+    runner = PluginRunner("slow", CircuitBreaker(failure_threshold=1), slow_call=0.01)
+    assert runner.call(lambda event, tools: time.sleep(0.02) or "done", False, None, None, None) == "done"
+    assert runner.breaker.state == BREAKER_OPEN
+    assert runner.stats()["failure_count"] == 0
+
+
+def test_runner_coroutine_handler():
+    async def handler(event, tools):
+        await asyncio.sleep(1)
+
+    runner = PluginRunner("async", CircuitBreaker(), timeout=0.05)
+    with pytest.raises(PluginTimeoutError):
+        runner.call(handler, True, None, None, None)
+
+    async def failing(event, tools):
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        asyncio.run(runner.call_async(failing, True, None, None, None))
+    assert (runner.timeout_count, runner.failure_count) == (1, 1)
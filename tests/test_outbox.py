@@ -0,0 +1,84 @@
+import threading
+import time
+
+import pytest
+
+from outbox import Outbox
+from scheduler import KIND_OPEN_ID, KIND_REPLY
+
+
+class _ApiClient(object):
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def _send(self, request):
+        with self._lock:
+            if self.failures > 0:
+                self.failures -= 1
+                raise RuntimeError("unavailable")
+            self.sent.append(request)
+        return {"code": 0}
+
+    def send_message_json(self, receive_id_type, req_body):
+        return self._send((receive_id_type, req_body))
+
+    def reply_message_json(self, messages_id, req_body):
+        return self._send((KIND_REPLY, messages_id, req_body))
+
+
+def _wait_for(predicate, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_deliver_and_dedup(tmp_path):
+    api = _ApiClient()
+    outbox = Outbox(api, str(tmp_path / "outbox.db"), poll_interval=0.05)
+    outbox.enqueue(KIND_OPEN_ID, "ou_1", {"receive_id": "ou_1"}, dedup_key="k1")
+    outbox.enqueue(KIND_REPLY, "om_1", {"content": "reply"})
+    assert outbox.flush(5)
+    assert _wait_for(lambda: outbox.stats()["sent_count"] == 2)
+    # 已发送的去重键不再入队
+    outbox.enqueue(KIND_OPEN_ID, "ou_1", {"receive_id": "ou_1"}, dedup_key="k1")
+    assert outbox.flush(5)
+    outbox.close()
+    assert sorted(api.sent, key=str) == [(KIND_OPEN_ID, {"receive_id": "ou_1"}),
+                                         (KIND_REPLY, "om_1", {"content": "reply"})]
+
+
+def test_retry_then_dead_letter(tmp_path):
+    api = _ApiClient(failures=3)
+    outbox = Outbox(api, str(tmp_path / "outbox.db"), max_attempts=3, poll_interval=0.05,
+                    backoff_base=0.01, backoff_max=0.01)
+    outbox.enqueue(KIND_OPEN_ID, "ou_1", {"receive_id": "ou_1"})
+    assert _wait_for(lambda: outbox.stats()["dead_count"] == 1)
+    stats = outbox.stats()
+    assert (stats["retry_count"], stats["queue_depth"], stats["dead_letter_count"]) == (2, 0, 1)
+    dead = outbox.dead_letters()
+    assert (dead[0]["target"], dead[0]["attempts"], dead[0]["last_error"]) == ("ou_1", 3, "unavailable")
+    outbox.close()
+    assert api.sent == []
+
+
+def test_undelivered_messages_survive_restart(tmp_path):
+    path = str(tmp_path / "outbox.db")
+    outbox = Outbox(_ApiClient(failures=1), path, poll_interval=0.05, backoff_base=0.5, backoff_max=0.5)
+    outbox.enqueue(KIND_OPEN_ID, "ou_1", {"receive_id": "ou_1"})
+    assert _wait_for(lambda: outbox.stats()["retry_count"] == 1)
+    outbox.close()
+
+    api = _ApiClient()
+    outbox = Outbox(api, path, poll_interval=0.05)
+    assert _wait_for(lambda: api.sent == [(KIND_OPEN_ID, {"receive_id": "ou_1"})])
+    outbox.close()
+
+
+def test_enqueue_after_close_is_rejected(tmp_path):
+    outbox = Outbox(_ApiClient(), str(tmp_path / "outbox.db"), poll_interval=0.05)
+    outbox.close()
+    with pytest.raises(RuntimeError):
+        outbox.enqueue(KIND_OPEN_ID, "ou_1", {})
@@ -0,0 +1,57 @@
+import pytest
+
+from router import Router, ROUTE_FOUND, ROUTE_NOT_FOUND, ROUTE_METHOD_NOT_ALLOWED
+
+
+@pytest.fixture
+def router():
+    router = Router()
+    router.add("/plugin/example", "example")
+    router.add("/hook/{name}", "hook", methods=["post"])
+    router.add("/hook/status", "status", methods=["GET"])
+    router.add("/hook/{name}/events/{event}", "event")
+    router.add("/", "root")
+    return router
+
+
+def test_static_route(router):
+    match = router.match("GET", "/plugin/example")
+    assert (match.status, match.target, match.params) == (ROUTE_FOUND, "example", {})
+    assert router.match("GET", "/plugin/example/").target == "example"
+    assert router.match("GET", "/").target == "root"
+
+
+def test_param_route(router):
+    match = router.match("POST", "/hook/github")
+    assert (match.status, match.target, match.params) == (ROUTE_FOUND, "hook", {"name": "github"})
+    match = router.match("PUT", "/hook/github/events/push")
+    assert (match.target, match.params) == ("event", {"name": "github", "event": "push"})
+
+
+def test_static_segment_wins_over_param(router):
+    assert router.match("GET", "/hook/status").target == "status"
+    assert router.match("POST", "/hook/statuses").params == {"name": "statuses"}
+    # 命中静态路径后不再回退到路径参数
+    match = router.match("POST", "/hook/status")
+    assert (match.status, match.allowed_methods) == (ROUTE_METHOD_NOT_ALLOWED, ("GET",))
+
+
+def test_not_found(router):
+    assert router.match("GET", "/plugin").status == ROUTE_NOT_FOUND
+    assert router.match("GET", "/plugin/example/more").status == ROUTE_NOT_FOUND
+    assert router.match("POST", "/hook//events/push").status == ROUTE_NOT_FOUND
+
+
+def test_method_not_allowed(router):
+    match = router.match("GET", "/hook/github")
+    assert match.status == ROUTE_METHOD_NOT_ALLOWED
+    assert match.allowed_methods == ("POST",)
+
+
+def test_conflicting_routes():
+    router = Router()
+    router.add("/hook/{name}", "hook")
+    with pytest.raises(ValueError):
+        router.add("/hook/{other}/events", "events")
+    with pytest.raises(ValueError):
+        router.add("/hook/{name}", "again")
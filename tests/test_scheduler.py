@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pytest
+
+from api import LarkException
+from scheduler import OutboundScheduler, ENDPOINT_MESSAGE, KIND_OPEN_ID, RECEIVER_RATE_LIMIT_CODE
+
+
+class _Sender(object):
+    """
+    记录发送顺序，前 rate_limited 次发送返回频率限制
+    """
+
+    def __init__(self, rate_limited: int = 0, retry_after: float = 0.1, code: int = RECEIVER_RATE_LIMIT_CODE):
+        self.rate_limited = rate_limited
+        self.retry_after = retry_after
+        self.code = code
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        with self._lock:
+            if self.rate_limited > 0:
+                self.rate_limited -= 1
+                raise LarkException(self.code, "rate limited", status_code=429, retry_after=self.retry_after)
+            self.sent.append(name)
+        return name
+
+
+@pytest.fixture
+def make_scheduler():
+    schedulers = []
+
+    def make(**kwargs):
+        scheduler = OutboundScheduler(None, **kwargs)
+        schedulers.append(scheduler)
+        return scheduler
+
+    yield make
+    for scheduler in schedulers:
+        scheduler.close(wait=False)
+
+
+def test_requeued_jobs_keep_submit_order(make_scheduler):
+    scheduler = make_scheduler(workers=1, endpoint_rate=1000, receiver_rate=5)
+    sender = _Sender()
+    futures = [scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, i) for i in range(12)]
+    assert [f.result(10) for f in futures] == list(range(12))
+    # 超出接收者频率的消息重新排队后仍按提交顺序发送
+    assert sender.sent == list(range(12))
+
+
+def test_rate_limited_job_is_retried_after_retry_after(make_scheduler):
+    scheduler = make_scheduler(workers=2, endpoint_rate=1000, receiver_rate=1000)
+    sender = _Sender(rate_limited=1, retry_after=0.2)
+    started = time.monotonic()
+    assert scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m1").result(10) == "m1"
+    assert time.monotonic() - started >= 0.2
+    stats = scheduler.stats()
+    assert (stats["sent_count"], stats["rate_limited_count"]) == (1, 1)
+
+
+def test_rate_limit_gives_up_after_max_attempts(make_scheduler):
+    scheduler = make_scheduler(endpoint_rate=1000, max_attempts=2)
+    sender = _Sender(rate_limited=2, retry_after=0.01)
+    with pytest.raises(LarkException):
+        scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m1").result(10)
+
+
+def test_call_shares_buckets_and_retries(make_scheduler):
+    scheduler = make_scheduler(workers=1, endpoint_rate=10, receiver_rate=1000)
+    sender = _Sender(rate_limited=1, retry_after=0.2, code=0)
+    started = time.monotonic()
+    # 直接发送与队列中的消息共用接口令牌桶，频率限制后暂停令牌桶并重试
+    assert scheduler.call(ENDPOINT_MESSAGE, "ou_1", sender, "m0") == "m0"
+    assert time.monotonic() - started >= 0.2
+    futures = [scheduler.submit(ENDPOINT_MESSAGE, "ou_%d" % i, sender, "m%d" % i) for i in range(1, 11)]
+    for i in range(11, 21):
+        scheduler.call(ENDPOINT_MESSAGE, "ou_%d" % i, sender, "m%d" % i)
+    assert all(f.result(10) for f in futures)
+    # 桶容量为10，之后每秒10个：21个请求至少需要1秒
+    assert time.monotonic() - started >= 1.0
+    stats = scheduler.stats()
+    assert (stats["sent_count"], stats["rate_limited_count"]) == (21, 1)
+
+
+def test_cancelled_job_is_not_sent(make_scheduler):
+    scheduler = make_scheduler(endpoint_rate=1000, receiver_rate=1)
+    sender = _Sender()
+    first = scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m1")
+    second = scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m2")
+    assert second.cancel()
+    assert first.result(10) == "m1"
+    scheduler.close(timeout=5)
+    assert sender.sent == ["m1"]
+
+
+def test_close_hands_off_unsent_jobs():
+    scheduler = OutboundScheduler(None, endpoint_rate=1000, receiver_rate=1)
+    sender = _Sender()
+    handed_off = []
+    futures = [scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m%d" % i,
+                                handoff=(KIND_OPEN_ID, "ou_1", {"content": "m%d" % i})) for i in range(3)]
+    assert futures[0].result(10) == "m0"
+    scheduler.close(timeout=0.2, handoff=lambda *args: handed_off.append(args))
+    # 接收者频率为每秒1条，超时前只能发送第一条，其余转交给持久化队列
+    assert sender.sent == ["m0"]
+    assert handed_off == [(KIND_OPEN_ID, "ou_1", {"content": "m1"}), (KIND_OPEN_ID, "ou_1", {"content": "m2"})]
+    for future in futures[1:]:
+        with pytest.raises(RuntimeError):
+            future.result(0)
+    with pytest.raises(RuntimeError):
+        scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m3")
+
+
+def test_close_hands_off_job_backing_off_past_deadline():
+    scheduler = OutboundScheduler(None, endpoint_rate=1000)
+    sender = _Sender(rate_limited=1, retry_after=5)
+    handed_off = []
+    future = scheduler.submit(ENDPOINT_MESSAGE, "ou_1", sender, "m1", handoff=(KIND_OPEN_ID, "ou_1", {}))
+    deadline = time.monotonic() + 5
+    while not scheduler.stats()["rate_limited_count"] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    started = time.monotonic()
+    scheduler.close(timeout=0.2, handoff=lambda *args: handed_off.append(args))
+    assert time.monotonic() - started < 2
+    assert handed_off == [(KIND_OPEN_ID, "ou_1", {})]
+    with pytest.raises(RuntimeError):
+        future.result(0)
@@ -0,0 +1,90 @@
+import json
+
+from manager import ConfigManger
+from store import JournalStore, REMOVED
+
+
+def _write_json(path, data):
+    with open(path, "w", encoding="utf-8") as w:
+        json.dump(data, w)
+
+
+def test_journal_replay(tmp_path):
+    path = str(tmp_path / "db.json")
+    _write_json(path, {"a": 1, "b": 2})
+    store = JournalStore(path)
+    assert store.load() == {"a": 1, "b": 2}
+    store.append([store.encode("a", 10), store.encode("b", REMOVED), store.encode("c", {"x": 1}),
+                  store.encode("c", "y", ("y",)), store.encode("c", REMOVED, ("x",))])
+    store.close()
+
+    store = JournalStore(path)
+    assert store.load() == {"a": 10, "c": {"y": "y"}}
+    store.close()
+
+
+def test_journal_drops_incomplete_last_record(tmp_path):
+    path = str(tmp_path / "db.json")
+    store = JournalStore(path)
+    store.load()
+    store.append([store.encode("a", 1)])
+    store.close()
+    with open(store.journal_path, "ab") as w:
+        w.write(store.encode("b", 2)[:-5])
+
+    store = JournalStore(path)
+    assert store.load() == {"a": 1}
+    store.append([store.encode("c", 3)])
+    store.close()
+    store = JournalStore(path)
+    assert store.load() == {"a": 1, "c": 3}
+    store.close()
+
+
+def test_journal_not_replayed_on_other_snapshot(tmp_path):
+    path = str(tmp_path / "db.json")
+    _write_json(path, {"a": 1})
+    store = JournalStore(path)
+    store.load()
+    store.append([store.encode("a", 2)])
+    store.close()
+    # 替换快照后、重建日志前崩溃：旧日志基于旧快照，不再重放
+    _write_json(path, {"a": 3})
+
+    store = JournalStore(path)
+    assert store.load() == {"a": 3}
+    store.close()
+
+
+def test_write_snapshot_resets_journal(tmp_path):
+    path = str(tmp_path / "db.json")
+    store = JournalStore(path)
+    data = store.load()
+    store.append([store.encode("a", 1)])
+    data["a"] = 1
+    store.write_snapshot(store.encode_snapshot(data))
+    with open(store.journal_path, "rb") as r:
+        assert len(r.readlines()) == 1
+    store.append([store.encode("b", 2)])
+    store.close()
+
+    with open(path, encoding="utf-8") as r:
+        assert json.load(r) == {"a": 1}
+    store = JournalStore(path)
+    assert store.load() == {"a": 1, "b": 2}
+    store.close()
+
+
+def test_config_manager_compaction(tmp_path):
+    path = str(tmp_path / "db.json")
+    config = ConfigManger(path, compact_bytes=512)
+    for i in range(100):
+        config.put("key", i)
+        config.subtree("nested").put("item%d" % (i % 10), i)
+    assert config.compact_count > 0
+    config.close()
+
+    config = ConfigManger(path)
+    assert config.get("key") == 99
+    assert dict(config.get("nested")) == {"item%d" % i: 90 + i for i in range(10)}
+    config.close()
@@ -0,0 +1,89 @@
+import json
+
+import pytest
+
+from enums import ReceiveType
+from manager import ConfigManger
+from plugin.sys.TopicManager import TopicManager, TopicSubscriber, TopicTrie
+
+
+@pytest.fixture
+def trie():
+    trie = TopicTrie()
+    for topic in ("alerts", "alerts.prod.db", "alerts.*.db", "alerts.#", "alerts.*", "#", "news.#.daily"):
+        trie.add(topic)
+    return trie
+
+
+def test_trie_exact_and_single_level(trie):
+    assert sorted(trie.match("alerts.prod.db")) == ["#", "alerts.#", "alerts.*.db", "alerts.prod.db"]
+    assert sorted(trie.match("alerts.test")) == ["#", "alerts.#", "alerts.*"]
+
+
+def test_trie_multi_level_matches_zero_levels(trie):
+    assert sorted(trie.match("alerts")) == ["#", "alerts", "alerts.#"]
+    assert sorted(trie.match("news.daily")) == ["#", "news.#.daily"]
+    assert sorted(trie.match("news.a.b.daily")) == ["#", "news.#.daily"]
+    assert trie.match("news.a.weekly") == ["#"]
+
+
+def test_trie_remove(trie):
+    trie.remove("#")
+    trie.remove("alerts.*.db")
+    trie.remove("missing.topic")
+    assert sorted(trie.match("alerts.prod.db")) == ["alerts.#", "alerts.prod.db"]
+    assert trie.match("other") == []
+
+
+@pytest.fixture(scope="module")
+def topic_manager(tmp_path_factory):
+    # TopicManager 为单例，同一模块内共用
+    path = tmp_path_factory.mktemp("topic") / "db.json"
+    with open(str(path), "w", encoding="utf-8") as w:
+        json.dump({"topic_data": {"__init__": "", "legacy": [
+            {"id": "oc_1", "type": "group", "name": None},
+            {"id": "oc_1", "type": "user", "name": None},
+            {"id": "oc_1", "type": "user", "name": None}
+        ]}}, w)
+    config = ConfigManger(str(path))
+    yield TopicManager(config)
+    config.close()
+
+
+def test_legacy_topic_migrated_by_type_and_id(topic_manager):
+    subscribers = topic_manager.get_subscribers("legacy")
+    assert sorted((s.open_id, s.receive_type.value) for s in subscribers) == [
+        ("oc_1", ReceiveType.GROUP.value), ("oc_1", ReceiveType.USER.value)]
+    assert topic_manager.subscribed_topics("oc_1") == frozenset({"legacy"})
+
+
+def test_wildcard_subscribers(topic_manager):
+    topic_manager.add_subscribers("alerts.#", [TopicSubscriber("ou_1", ReceiveType.USER),
+                                               TopicSubscriber("oc_2", ReceiveType.GROUP)])
+    topic_manager.add_subscriber("alerts.*.db", TopicSubscriber("ou_1", ReceiveType.USER))
+    topic_manager.add_subscriber("alerts.prod.db", TopicSubscriber("ou_3", ReceiveType.USER))
+    # 同一订阅者只出现一次
+    assert sorted(s["id"] for s in topic_manager.match_subscribers("alerts.prod.db")) == ["oc_2", "ou_1", "ou_3"]
+    assert sorted(s["id"] for s in topic_manager.match_subscribers("alerts.test.db")) == ["oc_2", "ou_1"]
+    assert topic_manager.match_subscribers("news") == ()
+
+    # 订阅变化时清空匹配缓存
+    topic_manager.remove_subscriber("alerts.#", "oc_2")
+    assert sorted(s["id"] for s in topic_manager.match_subscribers("alerts.test.db")) == ["ou_1"]
+    assert topic_manager.unsubscribe_all("ou_1") == frozenset({"alerts.#", "alerts.*.db"})
+    assert topic_manager.match_subscribers("alerts.test.db") == ()
+
+
+def test_empty_subscribe_is_noop(topic_manager):
+    topic_manager.add_subscribers("empty", [])
+    assert not topic_manager.has_topic("empty")
+    assert topic_manager.match_topics("empty") == []
+
+
+def test_invalid_topics(topic_manager):
+    with pytest.raises(ValueError):
+        topic_manager.add_subscribers("alerts.a*", [])
+    with pytest.raises(ValueError):
+        topic_manager.create_topic("alerts..db")
+    with pytest.raises(ValueError):
+        topic_manager.publish("alerts.*", None)
@@ -2,8 +2,12 @@ import hashlib
 import base64
 from Crypto.Cipher import AES
 
+from dotenv import find_dotenv, load_dotenv
 from loguru import logger
 
+# utils是最先被导入的模块，在此统一加载环境变量，保证其他模块在导入时即可读取
+load_dotenv(find_dotenv())
+
 LOG_FORMAT = "<green>{time:HH:mm:ss.SSS}</green> | " \
              "<level>{level: <8}</level> | " \
              "<cyan>{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}</cyan> - <level>{message}</level>"
@@ -47,9 +51,9 @@ class AESCipher(object):
         return s[: -ord(s[len(s) - 1:])]
 
     def decrypt(self, enc):
-        iv = enc[: AES.block_size]
+        iv = enc[: self.bs]
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return self._unpad(cipher.decrypt(enc[AES.block_size:]))
+        return self._unpad(cipher.decrypt(enc[self.bs:]))
 
     def decrypt_string(self, enc):
         enc = base64.b64decode(enc)